@@ -1,9 +1,6 @@
-import os
 import requests
 from sap_integration.sap_service import SAPService
 
-SERVICE_LAYER_URL = os.getenv("SAP_SERVICE_LAYER_URL", "").rstrip("/")
-
 
 class SAPAttachmentService:
     @staticmethod
@@ -11,19 +8,12 @@ class SAPAttachmentService:
         """
         Uploads a file to SAP B1 Attachments2 endpoint.
         """
-        SAPService.ensure_session()
-
-        url = f"{SERVICE_LAYER_URL}/Attachments2"
-        headers = {
-            "Cookie": f"B1SESSION={SAPService.session_id}",
-        }
         files = {
             "files": (filename, file_obj, "application/octet-stream")
         }
 
         try:
-            resp = requests.post(url, headers=headers, files=files, verify=False, timeout=30)
-            resp.raise_for_status()
+            resp = SAPService.post("/Attachments2", files=files)
             return {"status": "success", "data": resp.json()}
         except requests.RequestException as e:
             return {"status": "failed", "message": str(e), "data": None}
@@ -33,14 +23,8 @@ class SAPAttachmentService:
         """
         Fetches metadata/details of an attachment.
         """
-        SAPService.ensure_session()
-
-        url = f"{SERVICE_LAYER_URL}/Attachments2({attachment_id})"
-        headers = {"Cookie": f"B1SESSION={SAPService.session_id}"}
-
         try:
-            resp = requests.get(url, headers=headers, verify=False, timeout=15)
-            resp.raise_for_status()
+            resp = SAPService.get(f"/Attachments2({attachment_id})")
             return {"status": "success", "data": resp.json()}
         except requests.RequestException as e:
             return {"status": "failed", "message": str(e), "data": None}
@@ -50,14 +34,8 @@ class SAPAttachmentService:
         """
         Deletes an attachment by ID.
         """
-        SAPService.ensure_session()
-
-        url = f"{SERVICE_LAYER_URL}/Attachments2({attachment_id})"
-        headers = {"Cookie": f"B1SESSION={SAPService.session_id}"}
-
         try:
-            resp = requests.delete(url, headers=headers, verify=False, timeout=15)
-            resp.raise_for_status()
+            SAPService.delete(f"/Attachments2({attachment_id})")
             return {"status": "success", "message": "Attachment deleted successfully"}
         except requests.RequestException as e:
             return {"status": "failed", "message": str(e)}
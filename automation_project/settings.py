@@ -87,6 +87,12 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Pipeline stages and validation workers write from several threads:
+            # wait for the write lock instead of failing with "database is locked"
+            'timeout': 20,
+            'transaction_mode': 'IMMEDIATE',
+        },
     }
 }
 
@@ -150,6 +156,23 @@ CELERY_RESULT_BACKEND = "django-db"
 CELERY_TRACK_STARTED = True
 # Optional: Expire results after 1 day (keeps DB lean)
 CELERY_RESULT_EXPIRES = 86400
+# Run tasks inline instead of on a worker (local development without a broker)
+CELERY_TASK_ALWAYS_EAGER = os.getenv("CELERY_TASK_ALWAYS_EAGER", "False") == "True"
+# Periodic jobs (run `celery -A automation_project beat`)
+CELERY_BEAT_SCHEDULE = {
+    "sync-open-grn-mirror": {
+        "task": "grn_automation.tasks.sync_open_grn_mirror",
+        "schedule": float(os.getenv("SAP_GRN_MIRROR_SYNC_SECONDS", "300")),
+    },
+    "refresh-vendor-master": {
+        "task": "grn_automation.tasks.refresh_vendor_master",
+        "schedule": float(os.getenv("VENDOR_SYNC_SECONDS", "3600")),
+    },
+    "evict-extraction-cache": {
+        "task": "grn_automation.tasks.evict_extraction_cache",
+        "schedule": 24 * 3600.0,
+    },
+}
 
 
 # JWT Config
@@ -0,0 +1,59 @@
+# Generated by Django 5.1 on 2026-10-16 22:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grn_automation', '0006_alter_grnautomation_options_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GRNSyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('watermark_date', models.DateField(blank=True, null=True)),
+                ('watermark_time', models.CharField(blank=True, default='', max_length=8)),
+                ('last_synced_at', models.DateTimeField(blank=True, null=True)),
+                ('last_full_sync_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='OpenGRN',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('doc_entry', models.IntegerField(unique=True)),
+                ('doc_num', models.IntegerField()),
+                ('card_code', models.CharField(max_length=100)),
+                ('card_name', models.CharField(blank=True, default='', max_length=255)),
+                ('doc_date', models.DateField(blank=True, null=True)),
+                ('update_date', models.DateField(blank=True, null=True)),
+                ('update_time', models.CharField(blank=True, default='', max_length=8)),
+                ('header', models.JSONField(default=dict)),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['doc_entry'],
+                'indexes': [models.Index(fields=['card_code', 'doc_num'], name='grn_automat_card_co_d5b0c2_idx'), models.Index(fields=['doc_num'], name='grn_automat_doc_num_bf82dd_idx'), models.Index(fields=['synced_at'], name='grn_automat_synced__0fe939_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='OpenGRNLine',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('line_num', models.IntegerField()),
+                ('item_code', models.CharField(blank=True, default='', max_length=100)),
+                ('data', models.JSONField(default=dict)),
+                ('grn', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='grn_automation.opengrn')),
+            ],
+            options={
+                'ordering': ['line_num'],
+                'constraints': [models.UniqueConstraint(fields=('grn', 'line_num'), name='unique_line_per_open_grn')],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1 on 2026-10-16 23:03
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grn_automation', '0007_open_grn_mirror'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VendorMaster',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('card_code', models.CharField(max_length=100, unique=True)),
+                ('card_name', models.CharField(max_length=255)),
+                ('normalized_name', models.CharField(max_length=255)),
+                ('synced_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'ordering': ['card_code'],
+                'indexes': [models.Index(fields=['normalized_name'], name='grn_automat_normali_78ea72_idx'), models.Index(fields=['synced_at'], name='grn_automat_synced__a5a9ad_idx')],
+            },
+        ),
+    ]
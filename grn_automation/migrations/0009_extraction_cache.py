@@ -0,0 +1,31 @@
+# Generated by Django 5.1 on 2026-10-16 23:04
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grn_automation', '0008_vendor_master'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExtractionCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('markdown', 'PDF to Markdown'), ('vendor_fields', 'Vendor Fields')], max_length=30)),
+                ('key', models.CharField(max_length=64)),
+                ('value', models.JSONField()),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('expires_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['kind', 'last_used_at'], name='grn_automat_kind_b6ea0b_idx'), models.Index(fields=['expires_at'], name='grn_automat_expires_688aaa_idx')],
+                'constraints': [models.UniqueConstraint(fields=('kind', 'key'), name='unique_extraction_cache_key')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1 on 2026-10-16 23:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grn_automation', '0009_extraction_cache'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='extractioncache',
+            name='kind',
+            field=models.CharField(choices=[('markdown', 'PDF to Markdown'), ('vendor_fields', 'Vendor Fields'), ('document', 'Single-pass Document')], max_length=30),
+        ),
+    ]
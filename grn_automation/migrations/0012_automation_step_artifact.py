@@ -0,0 +1,19 @@
+# Generated by Django 5.1 on 2026-10-16 23:23
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grn_automation', '0011_llm_rate_bucket'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='automationstep',
+            name='artifact',
+            field=models.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1 on 2026-10-16 23:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grn_automation', '0012_automation_step_artifact'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='grnautomation',
+            name='stage_timings',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1 on 2026-10-16 23:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grn_automation', '0013_automation_stage_timings'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='validationresult',
+            name='posting_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('posted', 'Posted'), ('failed', 'Failed'), ('unknown', 'Unknown')], default='pending', max_length=20),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1 on 2026-10-16 23:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grn_automation', '0014_validation_result_posting_unknown'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='validationresult',
+            name='num_at_card',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1 on 2026-10-16 23:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grn_automation', '0015_validation_result_num_at_card'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='grnautomation',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,6 +1,7 @@
 from django.db import models
 from django.utils import timezone
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 import uuid
 
 def automation_upload_to(instance, filename):
@@ -33,6 +34,10 @@ class GRNAutomation(models.Model):
         max_length=20, choices=CaseType.choices, null=True
     )
     validation_message = models.TextField(null=True, blank=True)  
+    # Per-stage timings and critical path of the latest pipeline run
+    stage_timings = models.JSONField(null=True, blank=True)
+    # Bumped by the pipeline on every step; a RUNNING row that stops beating lost its worker
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(default=timezone.now)
     completed_at = models.DateTimeField(null=True, blank=True)
     
@@ -74,6 +79,9 @@ class AutomationStep(models.Model):
         max_length=20, choices=Status.choices, default=Status.PENDING
     )
     message = models.TextField(null=True, blank=True)
+    # Output of a successful step (markdown, vendor fields, GRN snapshot,
+    # validation payloads...), so a failed run can resume after it
+    artifact = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
     updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
@@ -98,6 +106,7 @@ class ValidationResult(models.Model):
         PENDING = "pending", "Pending"
         POSTED = "posted", "Posted"
         FAILED = "failed", "Failed"
+        UNKNOWN = "unknown", "Unknown"
     
     automation = models.ForeignKey(
         GRNAutomation, 
@@ -121,6 +130,8 @@ class ValidationResult(models.Model):
         default=PostingStatus.PENDING
     )
     posting_message = models.TextField(null=True, blank=True)
+    # Vendor reference of the last invoice sent to SAP; an "unknown" posting is looked up by it
+    num_at_card = models.CharField(max_length=100, null=True, blank=True)
     
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -156,4 +167,129 @@ class DocumentLine(models.Model):
         ]
     
     def __str__(self):
-        return f"Line {self.line_num} - Qty: {self.remaining_open_quantity}"
\ No newline at end of file
+        return f"Line {self.line_num} - Qty: {self.remaining_open_quantity}"
+
+class OpenGRN(models.Model):
+    """Local mirror of an open SAP PurchaseDeliveryNote (GRN)."""
+    doc_entry = models.IntegerField(unique=True)
+    doc_num = models.IntegerField()
+    card_code = models.CharField(max_length=100)
+    card_name = models.CharField(max_length=255, blank=True, default="")
+    doc_date = models.DateField(null=True, blank=True)
+    update_date = models.DateField(null=True, blank=True)
+    update_time = models.CharField(max_length=8, blank=True, default="")
+    # Header fields exactly as SAP returned them, without DocumentLines
+    header = models.JSONField(default=dict)
+    synced_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['doc_entry']
+        indexes = [
+            models.Index(fields=["card_code", "doc_num"]),
+            models.Index(fields=["doc_num"]),
+            models.Index(fields=["synced_at"]),
+        ]
+
+    def to_sap(self):
+        """Return the GRN in the shape SAP returns it, lines included."""
+        return {**self.header, "DocumentLines": [line.data for line in self.lines.all()]}
+
+    def __str__(self):
+        return f"GRN {self.doc_num} ({self.card_code})"
+
+
+class OpenGRNLine(models.Model):
+    """A DocumentLine of a mirrored open GRN."""
+    grn = models.ForeignKey(
+        OpenGRN,
+        on_delete=models.CASCADE,
+        related_name="lines"
+    )
+    line_num = models.IntegerField()
+    item_code = models.CharField(max_length=100, blank=True, default="")
+    data = models.JSONField(default=dict)
+
+    class Meta:
+        ordering = ['line_num']
+        constraints = [
+            models.UniqueConstraint(
+                fields=["grn", "line_num"], name="unique_line_per_open_grn"
+            )
+        ]
+
+    def __str__(self):
+        return f"Line {self.line_num} of {self.grn}"
+
+
+class GRNSyncState(models.Model):
+    """Watermark of the open-GRN mirror sync."""
+    name = models.CharField(max_length=50, unique=True)
+    watermark_date = models.DateField(null=True, blank=True)
+    watermark_time = models.CharField(max_length=8, blank=True, default="")
+    last_synced_at = models.DateTimeField(null=True, blank=True)
+    last_full_sync_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.name} synced at {self.last_synced_at}"
+
+
+class VendorMaster(models.Model):
+    """Local copy of an SAP supplier (BusinessPartners, CardType cSupplier)."""
+    card_code = models.CharField(max_length=100, unique=True)
+    card_name = models.CharField(max_length=255)
+    normalized_name = models.CharField(max_length=255)
+    synced_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['card_code']
+        indexes = [
+            models.Index(fields=["normalized_name"]),
+            models.Index(fields=["synced_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.card_code} - {self.card_name}"
+
+
+class ExtractionCache(models.Model):
+    """Cached LLM extraction output, addressed by a hash of everything that produced it."""
+    class Kind(models.TextChoices):
+        MARKDOWN = "markdown", "PDF to Markdown"
+        VENDOR_FIELDS = "vendor_fields", "Vendor Fields"
+        DOCUMENT = "document", "Single-pass Document"
+
+    kind = models.CharField(max_length=30, choices=Kind.choices)
+    key = models.CharField(max_length=64)
+    value = models.JSONField()
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["kind", "key"], name="unique_extraction_cache_key"
+            )
+        ]
+        indexes = [
+            models.Index(fields=["kind", "last_used_at"]),
+            models.Index(fields=["expires_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.key[:12]}"
+
+
+class LLMRateBucket(models.Model):
+    """Shared token bucket for one LLM quota (requests or tokens per minute of a provider/model)."""
+    name = models.CharField(max_length=150, unique=True)
+    capacity = models.FloatField()
+    refill_per_second = models.FloatField()
+    tokens = models.FloatField()
+    # time.time() of the last refill
+    refilled_at = models.FloatField()
+
+    def __str__(self):
+        return f"{self.name}: {self.tokens:.0f}/{self.capacity:.0f}"
@@ -69,6 +69,7 @@ class GRNAutomationSerializer(serializers.ModelSerializer):
             "completed_at",
             "steps",
             "user_email",  
+            "stage_timings",
         )
     
     def get_filename(self, obj):
@@ -146,11 +147,12 @@ class ValidationResultSerializer(serializers.ModelSerializer):
             'bpl_id',
             'posting_status',
             'posting_message',
+            'num_at_card',
             'document_lines',
             'created_at',
             'updated_at',
         ]
-        read_only_fields = ['id', 'automation', 'created_at', 'updated_at']
+        read_only_fields = ['id', 'automation', 'num_at_card', 'created_at', 'updated_at']
 
 
 class DocumentLineUpdateSerializer(serializers.ModelSerializer):
@@ -193,6 +195,11 @@ class ValidationResultUpdateSerializer(serializers.ModelSerializer):
                 "Cannot update invoice that has already been posted. "
                 "Posting status is 'posted'."
             )
+        if instance and instance.posting_status == ValidationResult.PostingStatus.UNKNOWN:
+            raise serializers.ValidationError(
+                "Cannot update invoice that SAP may already have posted. "
+                "Posting status is 'unknown'."
+            )
         
         return attrs
     
@@ -0,0 +1,38 @@
+import logging
+from celery import shared_task
+from .utils.extraction_cache import evict
+from .utils.grn_mirror import sync_open_grns
+from .utils.pipeline import run_automation
+from .utils.vendor import get_vendor_index
+
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def process_grn_automation(automation_id):
+    """Run the upload pipeline for a queued automation; the result lands in the result backend."""
+    result = run_automation(automation_id)
+    logger.info(f"Automation {automation_id}: {result['message']}")
+    return result
+
+
+@shared_task(ignore_result=True)
+def sync_open_grn_mirror(full=False):
+    """Beat job: refresh the local open-GRN mirror from SAP."""
+    result = sync_open_grns(full=full)
+    logger.info(result["message"])
+    return result["data"]
+
+
+@shared_task(ignore_result=True)
+def refresh_vendor_master():
+    """Beat job: reload the supplier master and this worker's vendor index."""
+    index = get_vendor_index(force_refresh=True)
+    logger.info(f"Vendor index holds {len(index)} supplier(s)")
+
+
+@shared_task(ignore_result=True)
+def evict_extraction_cache():
+    """Beat job: drop expired and least recently used extraction cache entries."""
+    logger.info(f"Evicted {evict()} extraction cache entries")
@@ -1,3 +1,1321 @@
-from django.test import TestCase
+import time
+import tempfile
+import threading
+from datetime import timedelta
+from unittest import mock
+import requests
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+from sap_integration.batch import BatchResult
+from .utils.grns import (
+    GRNStream, iter_open_grns,
+    GRN_MAX_PAGE_SIZE, GRN_PAGE_TARGET_SECONDS, fetch_grns_by_docnums, fetch_grns_for_vendor, next_link_endpoint, next_page_size,
+)
+from .views import AutomationInvoiceStatsView
+from .models import AutomationStep, ExtractionCache, GRNAutomation, GRNSyncState, OpenGRN, ValidationResult, VendorMaster
+from .utils.extraction_and_validation import InvoiceProcessor
+from .utils.extraction_cache import evict, set_cached
+from .utils.grn_mirror import get_open_grns, recheck_open_grns, sync_open_grns
+from .utils.invoice import create_invoices
+from .utils.llm_providers import FakeLLMError, FakeProvider, LLMProvider, get_provider, reset_providers
+from .utils.matcher import matching_grns
+from .utils.pdf_text import layout_to_markdown, score_text
+from .utils.pipeline import STAGES, run_automation
+from .utils.stage_graph import critical_path, run_stage_graph
+from .utils.prompt_builder import build_validation_context
+from .utils.rate_limit import acquire
+from .utils import vendor
+from .utils.vendor import get_vendor_code_from_api, normalize_vendor_name, resolve_vendor
 
-# Create your tests here.
+
+def grn_payload(card_code, doc_entry):
+    return {
+        "CardCode": card_code,
+        "DocEntry": doc_entry,
+        "DocDate": "2025-09-07",
+        "BPL_IDAssignedToInvoice": 3,
+        "DocumentLines": [{"LineNum": 0, "RemainingOpenQuantity": 5}],
+    }
+
+
+class CreateInvoicesTests(SimpleTestCase):
+    @mock.patch("grn_automation.utils.invoice.SAPService.batch")
+    def test_results_map_back_in_order(self, batch):
+        batch.return_value = [
+            BatchResult(201, body={"DocEntry": 11}),
+            BatchResult(400, body={"error": {"message": {"value": "Closed GRPO"}}}),
+        ]
+
+        results = create_invoices(
+            [grn_payload("S1", 1), {"DocEntry": 2}, grn_payload("S1", 3)],
+            use_dummy=False,
+        )
+
+        operations = batch.call_args.args[0]
+        self.assertEqual(len(operations), 2)
+        self.assertEqual([r["status"] for r in results], ["success", "failed", "failed"])
+        self.assertEqual(results[0]["data"], {"DocEntry": 11})
+        self.assertIn("CardCode", results[1]["message"])
+        self.assertEqual(results[2]["message"], "SAP API Error: Closed GRPO")
+
+    @mock.patch("grn_automation.utils.invoice.SAPService.get")
+    @mock.patch("grn_automation.utils.invoice.SAPService.batch")
+    def test_timed_out_batch_is_rechecked_by_reference(self, batch, get):
+        batch.side_effect = requests.exceptions.ReadTimeout("read timed out")
+
+        def found_first(endpoint, params):
+            reference = batch.call_args.args[0][0].body["NumAtCard"]
+            return sap_response({"value": [{"DocEntry": 11, "NumAtCard": reference}]})
+
+        get.side_effect = found_first
+
+        results = create_invoices([grn_payload("S1", 1), grn_payload("S1", 2)], use_dummy=False)
+
+        self.assertIn("NumAtCard eq", get.call_args.kwargs["params"]["$filter"])
+        self.assertEqual([r["status"] for r in results], ["success", "failed"])
+        self.assertEqual(results[0]["data"]["DocEntry"], 11)
+
+    @mock.patch("grn_automation.utils.invoice.SAPService.get")
+    @mock.patch("grn_automation.utils.invoice.SAPService.batch")
+    def test_unconfirmed_invoices_are_unknown_when_sap_cannot_be_asked(self, batch, get):
+        batch.side_effect = ValueError("Unparseable $batch response")
+        get.side_effect = requests.exceptions.ConnectionError("down")
+
+        results = create_invoices([grn_payload("S1", 1), grn_payload("S1", 2)], use_dummy=False)
+
+        self.assertEqual([r["status"] for r in results], ["unknown", "unknown"])
+        self.assertIn(results[0]["data"]["NumAtCard"], results[0]["message"])
+
+    @mock.patch("grn_automation.utils.invoice.SAPService.get")
+    @mock.patch("grn_automation.utils.invoice.SAPService.batch")
+    def test_rejected_batch_is_failed_without_recheck(self, batch, get):
+        response = mock.Mock(status_code=400, text="Bad $batch")
+        response.json.side_effect = ValueError
+        batch.side_effect = requests.exceptions.HTTPError(response=response)
+
+        results = create_invoices([grn_payload("S1", 1), grn_payload("S1", 2)], use_dummy=False)
+
+        get.assert_not_called()
+        self.assertEqual([r["status"] for r in results], ["failed", "failed"])
+
+    @mock.patch("grn_automation.utils.invoice.SAPService.batch")
+    def test_dummy_mode_does_not_call_sap(self, batch):
+        results = create_invoices([grn_payload("S1", 1), grn_payload("S1", 2)])
+
+        batch.assert_not_called()
+        self.assertEqual([r["status"] for r in results], ["success", "success"])
+
+
+def sap_response(body):
+    resp = mock.Mock()
+    resp.json.return_value = body
+    return resp
+
+
+@mock.patch.dict("os.environ", {"SAP_SERVICE_LAYER_URL": "https://sap.example:50000/b1s/v1"})
+class GRNPagingTests(SimpleTestCase):
+    @mock.patch("grn_automation.utils.grns.SAPService.ensure_session")
+    @mock.patch("grn_automation.utils.grns.SAPService.get")
+    def test_follows_next_link_with_max_page_size(self, get, ensure_session):
+        get.side_effect = [
+            sap_response({
+                "value": [{"DocEntry": 1}, {"DocEntry": 2}],
+                "odata.nextLink": "PurchaseDeliveryNotes?$filter=x&$skip=2",
+            }),
+            sap_response({"value": [{"DocEntry": 3}]}),
+        ]
+
+        result = fetch_grns_for_vendor("S1", batch_size=50)
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual([grn["DocEntry"] for grn in result["data"]], [1, 2, 3])
+        first_call, second_call = get.call_args_list
+        self.assertIn("CardCode eq 'S1'", first_call.args[0])
+        self.assertEqual(first_call.kwargs["headers"]["Prefer"], "odata.maxpagesize=50")
+        self.assertEqual(second_call.args[0], "/PurchaseDeliveryNotes?$filter=x&$skip=2")
+
+    @mock.patch("grn_automation.utils.grns.SAPService.ensure_session")
+    @mock.patch("grn_automation.utils.grns.SAPService.get")
+    def test_no_open_grns_means_already_posted(self, get, ensure_session):
+        get.return_value = sap_response({"value": []})
+
+        result = fetch_grns_for_vendor("S1")
+
+        self.assertTrue(result["already_posted"])
+
+    def test_absolute_next_link_is_made_relative(self):
+        body = {"@odata.nextLink": "https://sap.example:50000/b1s/v1/PurchaseDeliveryNotes?$skip=20"}
+
+        self.assertEqual(next_link_endpoint(body), "/PurchaseDeliveryNotes?$skip=20")
+
+    def test_page_size_adapts_to_latency(self):
+        self.assertEqual(next_page_size(100, 0.1), 200)
+        self.assertEqual(next_page_size(100, GRN_PAGE_TARGET_SECONDS + 1), 50)
+        self.assertEqual(next_page_size(GRN_MAX_PAGE_SIZE, 0.1), GRN_MAX_PAGE_SIZE)
+
+
+class ParallelGRNFetchTests(SimpleTestCase):
+    @mock.patch("grn_automation.utils.grns.SAPService.ensure_session")
+    @mock.patch("grn_automation.utils.grns.SAPService.get")
+    def test_windows_are_fetched_and_returned_in_doc_entry_order(self, get, ensure_session):
+        def respond(endpoint, **kwargs):
+            if "/$count" in endpoint:
+                return mock.Mock(text="5")
+            skip = int(endpoint.split("$skip=")[1]) if "$skip=" in endpoint else 0
+            return sap_response({"value": [{"DocEntry": entry} for entry in range(skip + 1, min(skip + 2, 5) + 1)]})
+
+        get.side_effect = respond
+
+        result = fetch_grns_for_vendor("S1", batch_size=2, parallel=True)
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual([grn["DocEntry"] for grn in result["data"]], [1, 2, 3, 4, 5])
+        window_calls = [c for c in get.call_args_list if "/$count" not in c.args[0]]
+        self.assertEqual(len(window_calls), 3)
+        self.assertTrue(all("$top=2" in c.args[0] for c in window_calls))
+
+    @mock.patch("grn_automation.utils.grns.SAPService.ensure_session")
+    @mock.patch("grn_automation.utils.grns.SAPService.get")
+    def test_zero_count_means_already_posted(self, get, ensure_session):
+        get.return_value = mock.Mock(text="0")
+
+        result = fetch_grns_for_vendor("S1", parallel=True)
+
+        self.assertTrue(result["already_posted"])
+        get.assert_called_once()
+
+
+@mock.patch("grn_automation.utils.grns.SAPService.ensure_session")
+@mock.patch("grn_automation.utils.grns.SAPService.get")
+class DocNumGRNFetchTests(SimpleTestCase):
+    def test_only_referenced_docnums_are_fetched_in_chunks(self, get, ensure_session):
+        get.side_effect = [
+            sap_response({"value": [{"DocEntry": 1, "DocNum": 101}, {"DocEntry": 2, "DocNum": 102}]}),
+            sap_response({"value": [{"DocEntry": 3, "DocNum": 103}]}),
+        ]
+
+        result = fetch_grns_by_docnums("S1", [101, 102, 103], chunk_size=2)
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual([grn["DocNum"] for grn in result["data"]], [101, 102, 103])
+        first_endpoint = get.call_args_list[0].args[0]
+        self.assertIn("(DocNum eq 101 or DocNum eq 102)", first_endpoint)
+        self.assertIn("CardCode eq 'S1'", first_endpoint)
+
+    def test_missing_docnum_falls_back_to_full_vendor_scan(self, get, ensure_session):
+        get.side_effect = [
+            sap_response({"value": [{"DocEntry": 1, "DocNum": 101}]}),
+            sap_response({"value": [{"DocEntry": 1, "DocNum": 101}, {"DocEntry": 9, "DocNum": 109}]}),
+        ]
+
+        result = fetch_grns_by_docnums("S1", [101, 102])
+
+        self.assertEqual(len(result["data"]), 2)
+        self.assertNotIn("DocNum eq", get.call_args_list[1].args[0])
+
+
+def mirror_doc(doc_entry, doc_num, status="bost_Open", update_date="2025-01-10", update_time="10:00:00"):
+    return {
+        "DocEntry": doc_entry,
+        "DocNum": doc_num,
+        "CardCode": "S1",
+        "DocDate": "2025-01-01",
+        "DocumentStatus": status,
+        "UpdateDate": update_date,
+        "UpdateTime": update_time,
+        "DocumentLines": [{"LineNum": 0, "ItemCode": "A", "RemainingOpenQuantity": 5}],
+    }
+
+
+@mock.patch("grn_automation.utils.grn_mirror.SAPService.ensure_session")
+@mock.patch("grn_automation.utils.grns.SAPService.get")
+class OpenGRNMirrorTests(TestCase):
+    def test_full_sync_then_incremental_sync_removes_closed_grns(self, get, ensure_session):
+        get.return_value = sap_response({"value": [mirror_doc(1, 101), mirror_doc(2, 102)]})
+        self.assertTrue(sync_open_grns()["data"]["full"])
+        self.assertEqual(OpenGRN.objects.count(), 2)
+
+        get.return_value = sap_response({"value": [
+            mirror_doc(2, 102, status="bost_Close", update_date="2025-01-11", update_time="08:30:00"),
+        ]})
+        result = sync_open_grns()
+
+        self.assertFalse(result["data"]["full"])
+        self.assertIn("UpdateDate gt '2025-01-10'", get.call_args.args[0])
+        self.assertEqual(list(OpenGRN.objects.values_list("doc_entry", flat=True)), [1])
+        state = GRNSyncState.objects.get()
+        self.assertEqual((state.watermark_date.isoformat(), state.watermark_time), ("2025-01-11", "08:30:00"))
+
+    def test_fresh_mirror_serves_reads_without_sap(self, get, ensure_session):
+        get.return_value = sap_response({"value": [mirror_doc(1, 101)]})
+        sync_open_grns()
+        get.reset_mock()
+
+        result = get_open_grns("S1", [101], projection="matching")
+
+        self.assertEqual(result["source"], "mirror")
+        self.assertEqual(result["data"][0]["DocumentLines"][0]["RemainingOpenQuantity"], 5)
+        get.assert_not_called()
+
+    def test_vendor_grn_view_is_served_from_a_fresh_mirror(self, get, ensure_session):
+        get.return_value = sap_response({"value": [mirror_doc(1, 101)]})
+        sync_open_grns()
+        get.reset_mock()
+        client = APIClient()
+        client.force_authenticate(get_user_model().objects.create_user("buyer", email="buyer@example.com", password="x"))
+
+        resp = client.post("/api/v1/automation/vendor-grns/", {"vendor_code": "S1"}, format="json")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data["source"], "mirror")
+        self.assertEqual(resp.data["data"][0]["DocumentLines"][0]["RemainingOpenQuantity"], 5)
+        get.assert_not_called()
+
+    def test_projection_wider_than_the_mirror_is_read_from_sap(self, get, ensure_session):
+        get.return_value = sap_response({"value": [mirror_doc(1, 101)]})
+        sync_open_grns()
+        full_doc = {**mirror_doc(1, 101), "TaxDate": "2025-01-01", "AddressExtension": {"ShipToCity": "Dubai"}}
+        get.return_value = sap_response({"value": [full_doc]})
+
+        result = get_open_grns("S1", projection="full")
+
+        self.assertEqual(result["source"], "sap")
+        self.assertEqual(result["data"][0]["AddressExtension"], {"ShipToCity": "Dubai"})
+
+    def test_recheck_drops_grns_closed_in_sap(self, get, ensure_session):
+        get.return_value = sap_response({"value": [mirror_doc(1, 101), mirror_doc(2, 102)]})
+        sync_open_grns()
+        get.return_value = sap_response({"value": [mirror_doc(1, 101)]})
+
+        result = recheck_open_grns([1, 2])
+
+        self.assertEqual(result["status"], "failed")
+        self.assertEqual(result["data"]["closed"], [2])
+        self.assertFalse(OpenGRN.objects.filter(doc_entry=2).exists())
+
+
+@mock.patch("grn_automation.utils.grns.SAPService.ensure_session")
+@mock.patch("grn_automation.utils.grns.SAPService.get")
+class GRNProjectionTests(SimpleTestCase):
+    def test_stage_projection_narrows_select_and_trims_lines(self, get, ensure_session):
+        get.return_value = sap_response({"value": [{
+            "DocEntry": 1, "DocNum": 101, "CardCode": "S1",
+            "DocumentLines": [{"LineNum": 0, "RemainingOpenQuantity": 2, "WarehouseCode": "W1", "ItemCode": "A"}],
+        }]})
+
+        result = fetch_grns_for_vendor("S1", projection="posting")
+
+        endpoint = get.call_args.args[0]
+        self.assertIn("$select=DocEntry,DocNum,DocDate,CardCode,BPL_IDAssignedToInvoice,DocumentLines", endpoint)
+        self.assertNotIn("AddressExtension", endpoint)
+        self.assertEqual(result["data"][0]["DocumentLines"], [{"LineNum": 0, "RemainingOpenQuantity": 2}])
+
+    def test_default_projection_keeps_full_documents(self, get, ensure_session):
+        lines = [{"LineNum": 0, "WarehouseCode": "W1"}]
+        get.return_value = sap_response({"value": [{"DocEntry": 1, "AddressExtension": {}, "DocumentLines": lines}]})
+
+        result = fetch_grns_for_vendor("S1")
+
+        self.assertIn("AddressExtension,TaxExtension,DocumentLines", get.call_args.args[0])
+        self.assertEqual(result["data"][0]["DocumentLines"], lines)
+
+
+@mock.patch("grn_automation.utils.grns.SAPService.get")
+class GRNStreamingTests(SimpleTestCase):
+    def test_pages_flow_through_filter_and_match_without_being_collected(self, get):
+        get.side_effect = [
+            sap_response({"value": [{"DocEntry": 1, "DocNum": 101}], "odata.nextLink": "PurchaseDeliveryNotes?$skip=1"}),
+            sap_response({"value": [{"DocEntry": 2, "DocNum": 102}]}),
+        ]
+
+        stream = GRNStream(iter_open_grns("S1", projection="matching"))
+        result = matching_grns("S1", [102], stream.filtered())
+
+        self.assertEqual([grn["DocNum"] for grn in result["data"]], [102])
+        self.assertEqual((stream.fetched, stream.filtered_count), (2, 2))
+        self.assertFalse(stream.is_empty())
+
+    def test_missing_docnum_continues_with_the_rest_of_the_vendor(self, get):
+        get.side_effect = [
+            sap_response({"value": [{"DocEntry": 1, "DocNum": 101}]}),
+            sap_response({"value": [{"DocEntry": 1, "DocNum": 101}, {"DocEntry": 3, "DocNum": 103}]}),
+        ]
+
+        grns = list(iter_open_grns("S1", [101, 102]))
+
+        self.assertEqual([grn["DocEntry"] for grn in grns], [1, 3])
+
+    def test_error_mid_stream_is_recorded(self, get):
+        get.side_effect = [
+            sap_response({"value": [{"DocEntry": 1, "DocNum": 101}], "odata.nextLink": "PurchaseDeliveryNotes?$skip=1"}),
+            sap_response(["unexpected"]),
+        ]
+
+        stream = GRNStream(iter_open_grns("S1"))
+        result = matching_grns("S1", [101], stream.filtered())
+
+        self.assertEqual(result["status"], "failed")
+        self.assertIsInstance(stream.error, ValueError)
+
+
+class VendorNormalizationTests(SimpleTestCase):
+    def test_legal_forms_punctuation_and_case_are_ignored(self):
+        self.assertEqual(normalize_vendor_name("Al-Noor Trading Co. W.L.L."), "al noor trading")
+        self.assertEqual(normalize_vendor_name("AL NOOR TRADING COMPANY"), "al noor trading")
+        self.assertEqual(normalize_vendor_name("Smith & Sons L.L.C"), "smith and sons")
+
+
+@mock.patch("grn_automation.utils.vendor.SAPService.get")
+class VendorResolutionTests(TestCase):
+    def setUp(self):
+        self.partners = {"value": [
+            {"CardCode": "S001", "CardName": "Gulf Steel Industries LLC"},
+            {"CardCode": "S002", "CardName": "Desert Rose Catering Est."},
+        ]}
+        # Every test starts outside the refresh cooldown
+        patcher = mock.patch("grn_automation.utils.vendor._last_refresh_at", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_misspelled_name_resolves_with_confidence(self, get):
+        get.return_value = sap_response(self.partners)
+
+        result = resolve_vendor("Gulf Steal Industries")
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(result["data"], "S001")
+        self.assertGreater(result["confidence"], 0.8)
+        self.assertLess(result["confidence"], 1.0)
+        get.assert_called_once()
+
+    def test_miss_refreshes_the_index_once(self, get):
+        get.return_value = sap_response(self.partners)
+        resolve_vendor("Gulf Steel Industries")
+        get.return_value = sap_response({"value": self.partners["value"] + [
+            {"CardCode": "S003", "CardName": "Blue Harbour Logistics"},
+        ]})
+
+        with mock.patch("grn_automation.utils.vendor._last_refresh_at", None):
+            result = resolve_vendor("Blue Harbour Logistics LLC")
+
+        self.assertEqual(result["data"], "S003")
+        self.assertEqual(get.call_count, 2)
+
+    def test_expired_index_is_not_refreshed_on_every_lookup_while_sap_is_down(self, get):
+        get.return_value = sap_response(self.partners)
+        resolve_vendor("Gulf Steel Industries")
+        VendorMaster.objects.update(synced_at=timezone.now() - timedelta(days=1))
+        vendor._last_refresh_at = None
+        get.reset_mock()
+        get.side_effect = requests.exceptions.ConnectionError("SAP down")
+
+        first = resolve_vendor("Blue Harbour Logistics")
+        second = resolve_vendor("Blue Harbour Logistics")
+        third = resolve_vendor("Gulf Steel Industries")
+
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual([first["status"], second["status"]], ["failed", "failed"])
+        self.assertEqual(third["data"], "S001")
+
+    def test_sync_runs_outside_the_index_lock(self, get):
+        seen = []
+
+        def page(*args, **kwargs):
+            seen.append(vendor._index_lock.locked())
+            # A lookup that arrives mid-sync is served from the current index
+            vendor._last_refresh_at = None
+            seen.append(len(vendor.get_vendor_index()))
+            return sap_response(self.partners)
+
+        get.side_effect = page
+
+        index = vendor.get_vendor_index(force_refresh=True)
+
+        self.assertEqual(seen, [False, 0])
+        self.assertEqual(len(index), 2)
+        get.assert_called_once()
+
+    def test_sync_that_stops_partway_keeps_the_stored_master(self, get):
+        get.return_value = sap_response(self.partners)
+        vendor.sync_vendor_master()
+        synced_at = VendorMaster.objects.get(card_code="S002").synced_at
+        get.side_effect = [
+            sap_response({
+                "value": [{"CardCode": "S001", "CardName": "Gulf Steel Industries LLC"}],
+                "odata.nextLink": "BusinessPartners?$skip=1",
+            }),
+            requests.exceptions.ConnectionError("SAP down"),
+        ]
+
+        result = vendor.sync_vendor_master()
+
+        self.assertEqual(result["status"], "failed")
+        self.assertEqual(VendorMaster.objects.count(), 2)
+        self.assertEqual(set(VendorMaster.objects.values_list("synced_at", flat=True)), {synced_at})
+
+    def test_unreachable_sap_with_no_stored_suppliers_is_an_upstream_error(self, get):
+        get.side_effect = requests.exceptions.ConnectionError("SAP down")
+
+        result = get_vendor_code_from_api("Gulf Steel Industries")
+
+        self.assertEqual(result["status"], "failed")
+        self.assertIn("Request error", result["message"])
+        self.assertNotIn("No vendor found", result["message"])
+
+
+@mock.patch("google.genai.Client")
+class MarkdownCacheTests(TestCase):
+    def setUp(self):
+        self.pdf = tempfile.NamedTemporaryFile(suffix=".pdf")
+        self.pdf.write(b"%PDF-1.4 invoice")
+        self.pdf.flush()
+        self.processor = InvoiceProcessor(api_key="x")
+
+    def tearDown(self):
+        self.pdf.close()
+
+    def test_same_pdf_is_extracted_once(self, client):
+        client.return_value.models.generate_content.return_value = mock.Mock(text="# Invoice")
+
+        first = self.processor.extract_complete_markdown(self.pdf.name)
+        second = self.processor.extract_complete_markdown(self.pdf.name)
+
+        self.assertEqual(first["data"], "# Invoice")
+        self.assertEqual(second["data"], "# Invoice")
+        self.assertIn("cache", second["message"])
+        client.return_value.models.generate_content.assert_called_once()
+        self.assertEqual(ExtractionCache.objects.get().hits, 1)
+
+    def test_expired_and_overflowing_entries_are_evicted(self, client):
+        set_cached(ExtractionCache.Kind.MARKDOWN, "expired", "old", ttl_seconds=-1)
+        for key in ("a", "b", "c"):
+            set_cached(ExtractionCache.Kind.MARKDOWN, key, key)
+
+        evict(max_entries=2)
+
+        self.assertEqual(sorted(ExtractionCache.objects.values_list("key", flat=True)), ["b", "c"])
+
+
+@mock.patch("google.genai.Client")
+class VendorFieldsCacheTests(TestCase):
+    RESPONSE = (
+        '{"vendor_code": "S1", "vendor_name": "Gulf Steel", "grn_po_number": ["101"], '
+        '"scenario_detected": "single_grn", "invoices": []}'
+    )
+
+    def test_identical_markdown_skips_the_second_llm_call(self, client):
+        client.return_value.models.generate_content.return_value = mock.Mock(text=self.RESPONSE)
+        processor = InvoiceProcessor(api_key="x")
+
+        first = processor.extract_vendor_fields("# Invoice 1")
+        second = processor.extract_vendor_fields("# Invoice 1")
+
+        self.assertEqual(first, second)
+        self.assertEqual(second["data"]["vendor_info"]["grn_po_number"], ["101"])
+        client.return_value.models.generate_content.assert_called_once()
+
+    def test_prompt_module_change_invalidates_entries(self, client):
+        client.return_value.models.generate_content.return_value = mock.Mock(text=self.RESPONSE)
+        processor = InvoiceProcessor(api_key="x")
+
+        processor.extract_vendor_fields("# Invoice 1")
+        with mock.patch("grn_automation.utils.extraction_and_validation.PROMPT_MODULE_VERSION", "edited"):
+            processor.extract_vendor_fields("# Invoice 1")
+
+        self.assertEqual(client.return_value.models.generate_content.call_count, 2)
+
+
+class ConcurrentValidationTests(SimpleTestCase):
+    def test_results_keep_invoice_order_and_failures_stay_isolated(self):
+        processor = InvoiceProcessor(api_key="x")
+        invoices = [
+            {"invoice_number": "INV-1", "invoice_date": "2025-01-01", "line_items": []},
+            {"invoice_number": "INV-2", "invoice_date": "2025-01-02"},  # no line_items
+            {"invoice_number": "INV-3", "invoice_date": "2025-01-03", "line_items": []},
+        ]
+        active = []
+        peak = []
+
+        def execute(user_content, prompt_type):
+            active.append(1)
+            peak.append(len(active))
+            # finish in reverse order of submission
+            time.sleep(0.05 if "INV-1" in user_content else 0.01)
+            active.pop()
+            return {"invoice_number": None, "status": "SUCCESS", "reasoning": "ok", "payload": None}
+
+        with mock.patch.object(processor, "_execute_validation", side_effect=execute), \
+                mock.patch("grn_automation.utils.extraction_and_validation.connection") as connection:
+            results = processor._validate_single_grn("# md", {"DocEntry": 1}, invoices)
+
+        # Every pool thread drops the DB connection the rate limiter may have opened
+        self.assertEqual(connection.close.call_count, len(invoices))
+        self.assertEqual([r["invoice_number"] for r in results], ["INV-1", "INV-2", "INV-3"])
+        self.assertEqual([r["status"] for r in results], ["SUCCESS", "FAILED", "SUCCESS"])
+        self.assertIn("line_items", results[1]["reasoning"])
+        self.assertGreater(max(peak), 1)
+
+
+class ValidationPromptContextTests(SimpleTestCase):
+    INVOICE = {
+        "invoice_number": "INV-7",
+        "invoice_date": "2025-03-04",
+        "line_items": [{"description": "Steel rebar 12mm", "unit_price": 250.0, "line_total": 500.0}],
+    }
+
+    def test_only_the_invoice_sections_and_matching_lines_are_sent(self):
+        markdown = "\n\n".join(
+            ["# ACME TRADING LLC\nTax invoice"]
+            + [f"## Invoice INV-{n + 4 if n == 3 else n}\n| Item {n} | {n}00.00 |\n" + "filler " * 80 for n in range(1, 7)]
+        )
+        grn = {
+            "DocEntry": 9, "DocNum": 101, "CardCode": "S1",
+            "DocumentLines": [
+                {"LineNum": 0, "ItemCode": "RB12", "ItemDescription": "STEEL REBAR 12MM", "UnitPrice": 250.0},
+            ] + [
+                {"LineNum": n, "ItemCode": f"X{n}", "ItemDescription": f"Cement bag {n}", "UnitPrice": 30.0}
+                for n in range(1, 30)
+            ],
+        }
+
+        markdown_context, grn_context, report = build_validation_context(markdown, grn, self.INVOICE)
+
+        self.assertIn("## Invoice INV-7", markdown_context)
+        self.assertNotIn("## Invoice INV-2", markdown_context)
+        self.assertIn("STEEL REBAR 12MM", grn_context)
+        self.assertNotIn("Cement bag", grn_context)
+        self.assertIn("29 other line(s)", grn_context)
+        self.assertLess(report["markdown_tokens_sent"], report["markdown_tokens_full"])
+        self.assertLess(report["grn_tokens_sent"], report["grn_tokens_full"] / 5)
+
+    def test_nothing_is_dropped_when_no_line_matches(self):
+        grn = {"DocEntry": 9, "DocNum": 101, "DocumentLines": [{"LineNum": 0, "ItemDescription": "Cement"}]}
+
+        markdown_context, grn_context, _ = build_validation_context("# short", grn, self.INVOICE)
+
+        self.assertEqual(markdown_context, "# short")
+        self.assertIn("Cement", grn_context)
+
+
+class FakePDFPage:
+    def __init__(self, text):
+        self.text = text
+
+    def extract_text(self, extraction_mode="plain"):
+        return self.text
+
+
+def text_layer_pdf(lines):
+    """A one-page PDF whose text layer holds `lines`, set in Courier so the columns survive."""
+    text = "".join(
+        "BT /F1 10 Tf 40 {} Td ({}) Tj ET\n".format(800 - 14 * number, line.replace("(", "\\(").replace(")", "\\)"))
+        for number, line in enumerate(lines)
+    ).encode()
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents 4 0 R "
+        b"/Resources << /Font << /F1 5 0 R >> >> >>",
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(text) + 1, text),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier >>",
+    ]
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return pdf
+
+
+@mock.patch("google.genai.Client")
+class PDFTextFastPathTests(TestCase):
+    INVOICE_PAGE = (
+        "ACME TRADING LLC                         TAX INVOICE\n"
+        "Invoice No: INV-7        Date: 04/03/2025        GRN No: 45120\n\n"
+        "Item              Qty        Unit Price        Amount\n"
+        "Steel rebar 12mm    2          250.00          500.00\n"
+        "Cement bag 50kg    10           30.00          300.00\n"
+    )
+
+    def setUp(self):
+        self.pdf = tempfile.NamedTemporaryFile(suffix=".pdf")
+        self.pdf.write(b"%PDF-1.4 invoice")
+        self.pdf.flush()
+        self.processor = InvoiceProcessor(api_key="x")
+
+    def tearDown(self):
+        self.pdf.close()
+
+    def extract(self, pages):
+        reader = mock.Mock(is_encrypted=False, pages=[FakePDFPage(text) for text in pages])
+        with mock.patch("grn_automation.utils.pdf_text.PdfReader", return_value=reader):
+            return self.processor.extract_complete_markdown(self.pdf.name)
+
+    def test_text_layer_pdf_does_not_call_gemini(self, client):
+        result = self.extract([self.INVOICE_PAGE])
+
+        self.assertEqual(result["status"], "success")
+        self.assertIn("locally", result["message"])
+        self.assertIn("| Steel rebar 12mm | 2 | 250.00 | 500.00 |", result["data"])
+        client.return_value.models.generate_content.assert_not_called()
+
+    def test_real_text_layer_pdf_is_read_locally(self, client):
+        self.pdf.seek(0)
+        self.pdf.truncate()
+        self.pdf.write(text_layer_pdf(self.INVOICE_PAGE.splitlines()))
+        self.pdf.flush()
+
+        result = self.processor.extract_complete_markdown(self.pdf.name)
+
+        self.assertEqual(result["status"], "success", result["message"])
+        self.assertIn("GRN No: 45120", result["data"])
+        self.assertIn("| Cement bag 50kg | 10 | 30.00 | 300.00 |", result["data"])
+        client.return_value.models.generate_content.assert_not_called()
+
+    def test_scanned_page_falls_back_to_gemini(self, client):
+        client.return_value.models.generate_content.return_value = mock.Mock(text="# Invoice")
+
+        result = self.extract([self.INVOICE_PAGE, ""])
+
+        self.assertEqual(result["data"], "# Invoice")
+        client.return_value.models.generate_content.assert_called_once()
+
+    def test_score_needs_references_and_dates(self, client):
+        self.assertGreaterEqual(score_text([self.INVOICE_PAGE])["score"], 0.85)
+        no_grn = score_text([self.INVOICE_PAGE.replace("GRN No: 45120", "")])
+        self.assertEqual(no_grn["checks"]["references"], 0.0)
+        self.assertLess(no_grn["score"], 0.85)
+        self.assertEqual(layout_to_markdown("Total   AED   800.00\n"), "Total  AED  800.00")
+
+
+@mock.patch("google.genai.Client")
+class ExtractionModeTests(TestCase):
+    FIELDS = (
+        '"vendor_code": "S1", "vendor_name": "Gulf Steel", "grn_po_number": ["101"], '
+        '"scenario_detected": "single_grn", "invoices": []'
+    )
+
+    def setUp(self):
+        self.pdf = tempfile.NamedTemporaryFile(suffix=".pdf")
+        self.pdf.write(b"%PDF-1.4 invoice")
+        self.pdf.flush()
+        self.processor = InvoiceProcessor(api_key="x")
+
+    def tearDown(self):
+        self.pdf.close()
+
+    def test_single_pass_returns_markdown_and_fields_from_one_call(self, client):
+        client.return_value.models.generate_content.return_value = mock.Mock(
+            text="{" + self.FIELDS + ', "markdown": "# Invoice"}'
+        )
+
+        result = self.processor.extract_document(self.pdf.name, mode="single_pass")
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(result["mode"], "single_pass")
+        self.assertEqual(result["data"]["markdown"], "# Invoice")
+        self.assertEqual(result["data"]["scenario_detected"], "single_grn")
+        client.return_value.models.generate_content.assert_called_once()
+
+    def test_two_pass_has_the_same_shape(self, client):
+        client.return_value.models.generate_content.side_effect = [
+            mock.Mock(text="# Invoice"),
+            mock.Mock(text="{" + self.FIELDS + "}"),
+        ]
+
+        result = self.processor.extract_document(self.pdf.name, mode="two_pass")
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(result["data"]["markdown"], "# Invoice")
+        self.assertEqual(result["data"]["vendor_info"]["grn_po_number"], ["101"])
+        self.assertEqual(client.return_value.models.generate_content.call_count, 2)
+
+
+class LLMProviderTests(TestCase):
+    def setUp(self):
+        reset_providers()
+        self.addCleanup(reset_providers)
+
+    @mock.patch("google.genai.Client")
+    def test_processors_share_one_pooled_client_per_process(self, client):
+        client.return_value.models.generate_content.return_value = mock.Mock(text="{}")
+
+        for _ in range(3):
+            InvoiceProcessor().provider.generate("gemini-2.5-flash", "hi")
+
+        self.assertIs(InvoiceProcessor().provider, get_provider("hosted"))
+        client.assert_called_once()
+        http_options = client.call_args.kwargs["http_options"]
+        self.assertEqual(http_options.timeout, 120000)
+        self.assertEqual(http_options.retry_options.attempts, 3)
+
+    @mock.patch("google.genai.Client")
+    def test_reset_closes_and_rebuilds_clients(self, client):
+        get_provider("hosted").generate("gemini-2.5-flash", "hi")
+
+        reset_providers()
+        get_provider("hosted").generate("gemini-2.5-flash", "hi")
+
+        client.return_value.close.assert_called_once()
+        self.assertEqual(client.call_count, 2)
+
+    def test_unknown_provider_is_rejected(self):
+        with self.assertRaises(ValueError):
+            get_provider("nope")
+        # Single-backend clients cannot serve both calls, so they are not providers
+        with self.assertRaises(ValueError):
+            get_provider("gemini")
+
+    def test_provider_must_implement_both_calls(self):
+        class GenerateOnly(LLMProvider):
+            def generate(self, model, prompt, pdf_bytes=None, system_instruction=None, response_schema=None):
+                return ""
+
+        with self.assertRaises(TypeError):
+            GenerateOnly()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@mock.patch.dict("grn_automation.utils.rate_limit.RATE_LIMITS", {"openai:gpt-5": {"rpm": 60, "tpm": 6000}})
+class LLMRateLimitTests(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch("grn_automation.utils.rate_limit.time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_callers_wait_for_refill_instead_of_failing(self):
+        for _ in range(60):
+            self.assertEqual(acquire("openai", "gpt-5"), 0.0)
+
+        waited = acquire("openai", "gpt-5")
+
+        # one request refills every second at 60 rpm
+        self.assertGreaterEqual(waited, 1.0)
+        self.assertTrue(self.clock.sleeps)
+
+    def test_tokens_per_minute_are_limited_too(self):
+        acquire("openai", "gpt-5", tokens=5000)
+
+        waited = acquire("openai", "gpt-5", tokens=2000)
+
+        # 1000 tokens short at 100 tokens/second
+        self.assertGreaterEqual(waited, 10.0)
+        self.assertLess(waited, 12.0)
+
+    def test_unconfigured_models_are_not_limited(self):
+        self.assertEqual(acquire("openai", "other-model", tokens=10 ** 9), 0.0)
+        self.assertFalse(self.clock.sleeps)
+
+
+class FakeLLMProviderTests(TestCase):
+    GRN = {
+        "DocEntry": 77, "DocNum": 4512, "CardCode": "S1", "BPL_IDAssignedToInvoice": 2,
+        "DocumentLines": [
+            {"LineNum": 0, "ItemDescription": "Steel rebar 12mm", "RemainingOpenQuantity": 20, "UnitPrice": 250.0},
+            {"LineNum": 1, "ItemDescription": "Binding wire 1.2mm", "RemainingOpenQuantity": 10, "UnitPrice": 35.0},
+        ],
+    }
+
+    def setUp(self):
+        self.pdf = tempfile.NamedTemporaryFile(suffix=".pdf")
+        self.pdf.write(b"%PDF-1.4 scanned invoice")
+        self.pdf.flush()
+
+    def tearDown(self):
+        self.pdf.close()
+
+    def test_pipeline_runs_offline_from_fixtures(self):
+        provider = FakeProvider(latency_scale=0, error_rate=0)
+        processor = InvoiceProcessor(provider=provider)
+
+        extracted = processor.extract_document(self.pdf.name, mode="two_pass")
+        self.assertEqual(extracted["status"], "success")
+        document = next(doc for doc in provider.documents if doc["markdown"] == extracted["data"]["markdown"])
+        self.assertEqual(extracted["data"]["vendor_info"], {
+            "vendor_code": None,
+            "vendor_name": document["vendor_fields"]["vendor_name"],
+            "grn_po_number": document["vendor_fields"]["grn_po_number"],
+        })
+
+        invoices = [{
+            "invoice_number": "INV-1001",
+            "invoice_date": "2025-03-04",
+            "line_items": [{"description": "Steel rebar 12mm", "quantity": 20, "unit_price": 250.0}],
+        }]
+        validated = processor.validate_invoice(extracted["data"]["markdown"], self.GRN, invoices, "single_grn")
+
+        payload = validated["data"]["validation_results"][0]["payload"]
+        self.assertEqual(validated["status"], "success")
+        self.assertEqual((payload["DocEntry"], payload["CardCode"], payload["NumAtCard"]), (77, "S1", "INV-1001"))
+        self.assertEqual(payload["DocumentLines"], [{"LineNum": 0, "RemainingOpenQuantity": 20.0}])
+        self.assertEqual(provider.calls, {"markdown": 1, "vendor_fields": 1, "validation": 1})
+
+    def test_latency_and_errors_are_simulated(self):
+        provider = FakeProvider(seed=1, error_rate=1)
+        provider.latency = {"default": {"distribution": "fixed", "ms": 30}}
+
+        started = time.monotonic()
+        with self.assertRaises(FakeLLMError):
+            provider.generate("gemini-2.5-flash", "# Invoice")
+        self.assertGreaterEqual(time.monotonic() - started, 0.03)
+
+
+MEDIA_DIR = tempfile.mkdtemp()
+
+
+@override_settings(MEDIA_ROOT=MEDIA_DIR)
+class QueuedUploadTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("clerk", email="clerk@example.com", password="x")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _upload(self):
+        pdf = SimpleUploadedFile("invoice.pdf", b"%PDF-1.4 test", content_type="application/pdf")
+        return self.client.post("/api/v1/automation/upload/one-to-one/", {"file": pdf}, format="multipart")
+
+    @mock.patch("grn_automation.views.process_grn_automation.delay")
+    def test_upload_is_queued_and_answered_with_202(self, delay):
+        resp = self._upload()
+
+        self.assertEqual(resp.status_code, 202)
+        automation = GRNAutomation.objects.get(id=resp.data["automation_id"])
+        delay.assert_called_once_with(automation.id)
+        self.assertEqual(automation.status, GRNAutomation.Status.PENDING)
+        self.assertEqual(resp.data["status_url"], f"/api/v1/automation/automation-details/{automation.id}/")
+        self.assertEqual(self.client.get(resp.data["status_url"]).data["status"], GRNAutomation.Status.PENDING)
+
+    @mock.patch("grn_automation.views.process_grn_automation.delay", side_effect=OSError("broker down"))
+    def test_unavailable_queue_fails_the_automation(self, delay):
+        resp = self._upload()
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(GRNAutomation.objects.get(id=resp.data["automation_id"]).status, GRNAutomation.Status.FAILED)
+
+    @mock.patch("grn_automation.views.process_grn_automation.delay")
+    def test_only_failed_automations_can_be_resumed(self, delay):
+        failed = GRNAutomation.objects.create(user=self.user, status=GRNAutomation.Status.FAILED)
+        completed = GRNAutomation.objects.create(user=self.user, status=GRNAutomation.Status.COMPLETED)
+
+        resp = self.client.post(f"/api/v1/automation/automation-details/{failed.id}/resume/")
+        conflict = self.client.post(f"/api/v1/automation/automation-details/{completed.id}/resume/")
+
+        self.assertEqual(resp.status_code, 202)
+        delay.assert_called_once_with(failed.id)
+        failed.refresh_from_db()
+        self.assertEqual(failed.status, GRNAutomation.Status.PENDING)
+        self.assertEqual(conflict.status_code, 409)
+
+    @mock.patch("grn_automation.views.process_grn_automation.delay")
+    def test_running_automation_without_heartbeat_can_be_resumed(self, delay):
+        stalled = GRNAutomation.objects.create(
+            user=self.user, status=GRNAutomation.Status.RUNNING, heartbeat_at=timezone.now() - timedelta(hours=2)
+        )
+        alive = GRNAutomation.objects.create(
+            user=self.user, status=GRNAutomation.Status.RUNNING, heartbeat_at=timezone.now()
+        )
+
+        resp = self.client.post(f"/api/v1/automation/automation-details/{stalled.id}/resume/")
+        conflict = self.client.post(f"/api/v1/automation/automation-details/{alive.id}/resume/")
+
+        self.assertEqual(resp.status_code, 202)
+        delay.assert_called_once_with(stalled.id)
+        self.assertEqual(conflict.status_code, 409)
+        alive.refresh_from_db()
+        self.assertEqual(alive.status, GRNAutomation.Status.RUNNING)
+
+
+class UnknownPostingTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("clerk", email="clerk@example.com", password="x")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.automation = GRNAutomation.objects.create(user=self.user, case_type=GRNAutomation.CaseType.ONE_TO_ONE)
+        self.result = ValidationResult.objects.create(
+            automation=self.automation,
+            invoice_date="2025-09-07",
+            validation_status=ValidationResult.ValidationStatus.SUCCESS,
+            card_code="S1",
+            doc_entry=20,
+            doc_date="2025-09-07",
+            bpl_id=3,
+            posting_status=ValidationResult.PostingStatus.UNKNOWN,
+            posting_message="SAP API request timed out",
+            num_at_card="INV-S1-1",
+        )
+        self.result.document_lines.create(line_num=0, remaining_open_quantity=5)
+
+    def _retry(self):
+        return self.client.post(f"/api/v1/automation/invoices/{self.result.id}/retry/", {"use_dummy": False}, format="json")
+
+    @mock.patch("grn_automation.utils.invoice.create_invoice")
+    @mock.patch("grn_automation.utils.invoice.SAPService.get", side_effect=requests.exceptions.ConnectionError("down"))
+    def test_retry_is_refused_while_sap_cannot_confirm(self, get, create_invoice):
+        resp = self._retry()
+
+        self.assertEqual(resp.status_code, 409)
+        create_invoice.assert_not_called()
+        self.result.refresh_from_db()
+        self.assertEqual(self.result.posting_status, ValidationResult.PostingStatus.UNKNOWN)
+
+    @mock.patch("grn_automation.utils.invoice.create_invoice")
+    @mock.patch("grn_automation.utils.invoice.SAPService.get")
+    def test_retry_of_an_invoice_found_in_sap_marks_it_posted(self, get, create_invoice):
+        get.return_value = sap_response({"value": [{"DocEntry": 77, "NumAtCard": "INV-S1-1"}]})
+
+        resp = self._retry()
+
+        self.assertEqual(resp.status_code, 200)
+        create_invoice.assert_not_called()
+        self.result.refresh_from_db()
+        self.assertEqual(self.result.posting_status, ValidationResult.PostingStatus.POSTED)
+        self.assertIn("DocEntry: 77", self.result.posting_message)
+
+    @mock.patch("grn_automation.utils.invoice.create_invoice")
+    @mock.patch("grn_automation.utils.invoice.SAPService.get", return_value=sap_response({"value": []}))
+    def test_retry_after_confirmed_miss_keeps_a_new_unknown_outcome(self, get, create_invoice):
+        create_invoice.return_value = {
+            "status": "unknown", "message": "SAP API request timed out", "data": {"NumAtCard": "INV-S1-2"},
+        }
+
+        resp = self._retry()
+
+        self.assertEqual(resp.status_code, 504)
+        create_invoice.assert_called_once()
+        self.result.refresh_from_db()
+        self.assertEqual(self.result.posting_status, ValidationResult.PostingStatus.UNKNOWN)
+        self.assertEqual(self.result.num_at_card, "INV-S1-2")
+
+    def test_unknown_invoice_cannot_be_edited(self):
+        resp = self.client.patch(
+            f"/api/v1/automation/invoices/{self.result.id}/update/",
+            {"document_lines": [{"id": self.result.document_lines.get().id, "remaining_open_quantity": 1}]},
+            format="json",
+        )
+
+        self.assertEqual(resp.status_code, 403)
+
+    def test_stats_count_unknown_postings(self):
+        request = APIRequestFactory().get("/")
+        force_authenticate(request, self.user)
+
+        resp = AutomationInvoiceStatsView.as_view()(request, automation_id=self.automation.id)
+
+        self.assertEqual(resp.data["statistics"]["posting_status"]["unknown"], 1)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_DIR)
+# Stage threads would not see the test transaction
+@mock.patch("grn_automation.utils.pipeline.PIPELINE_CONCURRENCY", 1)
+@mock.patch("grn_automation.utils.pipeline.GRN_STREAMING", False)
+@mock.patch("grn_automation.utils.pipeline.SAPService.ensure_session")
+class AutomationPipelineTests(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_user("clerk", email="clerk@example.com", password="x")
+        self.automation = GRNAutomation.objects.create(user=user, case_type=GRNAutomation.CaseType.ONE_TO_ONE)
+        self.automation.file.save("invoice.pdf", ContentFile(b"%PDF-1.4 test"))
+        self.extractor = mock.Mock()
+        self.extractor.extract_document.return_value = {
+            "status": "success",
+            "message": "ok",
+            "mode": "single_pass",
+            "elapsed_seconds": 1.2,
+            "data": {
+                "markdown": "# Invoice",
+                "vendor_info": {"vendor_name": "Gulf Steel", "vendor_code": "S1", "grn_po_number": ["4512"]},
+                "invoices": [],
+                "scenario_detected": "one_to_one",
+            },
+        }
+        self.extractor.validate_invoice.return_value = {
+            "status": "success",
+            "message": "valid",
+            "data": {"validation_results": [
+                {"invoice_date": "2025-09-07", "status": "SUCCESS", "payload": grn_payload("S1", 20)},
+            ]},
+        }
+
+    def _steps(self):
+        return dict(self.automation.steps.values_list("step_name", "status"))
+
+    @mock.patch("grn_automation.utils.pipeline.create_invoice", return_value={"status": "success", "data": {"DocEntry": 77}})
+    @mock.patch("grn_automation.utils.pipeline.matching_grns")
+    @mock.patch("grn_automation.utils.pipeline.get_open_grns")
+    def test_run_records_every_step_and_posts_the_invoice(self, get_open_grns, matching, create_invoice, login):
+        get_open_grns.return_value = {"status": "success", "source": "sap", "data": [grn_payload("S1", 20)]}
+        matching.return_value = {"status": "success", "data": [grn_payload("S1", 20)]}
+
+        result = run_automation(self.automation.id, extractor=self.extractor)
+
+        self.automation.refresh_from_db()
+        self.assertTrue(result["success"])
+        self.assertEqual(self.automation.status, GRNAutomation.Status.COMPLETED)
+        self.assertIsNotNone(self.automation.completed_at)
+        self.assertEqual(set(self._steps().values()), {AutomationStep.Status.SUCCESS})
+        self.assertIn(AutomationStep.Step.BOOKED, self._steps())
+        self.assertIsNotNone(self.automation.heartbeat_at)
+        posted = ValidationResult.objects.get(automation=self.automation)
+        self.assertEqual(posted.posting_status, ValidationResult.PostingStatus.POSTED)
+        self.assertIn("DocEntry: 77", posted.posting_message)
+        timings = self.automation.stage_timings
+        self.assertEqual(timings["critical_path"][-1], "book")
+        self.assertIn(timings["critical_path"][0], ("sap_login", "extract"))
+        self.assertEqual(set(timings["stages"]), {stage for stage, _, _ in STAGES})
+
+    def test_sap_login_failure_fails_the_automation(self, login):
+        login.side_effect = requests.exceptions.ConnectionError("VPN down")
+
+        result = run_automation(self.automation.id, extractor=self.extractor)
+
+        self.automation.refresh_from_db()
+        self.assertFalse(result["success"])
+        self.assertEqual(self.automation.status, GRNAutomation.Status.FAILED)
+        self.assertEqual(self._steps()[AutomationStep.Step.SAP_LOGIN], AutomationStep.Status.FAILED)
+        self.extractor.extract_document.assert_not_called()
+
+    def test_redelivered_task_does_not_run_twice(self, login):
+        self.automation.status = GRNAutomation.Status.RUNNING
+        self.automation.save(update_fields=["status"])
+
+        result = run_automation(self.automation.id, extractor=self.extractor)
+
+        self.assertFalse(result["success"])
+        login.assert_not_called()
+
+    @mock.patch("grn_automation.utils.pipeline.recheck_open_grns", return_value={"status": "success", "message": "open"})
+    @mock.patch("grn_automation.utils.pipeline.create_invoice")
+    @mock.patch("grn_automation.utils.pipeline.matching_grns")
+    @mock.patch("grn_automation.utils.pipeline.get_open_grns")
+    def test_resume_restarts_from_the_failed_step(self, get_open_grns, matching, create_invoice, recheck, login):
+        get_open_grns.return_value = {"status": "success", "source": "sap", "data": [grn_payload("S1", 20)]}
+        matching.return_value = {"status": "success", "data": [grn_payload("S1", 20)]}
+        create_invoice.side_effect = [
+            {"status": "error", "message": "SAP timeout"},
+            {"status": "success", "data": {"DocEntry": 77}},
+        ]
+
+        first = run_automation(self.automation.id, extractor=self.extractor)
+        self.assertFalse(first["success"])
+        self.assertEqual(self._steps()[AutomationStep.Step.BOOKED], AutomationStep.Status.FAILED)
+        recheck.assert_not_called()
+
+        GRNAutomation.objects.filter(id=self.automation.id).update(status=GRNAutomation.Status.PENDING)
+        result = run_automation(self.automation.id, extractor=self.extractor)
+
+        self.automation.refresh_from_db()
+        self.assertTrue(result["success"])
+        self.assertEqual(result["resumed_after"], ["extract", "fetch_open_grns", "filter_and_match", "validate"])
+        self.assertEqual(self.automation.status, GRNAutomation.Status.COMPLETED)
+        self.assertEqual(self._steps()[AutomationStep.Step.BOOKED], AutomationStep.Status.SUCCESS)
+        # No LLM call or GRN fetch is repeated; the restored GRNs are checked against SAP before posting
+        self.assertEqual(self.extractor.extract_document.call_count, 1)
+        self.assertEqual(self.extractor.validate_invoice.call_count, 1)
+        self.assertEqual(get_open_grns.call_count, 1)
+        recheck.assert_called_once_with([20])
+        posted = ValidationResult.objects.get(automation=self.automation)
+        self.assertEqual(posted.posting_status, ValidationResult.PostingStatus.POSTED)
+
+    @mock.patch("grn_automation.utils.pipeline.recheck_open_grns", return_value={"status": "success", "message": "open"})
+    @mock.patch("grn_automation.utils.pipeline.create_invoice")
+    @mock.patch("grn_automation.utils.pipeline.matching_grns")
+    @mock.patch("grn_automation.utils.pipeline.get_open_grns")
+    def test_invoice_of_unknown_outcome_is_not_posted_again(self, get_open_grns, matching, create_invoice, recheck, login):
+        get_open_grns.return_value = {"status": "success", "source": "sap", "data": [grn_payload("S1", 20)]}
+        matching.return_value = {"status": "success", "data": [grn_payload("S1", 20)]}
+        create_invoice.return_value = {
+            "status": "unknown",
+            "message": "SAP API request timed out. Check NumAtCard INV-S1-1 in SAP before posting it again",
+            "data": {"NumAtCard": "INV-S1-1"},
+        }
+
+        first = run_automation(self.automation.id, extractor=self.extractor)
+        self.assertFalse(first["success"])
+        result = ValidationResult.objects.get(automation=self.automation)
+        self.assertEqual(result.posting_status, ValidationResult.PostingStatus.UNKNOWN)
+
+        GRNAutomation.objects.filter(id=self.automation.id).update(status=GRNAutomation.Status.PENDING)
+        second = run_automation(self.automation.id, extractor=self.extractor)
+
+        self.assertFalse(second["success"])
+        self.assertIn("INV-S1-1", second["message"])
+        create_invoice.assert_called_once()
+
+    @mock.patch("grn_automation.utils.pipeline.recheck_open_grns", return_value={"status": "success", "message": "open"})
+    @mock.patch("grn_automation.utils.pipeline.create_invoice", return_value={"status": "success", "data": {"DocEntry": 78}})
+    @mock.patch("grn_automation.utils.pipeline.create_invoices")
+    @mock.patch("grn_automation.utils.pipeline.matching_grns")
+    @mock.patch("grn_automation.utils.pipeline.open_grn_stream")
+    def test_resume_never_posts_an_invoice_twice(self, open_grn_stream, matching, create_invoices, create_invoice, recheck, login):
+        # A streamed fetch keeps no checkpoint, so the resume validates again
+        open_grn_stream.side_effect = lambda *args, **kwargs: {
+            "status": "success", "source": "sap", "already_posted": False,
+            "data": GRNStream(iter([grn_payload("S1", 20), grn_payload("S1", 21)])),
+        }
+        matching.side_effect = lambda vendor_code, doc_nums, grns: {"status": "success", "data": list(grns)}
+        self.extractor.validate_invoice.return_value = {
+            "status": "success",
+            "message": "valid",
+            "data": {"validation_results": [
+                {"invoice_date": "2025-09-07", "status": "SUCCESS", "payload": grn_payload("S1", 20)},
+                {"invoice_date": "2025-09-08", "status": "SUCCESS", "payload": grn_payload("S1", 21)},
+            ]},
+        }
+        create_invoices.return_value = [
+            {"status": "success", "data": {"DocEntry": 77}},
+            {"status": "failed", "message": "SAP timeout"},
+        ]
+
+        with mock.patch("grn_automation.utils.pipeline.GRN_STREAMING", True):
+            first = run_automation(self.automation.id, extractor=self.extractor)
+            self.assertFalse(first["success"])
+            GRNAutomation.objects.filter(id=self.automation.id).update(status=GRNAutomation.Status.PENDING)
+            result = run_automation(self.automation.id, extractor=self.extractor)
+
+        self.assertTrue(result["success"])
+        self.assertEqual(self.extractor.validate_invoice.call_count, 2)
+        create_invoices.assert_called_once()
+        create_invoice.assert_called_once()
+        self.assertEqual(create_invoice.call_args.args[0]["DocEntry"], 21)
+        results = ValidationResult.objects.filter(automation=self.automation).order_by("invoice_date")
+        self.assertEqual(
+            [(r.invoice_date.isoformat(), r.posting_status) for r in results],
+            [("2025-09-07", ValidationResult.PostingStatus.POSTED), ("2025-09-08", ValidationResult.PostingStatus.POSTED)],
+        )
+        self.assertIn("DocEntry: 77", results[0].posting_message)
+
+    @mock.patch("grn_automation.utils.pipeline.get_open_grns", return_value={"status": "error", "message": "SAP down"})
+    def test_resume_after_a_failed_fetch_skips_extraction(self, get_open_grns, login):
+        run_automation(self.automation.id, extractor=self.extractor)
+        GRNAutomation.objects.filter(id=self.automation.id).update(status=GRNAutomation.Status.PENDING)
+
+        run_automation(self.automation.id, extractor=self.extractor)
+
+        self.assertEqual(self.extractor.extract_document.call_count, 1)
+        self.assertEqual(get_open_grns.call_count, 2)
+        self.assertEqual(self._steps()[AutomationStep.Step.FETCH_OPEN_GRN], AutomationStep.Status.FAILED)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_DIR)
+@mock.patch("grn_automation.utils.pipeline.PIPELINE_CONCURRENCY", 3)
+@mock.patch("grn_automation.utils.pipeline.GRN_STREAMING", False)
+@mock.patch("grn_automation.utils.pipeline.SAPService.ensure_session", side_effect=lambda: time.sleep(0.3))
+class ConcurrentPipelineTests(TransactionTestCase):
+    """Stages on their own threads, against the same SQLite database as the run."""
+
+    def setUp(self):
+        user = get_user_model().objects.create_user("clerk", email="clerk@example.com", password="x")
+        self.automation = GRNAutomation.objects.create(user=user, case_type=GRNAutomation.CaseType.ONE_TO_ONE)
+        self.automation.file.save("invoice.pdf", ContentFile(b"%PDF-1.4 test"))
+        self.extractor = mock.Mock()
+
+        def extract_document(*args, **kwargs):
+            time.sleep(0.3)
+            return {
+                "status": "success",
+                "message": "ok",
+                "mode": "single_pass",
+                "elapsed_seconds": 0.3,
+                "data": {
+                    "markdown": "# Invoice",
+                    "vendor_info": {"vendor_name": "Gulf Steel", "vendor_code": "S1", "grn_po_number": ["4512"]},
+                    "invoices": [],
+                    "scenario_detected": "one_to_one",
+                },
+            }
+
+        self.extractor.extract_document.side_effect = extract_document
+        self.extractor.validate_invoice.return_value = {
+            "status": "success",
+            "message": "valid",
+            "data": {"validation_results": [
+                {"invoice_date": "2025-09-07", "status": "SUCCESS", "payload": grn_payload("S1", 20)},
+            ]},
+        }
+
+    @mock.patch("grn_automation.utils.pipeline.create_invoice", return_value={"status": "success", "data": {"DocEntry": 77}})
+    @mock.patch("grn_automation.utils.pipeline.matching_grns")
+    @mock.patch("grn_automation.utils.pipeline.get_open_grns")
+    def test_login_and_extraction_overlap_on_sqlite(self, get_open_grns, matching, create_invoice, login):
+        get_open_grns.return_value = {"status": "success", "source": "sap", "data": [grn_payload("S1", 20)]}
+        matching.return_value = {"status": "success", "data": [grn_payload("S1", 20)]}
+
+        result = run_automation(self.automation.id, extractor=self.extractor)
+
+        self.assertTrue(result["success"], result)
+        self.automation.refresh_from_db()
+        self.assertEqual(self.automation.status, GRNAutomation.Status.COMPLETED)
+        self.assertEqual(set(self.automation.steps.values_list("status", flat=True)), {AutomationStep.Status.SUCCESS})
+        stages = self.automation.stage_timings["stages"]
+        login_ended = stages["sap_login"]["started"] + stages["sap_login"]["seconds"]
+        self.assertLess(stages["extract"]["started"], login_ended)
+
+
+class StageGraphTests(SimpleTestCase):
+    GRAPH = {"login": (), "extract": (), "fetch": ("login", "extract"), "validate": ("fetch",), "recheck": ("fetch",), "book": ("validate", "recheck")}
+    DURATIONS = {"login": 0.05, "extract": 0.2, "fetch": 0.05, "validate": 0.2, "recheck": 0.05, "book": 0.02}
+
+    def _run(self, stage):
+        with self.lock:
+            self.started.append(stage)
+        time.sleep(self.DURATIONS[stage])
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.started = []
+
+    def test_independent_stages_overlap(self):
+        timings = run_stage_graph(self.GRAPH, self._run, max_workers=3)
+
+        wall = max(ended for _, ended in timings.values())
+        self.assertLess(timings["login"][0], timings["extract"][1])
+        self.assertLess(timings["recheck"][0], timings["validate"][1])
+        self.assertLess(wall, sum(self.DURATIONS.values()) - 0.05)
+        for stage, dependencies in self.GRAPH.items():
+            for dependency in dependencies:
+                self.assertGreaterEqual(timings[stage][0], timings[dependency][1])
+
+    def test_critical_path_is_the_longest_chain(self):
+        timings = run_stage_graph(self.GRAPH, self._run, max_workers=3)
+
+        path, seconds = critical_path(self.GRAPH, timings)
+
+        self.assertEqual(path, ["extract", "fetch", "validate", "book"])
+        self.assertGreaterEqual(seconds, 0.47)
+
+    def test_failure_lets_running_stages_finish_and_starts_nothing_new(self):
+        def run(stage):
+            if stage == "login":
+                raise RuntimeError("SAP down")
+            self._run(stage)
+
+        with self.assertRaises(RuntimeError) as raised:
+            run_stage_graph(self.GRAPH, run, max_workers=3)
+
+        self.assertEqual(set(raised.exception.stage_timings), {"login", "extract"})
+        self.assertEqual(sorted(self.started), ["extract"])
+
+    def test_done_stages_are_not_run(self):
+        run_stage_graph(self.GRAPH, self._run, done=("login", "extract", "fetch"), max_workers=1)
+
+        self.assertEqual(self.started, ["validate", "recheck", "book"])
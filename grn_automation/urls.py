@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import UserAutomationListView,  UserAutomationDetailView, OneToOneAutomationUploadView, OneToManyAutomationUploadView, ManyToManyAutomationUploadView, CreateInvoiceView, BranchListView, VendorGRNView, VendorFilterOpenGRNView, VendorGRNMatchView
+from .views import UserAutomationListView,  UserAutomationDetailView, AutomationResumeView, OneToOneAutomationUploadView, OneToManyAutomationUploadView, ManyToManyAutomationUploadView, CreateInvoiceView, BranchListView, VendorGRNView, VendorFilterOpenGRNView, VendorGRNMatchView
 from .views import TotalStatsView, CaseTypeStatsView
 
 from django.urls import path
@@ -15,6 +15,7 @@ urlpatterns = [
 
     path("automation-details/", UserAutomationListView.as_view(), name="user-automations"),
     path("automation-details/<int:pk>/", UserAutomationDetailView.as_view(), name="user-automation-detail"),
+    path("automation-details/<int:pk>/resume/", AutomationResumeView.as_view(), name="user-automation-resume"),
 
     path("branches/", BranchListView.as_view(), name="branch-list"),
     path("vendor-grns/", VendorGRNView.as_view(), name="vendor-grns"),
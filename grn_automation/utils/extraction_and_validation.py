@@ -1,20 +1,39 @@
 import json
 import os
-from openai import OpenAI
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pydantic import BaseModel, Field
 from typing import Optional, List, Dict, Any
+import logging
 from enum import Enum
 from dotenv import load_dotenv
+from django.db import connection
+from . import prompt as prompt_module
 from .prompt import SYSTEM_PROMPT_FOR_EXTRACT_VENDOR_FIELDS,SINGLE_GRN_VALIDATION_PROMPT,MULTIPLE_GRN_VALIDATION_PROMPT  
-from dotenv import load_dotenv
-from google import genai
+from .extraction_cache import content_key, get_cached, set_cached, text_version
+from .prompt_builder import build_validation_context, count_tokens
+from .pdf_text import PDF_TEXT_FAST_PATH, extract_pdf_text
+from .llm_providers import HostedProvider, LLMProvider, get_provider
+from ..models import ExtractionCache
 
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 
-api_key = os.getenv('GEMINI_API_KEY')
-client = genai.Client(api_key=api_key)
+MARKDOWN_MODEL = "gemini-2.5-flash"
+MARKDOWN_PROMPT = (
+    "Extract all text and data from this PDF document into clean markdown format. "
+    "Preserve the complete structure, tables, headers, and all content exactly as it appears. "
+    "Do not summarize, omit, or modify any information. "
+    "Convert tables to markdown table format when possible. "
+    "Maintain the original layout and hierarchy of information. "
+    "Pay special attention to preserving ALL GRN numbers, invoice numbers, dates, and reference numbers."
+)
+# Changing the prompt text changes the version and so the cache key
+MARKDOWN_PROMPT_VERSION = text_version(MARKDOWN_PROMPT)
 
 
 # Pydantic Models
@@ -73,23 +92,59 @@ class VendorInfoWithScenario(BaseModel):
     invoices: Optional[List[InvoiceWithLines]] = None
 
 
+class DocumentExtraction(VendorInfoWithScenario):
+    """Single-pass extraction: vendor fields plus the markdown used for validation"""
+    markdown: str = Field(description="Complete document content as clean markdown")
+
+
+VALIDATION_MODEL = "gpt-5"
+# Max invoices of one automation validated at the same time
+VALIDATION_CONCURRENCY = int(os.getenv("VALIDATION_CONCURRENCY", "4"))
+
+VENDOR_FIELDS_MODEL = "gemini-2.5-flash"
+VENDOR_FIELDS_CONTENT_PREFIX = "Analyze this document for scenario detection, extract vendor fields, and map invoice dates to line items:\n\n"
+# Any edit to prompt.py or to the response schema yields new cache keys
+with open(prompt_module.__file__, "rb") as prompt_file:
+    PROMPT_MODULE_VERSION = content_key(prompt_file.read())[:12]
+VENDOR_FIELDS_SCHEMA_VERSION = text_version(
+    json.dumps(VendorInfoWithScenario.model_json_schema(), sort_keys=True)
+)
+
+# "two_pass": PDF -> markdown, then markdown -> vendor fields (two LLM calls).
+# "single_pass": the PDF is sent once and both come back in one response.
+EXTRACTION_MODES = ("two_pass", "single_pass")
+EXTRACTION_MODE = os.getenv("EXTRACTION_MODE", "two_pass")
+SINGLE_PASS_MODEL = "gemini-2.5-flash"
+SINGLE_PASS_PROMPT = (
+    "Analyze this PDF document for scenario detection, extract vendor fields, and map invoice dates "
+    "to line items. In the same response, fill `markdown` with the complete document: "
+    + MARKDOWN_PROMPT
+)
+DOCUMENT_SCHEMA_VERSION = text_version(
+    json.dumps(DocumentExtraction.model_json_schema(), sort_keys=True)
+)
+
+
 class InvoiceProcessor:
     """
     Invoice Processing Methods for Backend Integration
     Provides three core methods: markdown extraction, vendor field extraction, and validation
     """
     
-    def __init__(self, api_key: str = None):
+    def __init__(self, api_key: str = None, provider: Optional[LLMProvider] = None):
         """
-        Initialize processor with OpenAI API key
+        Initialize processor with an LLM provider
         
         Args:
-            api_key: OpenAI API key (uses env var if not provided)
+            api_key: OpenAI API key for a dedicated, unpooled provider (optional)
+            provider: LLM provider to use (defaults to the shared get_provider())
         """
-        if api_key:
-            self.client = OpenAI(api_key=api_key)
+        if provider is not None:
+            self.provider = provider
+        elif api_key:
+            self.provider = HostedProvider(openai_api_key=api_key)
         else:
-            self.client = OpenAI()
+            self.provider = get_provider()
     
     # ============================================================================
     # METHOD 1: EXTRACT COMPLETE MARKDOWN
@@ -99,6 +154,10 @@ class InvoiceProcessor:
         """
         Extract complete data from PDF in markdown format using Gemini API
         
+        Digitally generated PDFs are read from their text layer locally first;
+        Gemini is only called when that text scores below PDF_TEXT_MIN_SCORE
+        (scanned pages, missing GRN numbers or dates, broken encodings).
+        
         Args:
             pdf_path: Path to the PDF file
             
@@ -118,40 +177,36 @@ class InvoiceProcessor:
             }
         
         try:
-            from google import genai
-            from google.genai import types
             import pathlib
             
-            # Initialize Gemini client
-            api_key = os.getenv('GEMINI_API_KEY')
-            gemini_client = genai.Client(api_key=api_key) 
-            
             # Read PDF file
             filepath = pathlib.Path(pdf_path)
+            pdf_bytes = filepath.read_bytes()
             
-            # Prepare prompt
-            prompt = (
-                "Extract all text and data from this PDF document into clean markdown format. "
-                "Preserve the complete structure, tables, headers, and all content exactly as it appears. "
-                "Do not summarize, omit, or modify any information. "
-                "Convert tables to markdown table format when possible. "
-                "Maintain the original layout and hierarchy of information. "
-                "Pay special attention to preserving ALL GRN numbers, invoice numbers, dates, and reference numbers."
-            )
+            # Same PDF + model + prompt version -> same markdown; skip the LLM call
+            cache_key = content_key(pdf_bytes, MARKDOWN_MODEL, MARKDOWN_PROMPT_VERSION)
+            cached_markdown = get_cached(ExtractionCache.Kind.MARKDOWN, cache_key)
+            if cached_markdown:
+                return {
+                    "status": "success",
+                    "message": "PDF markdown served from extraction cache",
+                    "data": cached_markdown
+                }
             
-            # Generate content using Gemini
-            response = gemini_client.models.generate_content(
-                model="gemini-2.5-flash",
-                contents=[
-                    types.Part.from_bytes(
-                        data=filepath.read_bytes(),
-                        mime_type='application/pdf',
-                    ),
-                    prompt
-                ]
-            )
+            if PDF_TEXT_FAST_PATH:
+                local_result = extract_pdf_text(pdf_bytes)
+                logger.info(f"{local_result['message']} Checks: {local_result['checks']}")
+                if local_result["status"] == "success":
+                    return {
+                        "status": "success",
+                        "message": local_result["message"],
+                        "data": local_result["data"]
+                    }
             
-            markdown_text = response.text
+            # Generate content using Gemini
+            markdown_text = self.provider.generate(MARKDOWN_MODEL, MARKDOWN_PROMPT, pdf_bytes=pdf_bytes)
+            if markdown_text:
+                set_cached(ExtractionCache.Kind.MARKDOWN, cache_key, markdown_text)
             
             return {
                 "status": "success",
@@ -197,72 +252,211 @@ class InvoiceProcessor:
             }
         
         try:
-            from google import genai
-            from google.genai import types
-            
-            # Initialize Gemini client
-            gemini_client = genai.Client()
-            
-            # Prepare content
-            content = f"Analyze this document for scenario detection, extract vendor fields, and map invoice dates to line items:\n\n{markdown_text}"
+            # Same markdown + prompt + schema -> same fields; skip the LLM call
+            cache_key = content_key(
+                markdown_text,
+                VENDOR_FIELDS_MODEL,
+                VENDOR_FIELDS_CONTENT_PREFIX,
+                SYSTEM_PROMPT_FOR_EXTRACT_VENDOR_FIELDS,
+                PROMPT_MODULE_VERSION,
+                VENDOR_FIELDS_SCHEMA_VERSION,
+            )
+            result_dict = get_cached(ExtractionCache.Kind.VENDOR_FIELDS, cache_key)
             
-            # Generate content with structured output using Pydantic schema
-            response = gemini_client.models.generate_content(
-                model="gemini-2.5-flash",
-                contents=content,
-                config=types.GenerateContentConfig(
+            if result_dict is None:
+                # Prepare content
+                content = f"{VENDOR_FIELDS_CONTENT_PREFIX}{markdown_text}"
+                
+                # Generate content with structured output using Pydantic schema
+                response_text = self.provider.generate(
+                    VENDOR_FIELDS_MODEL,
+                    content,
                     system_instruction=SYSTEM_PROMPT_FOR_EXTRACT_VENDOR_FIELDS,
-                    response_mime_type="application/json",
                     response_schema=VendorInfoWithScenario  # Use Pydantic model directly
                 )
-            )
+                
+                # Parse the JSON response and convert to Pydantic model
+                result_dict = json.loads(response_text)
+                vendor_info_obj = VendorInfoWithScenario(**result_dict)
+                # Only responses that parse against the schema are cached
+                set_cached(ExtractionCache.Kind.VENDOR_FIELDS, cache_key, vendor_info_obj.model_dump())
+            else:
+                vendor_info_obj = VendorInfoWithScenario(**result_dict)
+            
+            return self._vendor_fields_result(vendor_info_obj)
+            
+        except Exception as e:
+            return {
+                "status": "error",
+                "message": f"Failed to extract vendor fields: {str(e)}",
+                "data": None
+            }
+    
+    def _vendor_fields_result(self, vendor_info_obj: VendorInfoWithScenario) -> Dict[str, Any]:
+        """
+        Settle the scenario from the extracted GRN numbers and build the
+        extract_vendor_fields() response (internal method)
+        """
+        grn_count = len(vendor_info_obj.grn_po_number) if vendor_info_obj.grn_po_number else 0
+        invoice_count = len(vendor_info_obj.invoices) if vendor_info_obj.invoices else 0
+        
+        if grn_count == 0:
+            final_scenario = "no_grns_found"
+            message = "No GRN numbers found in document"
+            status = "error"
+        elif grn_count == 1:
+            final_scenario = "single_grn"
+            message = f"Single GRN with {invoice_count} invoice(s)"
+            status = "success"
+        elif grn_count > 1:
+            final_scenario = "multiple_grns"
+            message = f"Multiple GRNs ({grn_count}) with {invoice_count} invoice(s)"
+            status = "success"
+        else:
+            final_scenario = vendor_info_obj.scenario_detected
+            message = "Document processed successfully"
+            status = "success"
+        
+        return {
+            "status": status,
+            "message": message,
+            "data": {
+                "vendor_info": {
+                    "vendor_code": vendor_info_obj.vendor_code,
+                    "vendor_name": vendor_info_obj.vendor_name,
+                    "grn_po_number": vendor_info_obj.grn_po_number
+                },
+                "scenario_detected": final_scenario,
+                "invoices": [inv.dict() for inv in vendor_info_obj.invoices] if vendor_info_obj.invoices else []
+            }
+        }
+    
+    # ============================================================================
+    # METHOD 2b: SINGLE-PASS EXTRACTION
+    # ============================================================================
+    
+    def extract_document(self, pdf_path: str, mode: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Markdown and vendor fields for a PDF in the configured EXTRACTION_MODE
+        
+        Args:
+            pdf_path: Path to the PDF file
+            mode: "two_pass" or "single_pass" (defaults to EXTRACTION_MODE)
+            
+        Returns:
+            {
+                "status": "success" | "error",
+                "message": "Description of result",
+                "data": {"markdown": ..., "vendor_info": {...}, "scenario_detected": ..., "invoices": [...]} | None,
+                "mode": mode used,
+                "elapsed_seconds": wall time of the extraction
+            }
+        """
+        mode = mode or EXTRACTION_MODE
+        if mode not in EXTRACTION_MODES:
+            return {
+                "status": "error",
+                "message": f"Unknown extraction mode '{mode}'. Expected one of: {', '.join(EXTRACTION_MODES)}",
+                "data": None,
+                "mode": mode,
+                "elapsed_seconds": 0.0
+            }
+        
+        started = time.monotonic()
+        if mode == "single_pass":
+            result = self._extract_single_pass(pdf_path)
+        else:
+            result = self._extract_two_pass(pdf_path)
+        
+        result["mode"] = mode
+        result["elapsed_seconds"] = round(time.monotonic() - started, 3)
+        logger.info(f"Extraction ({mode}) took {result['elapsed_seconds']}s: {result['message']}")
+        return result
+    
+    def _extract_two_pass(self, pdf_path: str) -> Dict[str, Any]:
+        """PDF -> markdown, then markdown -> vendor fields (internal method)"""
+        markdown_resp = self.extract_complete_markdown(pdf_path)
+        if markdown_resp["status"] != "success" or not markdown_resp["data"]:
+            return {
+                "status": "error",
+                "message": f"Markdown extraction failed: {markdown_resp['message']}",
+                "data": None
+            }
+        
+        field_resp = self.extract_vendor_fields(markdown_resp["data"])
+        if field_resp["status"] != "success" or not field_resp["data"]:
+            return {
+                "status": "error",
+                "message": f"Vendor field extraction failed: {field_resp['message']}",
+                "data": None
+            }
+        
+        return {
+            "status": "success",
+            "message": field_resp["message"],
+            "data": {"markdown": markdown_resp["data"], **field_resp["data"]}
+        }
+    
+    def _extract_single_pass(self, pdf_path: str) -> Dict[str, Any]:
+        """One multimodal call returning vendor fields and markdown together (internal method)"""
+        if not os.path.exists(pdf_path):
+            return {
+                "status": "error",
+                "message": f"PDF file not found: {pdf_path}",
+                "data": None
+            }
+        
+        try:
+            import pathlib
             
-            # Parse the JSON response and convert to Pydantic model
-            result_dict = json.loads(response.text)
-            vendor_info_obj = VendorInfoWithScenario(**result_dict)
+            pdf_bytes = pathlib.Path(pdf_path).read_bytes()
             
-            # Validate and process the result
-            grn_count = len(vendor_info_obj.grn_po_number) if vendor_info_obj.grn_po_number else 0
-            invoice_count = len(vendor_info_obj.invoices) if vendor_info_obj.invoices else 0
+            cache_key = content_key(
+                pdf_bytes,
+                SINGLE_PASS_MODEL,
+                SINGLE_PASS_PROMPT,
+                SYSTEM_PROMPT_FOR_EXTRACT_VENDOR_FIELDS,
+                PROMPT_MODULE_VERSION,
+                DOCUMENT_SCHEMA_VERSION,
+            )
+            result_dict = get_cached(ExtractionCache.Kind.DOCUMENT, cache_key)
             
-            if grn_count == 0:
-                final_scenario = "no_grns_found"
-                message = "No GRN numbers found in document"
-                status = "error"
-            elif grn_count == 1:
-                final_scenario = "single_grn"
-                message = f"Single GRN with {invoice_count} invoice(s)"
-                status = "success"
-            elif grn_count > 1:
-                final_scenario = "multiple_grns"
-                message = f"Multiple GRNs ({grn_count}) with {invoice_count} invoice(s)"
-                status = "success"
+            if result_dict is None:
+                response_text = self.provider.generate(
+                    SINGLE_PASS_MODEL,
+                    SINGLE_PASS_PROMPT,
+                    pdf_bytes=pdf_bytes,
+                    system_instruction=SYSTEM_PROMPT_FOR_EXTRACT_VENDOR_FIELDS,
+                    response_schema=DocumentExtraction
+                )
+                document = DocumentExtraction(**json.loads(response_text))
+                set_cached(ExtractionCache.Kind.DOCUMENT, cache_key, document.model_dump())
             else:
-                final_scenario = vendor_info_obj.scenario_detected
-                message = "Document processed successfully"
-                status = "success"
+                document = DocumentExtraction(**result_dict)
             
-            return {
-                "status": status,
-                "message": message,
-                "data": {
-                    "vendor_info": {
-                        "vendor_code": vendor_info_obj.vendor_code,
-                        "vendor_name": vendor_info_obj.vendor_name,
-                        "grn_po_number": vendor_info_obj.grn_po_number
-                    },
-                    "scenario_detected": final_scenario,
-                    "invoices": [inv.dict() for inv in vendor_info_obj.invoices] if vendor_info_obj.invoices else []
+            if not document.markdown:
+                return {
+                    "status": "error",
+                    "message": "Single-pass extraction returned no markdown",
+                    "data": None
                 }
-            }
+            
+            result = self._vendor_fields_result(document)
+            if result["status"] != "success":
+                result["message"] = f"Vendor field extraction failed: {result['message']}"
+                result["data"] = None
+                return result
+            
+            result["data"] = {"markdown": document.markdown, **result["data"]}
+            return result
             
         except Exception as e:
             return {
                 "status": "error",
-                "message": f"Failed to extract vendor fields: {str(e)}",
+                "message": f"Single-pass extraction failed: {str(e)}",
                 "data": None
             }
-    
+
     # ============================================================================
     # METHOD 3: VALIDATE INVOICE
     # ============================================================================
@@ -334,7 +528,9 @@ class InvoiceProcessor:
                 "status": overall_status,
                 "message": combined_message,  # Now contains only AI reasoning
                 "data": {
-                    "validation_results": cleaned_results
+                    "validation_results": cleaned_results,
+                    # Input tokens per validation call, full context vs. what was sent
+                    "token_reports": [result.get('token_report') for result in validation_results]
                 }
             }
             
@@ -357,13 +553,12 @@ class InvoiceProcessor:
     ) -> List[Dict[str, Any]]:
         """Validate invoices against single GRN (internal method)"""
         
-        validation_results = []
-        
-        for invoice in invoices:
+        def build_content(invoice):
             invoice_number = invoice.get('invoice_number', 'N/A')
             invoice_date = invoice.get('invoice_date', 'N/A')
+            markdown_context, grn_context, report = build_validation_context(markdown_text, grn_data, invoice)
             
-            user_content = f"""
+            return f"""
             Validate this specific invoice against the GRN data.
 
             ## INVOICE DATA:
@@ -371,13 +566,11 @@ class InvoiceProcessor:
             Invoice Date: {invoice_date}
             Line Items: {json.dumps(invoice['line_items'], indent=2)}
 
-            ## COMPLETE MARKDOWN (for context):
-            {markdown_text}
+            ## DOCUMENT MARKDOWN (sections relevant to this invoice):
+            {markdown_context}
 
-            ## GRN DATA FROM SAP:
-```json
-            {json.dumps(grn_data, indent=2)}
-```
+            ## GRN DATA FROM SAP (GRN header line, then its lines as a | table):
+            {grn_context}
 
             ## VALIDATION REQUEST (SINGLE GRN):
             1. Validate invoice line items against GRN DocumentLines
@@ -390,14 +583,9 @@ class InvoiceProcessor:
                - NumAtCard = {invoice_number} (use exactly as provided)
                - BPL_IDAssignedToInvoice from GRN
                - DocumentLines with LineNum and RemainingOpenQuantity (invoice qty)
-            """
-            
-            result = self._execute_validation(user_content, "SINGLE_GRN_VALIDATION_PROMPT")
-            result["invoice_number"] = invoice_number
-            result["invoice_date"] = invoice_date
-            validation_results.append(result)
+            """, report
         
-        return validation_results
+        return self._validate_invoices(invoices, build_content, "SINGLE_GRN_VALIDATION_PROMPT")
     
     def _validate_multiple_grns(
         self,
@@ -407,13 +595,12 @@ class InvoiceProcessor:
     ) -> List[Dict[str, Any]]:
         """Validate invoice against multiple GRNs (internal method)"""
         
-        validation_results = []
-        
-        for invoice in invoices:
+        def build_content(invoice):
             invoice_number = invoice.get('invoice_number', 'N/A')
             invoice_date = invoice.get('invoice_date', 'N/A')
+            markdown_context, grn_context, report = build_validation_context(markdown_text, grn_data_list, invoice)
             
-            user_content = f"""
+            return f"""
             Validate this invoice against MULTIPLE GRNs.
 
             ## INVOICE DATA:
@@ -421,13 +608,11 @@ class InvoiceProcessor:
             Invoice Date: {invoice_date}
             Line Items: {json.dumps(invoice['line_items'], indent=2)}
 
-            ## COMPLETE MARKDOWN (for context):
-            {markdown_text}
+            ## DOCUMENT MARKDOWN (sections relevant to this invoice):
+            {markdown_context}
 
-            ## MULTIPLE GRN DATA FROM SAP:
-```json
-            {json.dumps(grn_data_list, indent=2)}
-```
+            ## MULTIPLE GRN DATA FROM SAP (GRN header line, then its lines as a | table):
+            {grn_context}
 
             ## VALIDATION REQUEST (MULTIPLE GRNs):
             1. Match invoice line items to appropriate GRN DocumentLines across ALL GRNs
@@ -435,14 +620,54 @@ class InvoiceProcessor:
             3. Aggregate validation across multiple GRNs
             4. If successful, construct SAP payload(s) with proper mapping
             5. IMPORTANT: Include NumAtCard = {invoice_number} (use exactly as provided) in the payload
-            """
-            
-            result = self._execute_validation(user_content, "MULTIPLE_GRN_VALIDATION_PROMPT")
-            result["invoice_number"] = invoice_number
-            result["invoice_date"] = invoice_date
-            validation_results.append(result)
+            """, report
         
-        return validation_results
+        return self._validate_invoices(invoices, build_content, "MULTIPLE_GRN_VALIDATION_PROMPT")
+    
+    def _validate_invoices(
+        self,
+        invoices: List[Dict[str, Any]],
+        build_content,
+        prompt_type: str
+    ) -> List[Dict[str, Any]]:
+        """
+        Validate each invoice with its own LLM call, up to VALIDATION_CONCURRENCY at once
+        (internal method). Results are in the order of `invoices`; a failure only
+        affects its own invoice. `build_content(invoice)` returns (prompt, token report).
+        """
+        
+        caller = threading.current_thread()
+        
+        def validate(invoice):
+            report = None
+            try:
+                user_content, report = build_content(invoice)
+                report["prompt_tokens"] = count_tokens(user_content)
+                logger.info(f"Validation prompt tokens: {report}")
+                result = self._execute_validation(user_content, prompt_type)
+            except Exception as e:
+                result = {
+                    "invoice_number": None,
+                    "status": "FAILED",
+                    "reasoning": f"Validation error: {str(e)}",
+                    "payload": None
+                }
+            finally:
+                if threading.current_thread() is not caller:
+                    # The rate limiter reads the DB from pool threads; do not leak their connections
+                    connection.close()
+            result["invoice_number"] = invoice.get('invoice_number', 'N/A')
+            result["invoice_date"] = invoice.get('invoice_date', 'N/A')
+            result["token_report"] = report
+            return result
+        
+        workers = min(VALIDATION_CONCURRENCY, len(invoices))
+        if workers <= 1:
+            return [validate(invoice) for invoice in invoices]
+        
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="invoice-validation") as executor:
+            # map() yields in input order, whichever call finishes first
+            return list(executor.map(validate, invoices))
     
     def _execute_validation(self, user_content: str, prompt_type: str) -> Dict[str, Any]:
         """Execute validation API call (internal method)"""
@@ -451,17 +676,13 @@ class InvoiceProcessor:
             # Backend should load the appropriate validation prompt
             system_prompt = prompt_type  # Placeholder
             
-            response = self.client.responses.parse(
-                model="gpt-5",
-                input=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_content}
-                ],
-                text_format=ValidationResult
+            validation_result = self.provider.parse(
+                VALIDATION_MODEL,
+                system_prompt,
+                user_content,
+                ValidationResult
             )
             
-            validation_result = response.output_parsed
-            
             return {
                 "invoice_number": validation_result.invoice_number,
                 "status": validation_result.status,
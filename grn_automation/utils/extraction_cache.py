@@ -0,0 +1,92 @@
+import os
+import hashlib
+import logging
+from datetime import timedelta
+from django.db.models import F
+from django.utils import timezone
+from ..models import ExtractionCache
+
+
+logger = logging.getLogger(__name__)
+
+
+# LLM extraction results are deterministic enough per (input, model, prompt)
+# to reuse; entries expire after the TTL and the least recently used ones are
+# evicted beyond the per-kind limit.
+EXTRACTION_CACHE_ENABLED = os.getenv("EXTRACTION_CACHE_ENABLED", "true").lower() == "true"
+EXTRACTION_CACHE_TTL_SECONDS = int(os.getenv("EXTRACTION_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+EXTRACTION_CACHE_MAX_ENTRIES = int(os.getenv("EXTRACTION_CACHE_MAX_ENTRIES", "5000"))
+
+
+def content_key(*parts):
+    """SHA-256 over `parts` (str or bytes); each part is length-prefixed so boundaries matter."""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def text_version(text):
+    """Short stable version id for a prompt or schema text."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+
+
+def get_cached(kind, key):
+    """Return the cached value or None. Never raises; a broken cache is a miss."""
+    if not EXTRACTION_CACHE_ENABLED:
+        return None
+    try:
+        entry = ExtractionCache.objects.filter(kind=kind, key=key).first()
+        if entry is None:
+            return None
+        now = timezone.now()
+        if entry.expires_at and entry.expires_at <= now:
+            entry.delete()
+            return None
+        ExtractionCache.objects.filter(pk=entry.pk).update(hits=F("hits") + 1, last_used_at=now)
+        return entry.value
+    except Exception as e:
+        logger.warning(f"Extraction cache read failed ({kind}): {e}")
+        return None
+
+
+def set_cached(kind, key, value, ttl_seconds=None):
+    """Store `value` (JSON-serializable) and evict the oldest entries of `kind` over the limit."""
+    if not EXTRACTION_CACHE_ENABLED:
+        return
+    ttl_seconds = EXTRACTION_CACHE_TTL_SECONDS if ttl_seconds is None else ttl_seconds
+    now = timezone.now()
+    try:
+        ExtractionCache.objects.update_or_create(
+            kind=kind,
+            key=key,
+            defaults={
+                "value": value,
+                "last_used_at": now,
+                "expires_at": now + timedelta(seconds=ttl_seconds) if ttl_seconds else None,
+            },
+        )
+        evict(kind)
+    except Exception as e:
+        logger.warning(f"Extraction cache write failed ({kind}): {e}")
+
+
+def evict(kind=None, max_entries=None):
+    """Delete expired entries, then least recently used ones beyond `max_entries` per kind."""
+    max_entries = EXTRACTION_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+    removed, _ = ExtractionCache.objects.filter(expires_at__lte=timezone.now()).delete()
+
+    kinds = [kind] if kind else [choice for choice, _ in ExtractionCache.Kind.choices]
+    for cache_kind in kinds:
+        stale = (
+            ExtractionCache.objects.filter(kind=cache_kind)
+            .order_by("-last_used_at")
+            .values_list("pk", flat=True)[max_entries:]
+        )
+        stale_ids = list(stale)
+        if stale_ids:
+            removed += ExtractionCache.objects.filter(pk__in=stale_ids).delete()[0]
+    return removed
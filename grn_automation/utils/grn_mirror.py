@@ -0,0 +1,334 @@
+import os
+import logging
+from datetime import timedelta
+import requests
+from django.db import transaction
+from django.utils import timezone
+from sap_integration.sap_service import SAPService
+from ..models import GRNSyncState, OpenGRN, OpenGRNLine
+from .grns import (
+    GRN_PAGE_SIZE, GRNStream, fetch_grns_by_docnums, iter_grn_pages, iter_open_grns, normalize_docnums,
+)
+from .projections import get_projection
+
+
+logger = logging.getLogger(__name__)
+
+
+# Reads fall back to SAP when the mirror is disabled, has never completed a
+# full sync, or has not synced within SAP_GRN_MIRROR_MAX_AGE_SECONDS.
+MIRROR_ENABLED = os.getenv("SAP_GRN_MIRROR_ENABLED", "true").lower() == "true"
+MIRROR_MAX_AGE_SECONDS = int(os.getenv("SAP_GRN_MIRROR_MAX_AGE_SECONDS", "900"))
+# Incremental syncs only see documents whose UpdateDate/UpdateTime moved; a
+# periodic full sync also drops GRNs that were closed without being touched.
+MIRROR_FULL_SYNC_HOURS = int(os.getenv("SAP_GRN_MIRROR_FULL_SYNC_HOURS", "24"))
+
+SYNC_STATE_NAME = "open_grns"
+OPEN_STATUS = "bost_Open"
+
+
+def _sap_date(value):
+    """SAP sends dates as 'YYYY-MM-DD' (sometimes with a time part)."""
+    return value[:10] if value else None
+
+
+def _sap_time(value):
+    return (value or "")[:8]
+
+
+def save_grn(doc):
+    """Insert or replace one open GRN and its lines."""
+    lines = doc.get("DocumentLines") or []
+    header = {key: value for key, value in doc.items() if key != "DocumentLines"}
+
+    with transaction.atomic():
+        grn, _ = OpenGRN.objects.update_or_create(
+            doc_entry=doc["DocEntry"],
+            defaults={
+                "doc_num": doc.get("DocNum", 0),
+                "card_code": doc.get("CardCode", ""),
+                "card_name": doc.get("CardName") or "",
+                "doc_date": _sap_date(doc.get("DocDate")),
+                "update_date": _sap_date(doc.get("UpdateDate")),
+                "update_time": _sap_time(doc.get("UpdateTime")),
+                "header": header,
+            },
+        )
+        grn.lines.all().delete()
+        OpenGRNLine.objects.bulk_create([
+            OpenGRNLine(
+                grn=grn,
+                line_num=line.get("LineNum", index),
+                item_code=line.get("ItemCode") or "",
+                data=line,
+            )
+            for index, line in enumerate(lines)
+        ])
+    return grn
+
+
+def forget_grns(doc_entries):
+    """Remove GRNs from the mirror; returns the number of documents removed."""
+    removed, _ = OpenGRN.objects.filter(doc_entry__in=list(doc_entries)).delete()
+    return removed
+
+
+def _watermark(doc, current):
+    stamp = (_sap_date(doc.get("UpdateDate")) or "", _sap_time(doc.get("UpdateTime")))
+    return max(stamp, current)
+
+
+def incremental_filter(watermark_date, watermark_time):
+    # `ge` on the same date re-reads documents updated in the watermark second;
+    # upserts are idempotent so that costs nothing but guarantees no gaps.
+    return (
+        f"UpdateDate gt '{watermark_date}' or "
+        f"(UpdateDate eq '{watermark_date}' and UpdateTime ge '{watermark_time or '00:00:00'}')"
+    )
+
+
+def sync_open_grns(full=False):
+    """
+    Bring the open-GRN mirror up to date with SAP.
+
+    The first run and every SAP_GRN_MIRROR_FULL_SYNC_HOURS do a full load of
+    open GRNs and drop everything that was not seen. In between, only
+    documents changed since the UpdateDate/UpdateTime watermark are read;
+    open ones are upserted and closed or cancelled ones are removed.
+    Returns: dict {status, message, data}
+    """
+    state, _ = GRNSyncState.objects.get_or_create(name=SYNC_STATE_NAME)
+    started = timezone.now()
+    if state.last_full_sync_at is None or state.watermark_date is None:
+        full = True
+    elif started - state.last_full_sync_at > timedelta(hours=MIRROR_FULL_SYNC_HOURS):
+        full = True
+
+    watermark = (state.watermark_date.isoformat() if state.watermark_date else "", state.watermark_time)
+    upserted = removed = 0
+
+    try:
+        if full:
+            filter_expr = f"DocumentStatus eq '{OPEN_STATUS}'"
+        else:
+            filter_expr = incremental_filter(*watermark)
+
+        for page in iter_grn_pages(filter_expr, projection="mirror"):
+            for doc in page:
+                watermark = _watermark(doc, watermark)
+                if doc.get("DocumentStatus", OPEN_STATUS) == OPEN_STATUS:
+                    save_grn(doc)
+                    upserted += 1
+                else:
+                    removed += forget_grns([doc["DocEntry"]])
+
+        if full:
+            # Everything still open was just re-saved, so older rows are closed
+            removed += OpenGRN.objects.filter(synced_at__lt=started).delete()[0]
+    except (requests.exceptions.RequestException, ValueError) as e:
+        state.last_error = str(e)
+        state.save(update_fields=["last_error"])
+        logger.error(f"Open GRN mirror sync failed: {e}")
+        return {
+            "status": "failed",
+            "message": f"Open GRN mirror sync failed: {str(e)}",
+            "data": None,
+        }
+
+    if watermark[0]:
+        state.watermark_date = watermark[0]
+        state.watermark_time = watermark[1]
+    state.last_synced_at = started
+    if full:
+        state.last_full_sync_at = started
+    state.last_error = None
+    state.save()
+
+    kind = "Full" if full else "Incremental"
+    return {
+        "status": "success",
+        "message": f"{kind} sync: {upserted} open GRN(s) saved, {removed} removed.",
+        "data": {"full": full, "upserted": upserted, "removed": removed},
+    }
+
+
+def mirror_is_fresh():
+    if not MIRROR_ENABLED:
+        return False
+    state = GRNSyncState.objects.filter(name=SYNC_STATE_NAME).first()
+    if state is None or state.last_full_sync_at is None or state.last_synced_at is None:
+        return False
+    return timezone.now() - state.last_synced_at <= timedelta(seconds=MIRROR_MAX_AGE_SECONDS)
+
+
+def mirror_serves(projection):
+    """The mirror only holds the "mirror" projection; wider reads go to SAP."""
+    return get_projection("mirror").covers(get_projection(projection))
+
+
+def mirrored_grns(vendor_code, doc_nums=None, projection="mirror"):
+    """Open GRNs for a vendor from the mirror, in SAP's shape and DocEntry order."""
+    projection = get_projection(projection)
+    grns = OpenGRN.objects.filter(card_code=vendor_code).prefetch_related("lines")
+    if doc_nums is not None:
+        grns = grns.filter(doc_num__in=doc_nums)
+    return [projection.apply(grn.to_sap()) for grn in grns]
+
+
+def get_open_grns(vendor_code, doc_nums=None, projection="full"):
+    """
+    Open GRNs for a vendor, read from the local mirror when it is fresh.
+
+    Same contract as fetch_grns_for_vendor(), plus `source` ("mirror" or
+    "sap"). With `doc_nums`, a DocNum that is not mirrored (for example a
+    GRN created since the last sync) sends the lookup to SAP. The mirror
+    holds the "mirror" projection, so a wider `projection` (such as "full")
+    is always read from SAP.
+    Returns:
+        dict: {status, message, data, already_posted, source}
+    """
+    if vendor_code and isinstance(vendor_code, str) and mirror_serves(projection) and mirror_is_fresh():
+        wanted = normalize_docnums(doc_nums)
+        grns = mirrored_grns(vendor_code, wanted or None, projection=projection)
+        found = {grn.get("DocNum") for grn in grns}
+
+        if wanted and all(doc_num in found for doc_num in wanted):
+            return {
+                "status": "success",
+                "message": f"Fetched {len(grns)} open GRNs for vendor {vendor_code}.",
+                "data": grns,
+                "already_posted": False,
+                "source": "mirror",
+            }
+        if not wanted:
+            if not grns:
+                return {
+                    "status": "success",
+                    "message": "GRN already posted.",
+                    "data": [],
+                    "already_posted": True,
+                    "source": "mirror",
+                }
+            return {
+                "status": "success",
+                "message": f"Fetched {len(grns)} open GRNs for vendor {vendor_code}.",
+                "data": grns,
+                "already_posted": False,
+                "source": "mirror",
+            }
+
+    return {**fetch_grns_by_docnums(vendor_code, doc_nums, projection=projection), "source": "sap"}
+
+
+def _iter_mirror_then_sap(vendor_code, wanted, projection):
+    grns = OpenGRN.objects.filter(card_code=vendor_code).prefetch_related("lines")
+    if wanted:
+        grns = grns.filter(doc_num__in=wanted)
+
+    yielded = set()
+    found = set()
+    for grn in grns.iterator(chunk_size=GRN_PAGE_SIZE):
+        yielded.add(grn.doc_entry)
+        found.add(grn.doc_num)
+        yield projection.apply(grn.to_sap())
+
+    if wanted and any(doc_num not in found for doc_num in wanted):
+        yield from iter_open_grns(vendor_code, wanted, projection=projection, exclude=yielded)
+
+
+def open_grn_stream(vendor_code, doc_nums=None, projection="full"):
+    """
+    Streaming counterpart of get_open_grns(): `data` is a GRNStream.
+
+    The mirror is read when fresh and it holds every field of `projection`
+    (DocNums missing from it are looked up in SAP), otherwise SAP is paged
+    directly. Nothing is collected into a list.
+    Returns:
+        dict: {status, message, data, already_posted, source}
+    """
+    if not vendor_code or not isinstance(vendor_code, str):
+        return {
+            "status": "failed",
+            "message": "Invalid vendor_code provided.",
+            "data": None,
+            "already_posted": False,
+            "source": None,
+        }
+
+    wanted = normalize_docnums(doc_nums)
+    projection = get_projection(projection)
+    try:
+        if mirror_serves(projection) and mirror_is_fresh():
+            source = "mirror"
+            stream = GRNStream(_iter_mirror_then_sap(vendor_code, wanted, projection))
+        else:
+            source = "sap"
+            SAPService.ensure_session()
+            stream = GRNStream(iter_open_grns(vendor_code, wanted, projection=projection))
+    except Exception as e:
+        return {
+            "status": "failed",
+            "message": f"Failed to fetch open GRNs: {str(e)}",
+            "data": None,
+            "already_posted": False,
+            "source": None,
+        }
+
+    if stream.is_empty():
+        return {
+            "status": "success",
+            "message": "GRN already posted.",
+            "data": stream,
+            "already_posted": True,
+            "source": source,
+        }
+
+    return {
+        "status": "success",
+        "message": f"Streaming open GRNs for vendor {vendor_code}.",
+        "data": stream,
+        "already_posted": False,
+        "source": source,
+    }
+
+
+def recheck_open_grns(doc_entries):
+    """
+    Confirm against SAP that mirrored GRNs are still open right before posting.
+
+    Only the document status is read. GRNs SAP no longer reports as open are
+    removed from the mirror.
+    Returns: dict {status, message, data: {"open": [...], "closed": [doc_entry, ...]}}
+    """
+    doc_entries = sorted({int(doc_entry) for doc_entry in doc_entries})
+    if not doc_entries:
+        return {"status": "success", "message": "No GRNs to re-check.", "data": {"open": [], "closed": []}}
+
+    entries_expr = " or ".join(f"DocEntry eq {doc_entry}" for doc_entry in doc_entries)
+    filter_expr = f"DocumentStatus eq '{OPEN_STATUS}' and ({entries_expr})"
+
+    try:
+        SAPService.ensure_session()
+        open_docs = [doc for page in iter_grn_pages(filter_expr, projection="status") for doc in page]
+    except Exception as e:
+        return {
+            "status": "failed",
+            "message": f"Could not re-check GRNs against SAP: {str(e)}",
+            "data": None,
+        }
+
+    still_open = {doc.get("DocEntry") for doc in open_docs}
+    closed = [doc_entry for doc_entry in doc_entries if doc_entry not in still_open]
+    if closed:
+        forget_grns(closed)
+        return {
+            "status": "failed",
+            "message": f"GRN(s) with DocEntry {closed} are no longer open in SAP.",
+            "data": {"open": open_docs, "closed": closed},
+        }
+
+    return {
+        "status": "success",
+        "message": f"{len(open_docs)} GRN(s) still open in SAP.",
+        "data": {"open": open_docs, "closed": []},
+    }
@@ -1,21 +1,196 @@
 import os
+import time
+import logging
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 from sap_integration.sap_service import SAPService
-import requests
-import time
+from .projections import GRN_PROJECTIONS, get_projection
+
+
+logger = logging.getLogger(__name__)
+
+
+# Server-side page size requested with `Prefer: odata.maxpagesize`. It adapts
+# per page: doubled while pages come back faster than half the target latency,
+# halved when a page takes longer than the target.
+GRN_PAGE_SIZE = int(os.getenv("SAP_GRN_PAGE_SIZE", "100"))
+GRN_MIN_PAGE_SIZE = int(os.getenv("SAP_GRN_MIN_PAGE_SIZE", "20"))
+GRN_MAX_PAGE_SIZE = int(os.getenv("SAP_GRN_MAX_PAGE_SIZE", "500"))
+GRN_PAGE_TARGET_SECONDS = float(os.getenv("SAP_GRN_PAGE_TARGET_SECONDS", "2"))
+
+# Parallel mode: count the open GRNs first, then fetch fixed $skip windows
+# concurrently. Each worker uses its own pooled SAP session.
+GRN_PARALLEL_FETCH = os.getenv("SAP_GRN_PARALLEL_FETCH", "false").lower() == "true"
+GRN_PARALLEL_WINDOW = int(os.getenv("SAP_GRN_PARALLEL_WINDOW", str(GRN_MAX_PAGE_SIZE)))
+GRN_PARALLEL_WORKERS = int(os.getenv("SAP_GRN_PARALLEL_WORKERS", str(SAPService.POOL_SIZE)))
+
+# Streaming pipeline: GRNs flow page by page through filter and match instead
+# of being collected into lists, so memory is bounded by the page size.
+GRN_STREAMING = os.getenv("SAP_GRN_STREAMING", "false").lower() == "true"
+
+# Targeted fetch: DocNums per `DocNum eq a or DocNum eq b ...` filter, kept
+# small enough that the request URL stays well under server/proxy limits.
+GRN_DOCNUM_CHUNK_SIZE = int(os.getenv("SAP_GRN_DOCNUM_CHUNK_SIZE", "40"))
+
+# Default projection; pipeline stages ask for a narrower one (see projections.py)
+GRN_SELECT = GRN_PROJECTIONS["full"].select
+
+
+def open_grn_filter(vendor_code):
+    return f"CardCode eq '{vendor_code}' and DocumentStatus eq 'bost_Open'"
+
+
+def normalize_docnums(doc_nums):
+    """Unique integer DocNums in input order; unparseable values are dropped."""
+    wanted = []
+    for doc_num in doc_nums or []:
+        try:
+            doc_num = int(doc_num)
+        except (TypeError, ValueError):
+            continue
+        if doc_num not in wanted:
+            wanted.append(doc_num)
+    return wanted
+
+
+def docnum_filter(vendor_code, doc_nums):
+    docnums_expr = " or ".join(f"DocNum eq {int(doc_num)}" for doc_num in doc_nums)
+    return f"{open_grn_filter(vendor_code)} and ({docnums_expr})"
+
+
+def next_page_size(page_size, elapsed):
+    """Grow or shrink the page size based on how long the last page took."""
+    if elapsed < GRN_PAGE_TARGET_SECONDS / 2:
+        return min(page_size * 2, GRN_MAX_PAGE_SIZE)
+    if elapsed > GRN_PAGE_TARGET_SECONDS:
+        return max(page_size // 2, GRN_MIN_PAGE_SIZE)
+    return page_size
+
+
+def next_link_endpoint(body):
+    """Return the Service Layer endpoint of the next page, or None on the last page."""
+    link = body.get("odata.nextLink") or body.get("@odata.nextLink")
+    if not link:
+        return None
+
+    # SAP returns the link relative to the service root ("PurchaseDeliveryNotes?...$skip=20"),
+    # but absolute forms are accepted too.
+    parsed = urlparse(link)
+    base_path = urlparse(os.getenv("SAP_SERVICE_LAYER_URL", "")).path.rstrip("/")
+    path = parsed.path
+    if base_path and path.startswith(base_path):
+        path = path[len(base_path):]
+    if not path.startswith("/"):
+        path = f"/{path}"
+    return f"{path}?{parsed.query}" if parsed.query else path
+
+
+def _get_page(endpoint, page_size, max_retries, retry_delay):
+    attempt = 0
+    while True:
+        try:
+            resp = SAPService.get(endpoint, headers={"Prefer": f"odata.maxpagesize={page_size}"})
+            return resp.json()
+        except requests.exceptions.RequestException:
+            attempt += 1
+            if attempt >= max_retries:
+                raise
+            time.sleep(retry_delay)
+
+
+def iter_grn_pages(filter_expr, projection="full", page_size=None, max_retries=3, retry_delay=2,
+                   top=None, skip=None):
+    """
+    Yield PurchaseDeliveryNotes matching `filter_expr` one page at a time.
+
+    SAP decides the page boundaries (`Prefer: odata.maxpagesize`) and the next
+    page is requested through the `odata.nextLink` it returns. `top`/`skip`
+    restrict the iteration to one window of the ordered result. Only the
+    fields of `projection` (a name from GRN_PROJECTIONS) are requested and kept.
 
+    Raises:
+        requests.exceptions.RequestException: when a page still fails after `max_retries`
+        ValueError: when SAP returns an unexpected payload
+    """
+    projection = get_projection(projection)
+    page_size = page_size or GRN_PAGE_SIZE
+    endpoint = f"/PurchaseDeliveryNotes?$filter={filter_expr}&$select={projection.select}&$orderby=DocEntry"
+    if top is not None:
+        endpoint += f"&$top={top}"
+    if skip:
+        endpoint += f"&$skip={skip}"
+
+    while endpoint:
+        started = time.monotonic()
+        body = _get_page(endpoint, page_size, max_retries, retry_delay)
+        elapsed = time.monotonic() - started
+
+        page = body.get("value", []) if isinstance(body, dict) else None
+        if not isinstance(page, list):
+            raise ValueError("Unexpected response format from SAP Service Layer.")
+
+        yield [projection.apply(doc) for doc in page]
+
+        endpoint = next_link_endpoint(body)
+        page_size = next_page_size(page_size, elapsed)
+
+
+def count_grns(filter_expr):
+    """Number of PurchaseDeliveryNotes matching `filter_expr` ($count)."""
+    resp = SAPService.get(f"/PurchaseDeliveryNotes/$count?$filter={filter_expr}")
+    try:
+        return int(resp.text.strip())
+    except ValueError:
+        raise ValueError(f"Unexpected $count response from SAP Service Layer: {resp.text[:100]}")
+
+
+def fetch_grns_parallel(filter_expr, window=None, max_workers=None, max_retries=3, retry_delay=2,
+                        projection="full"):
+    """
+    Fetch every GRN matching `filter_expr` by fetching $skip windows concurrently.
+
+    Wall-clock time is roughly one window's latency instead of one per page.
+    Windows are fetched on separate pooled sessions and the result is returned
+    in DocEntry order.
+    """
+    window = window or GRN_PARALLEL_WINDOW
+    total = count_grns(filter_expr)
+    if total == 0:
+        return []
+
+    def fetch_window(skip):
+        grns = []
+        for page in iter_grn_pages(filter_expr, projection=projection, page_size=window,
+                                   max_retries=max_retries, retry_delay=retry_delay, top=window, skip=skip):
+            grns.extend(page)
+        return grns
+
+    skips = list(range(0, total, window))
+    workers = max(1, min(max_workers or GRN_PARALLEL_WORKERS, SAPService.POOL_SIZE, len(skips)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="grn-fetch") as executor:
+        windows = list(executor.map(fetch_window, skips))
 
-SERVICE_LAYER_URL = os.getenv("SAP_SERVICE_LAYER_URL", "").rstrip("/")
+    # A GRN that moves between windows while they are fetched may show up twice
+    by_doc_entry = {}
+    for grns in windows:
+        for grn in grns:
+            by_doc_entry[grn.get("DocEntry")] = grn
+    return [by_doc_entry[key] for key in sorted(by_doc_entry, key=lambda k: (k is None, k))]
 
 
-def fetch_grns_for_vendor(vendor_code, batch_size=10, max_retries=3, retry_delay=2):
+def fetch_grns_for_vendor(vendor_code, batch_size=None, max_retries=3, retry_delay=2, parallel=None,
+                          projection="full"):
     """
-    Fetch open GRNs for a vendor in batches to avoid instability with large datasets.
+    Fetch open GRNs for a vendor, following SAP's server-side paging.
     Args:
         vendor_code (str): The vendor code to filter GRNs.
-        batch_size (int): Number of records to fetch per batch (default: 10).
-        max_retries (int): Number of retries for transient errors.
+        batch_size (int): Initial page size (default: SAP_GRN_PAGE_SIZE); adapts to response time.
+            In parallel mode this is the $skip window size instead.
+        max_retries (int): Number of retries per page for transient errors.
         retry_delay (int): Delay in seconds between retries.
+        parallel (bool): Count first and fetch windows concurrently (default: SAP_GRN_PARALLEL_FETCH).
+        projection (str): Fields to fetch, see GRN_PROJECTIONS (default: "full").
     Returns:
         dict: {status (str), message (str), data (list or None), already_posted (bool)}
     """
@@ -37,72 +212,206 @@ def fetch_grns_for_vendor(vendor_code, batch_size=10, max_retries=3, retry_delay
             "already_posted": False,
         }
     
+    if parallel is None:
+        parallel = GRN_PARALLEL_FETCH
+    
     all_data = []
-    skip = 0
     
-    while True:
-        url = (
-            f"{SERVICE_LAYER_URL}/PurchaseDeliveryNotes?"
-            f"$filter=CardCode eq '{vendor_code}' and DocumentStatus eq 'bost_Open'"
-            f"&$select=DocEntry,DocNum,DocDate,TaxDate,CreationDate,UpdateDate,BPL_IDAssignedToInvoice,DocTotalFc,"
-            f"CardCode,CardName,DocTotal,DocTotalSys,DocCurrency,VatSum,"
-            f"AddressExtension,TaxExtension,DocumentLines"
-            f"&$top={batch_size}&$skip={skip}"
-        )
-        
-        headers = {
-            "Cookie": f"B1SESSION={SAPService.session_id}",
-            "Content-Type": "application/json",
+    try:
+        if parallel:
+            all_data = fetch_grns_parallel(open_grn_filter(vendor_code), window=batch_size,
+                                           max_retries=max_retries, retry_delay=retry_delay,
+                                           projection=projection)
+        else:
+            for page in iter_grn_pages(open_grn_filter(vendor_code), projection=projection,
+                                       page_size=batch_size, max_retries=max_retries,
+                                       retry_delay=retry_delay):
+                all_data.extend(page)
+    except requests.exceptions.RequestException as e:
+        return {
+            "status": "failed",
+            "message": f"Failed after {max_retries} attempts: {str(e)}",
+            "data": None,
+            "already_posted": False,
         }
-        
-        attempt = 0
-        while attempt < max_retries:
-            try:
-                resp = requests.get(url, headers=headers, verify=False, timeout=30)
-                resp.raise_for_status()
-                batch = resp.json().get("value", [])
-                
-                if not isinstance(batch, list):
-                    return {
-                        "status": "failed",
-                        "message": "Unexpected response format from SAP Service Layer.",
-                        "data": None,
-                        "already_posted": False,
-                    }
-                
-                all_data.extend(batch)
-                
-                # If fewer records than batch_size returned, we've reached the end
-                if len(batch) < batch_size:
-                    # Check if no GRNs were found at all (already posted scenario)
-                    if len(all_data) == 0:
-                        return {
-                            "status": "success",
-                            "message": "GRN already posted.",
-                            "data": [],
-                            "already_posted": True,
-                        }
-                    
-                    return {
-                        "status": "success",
-                        "message": f"Fetched {len(all_data)} open GRNs for vendor {vendor_code}.",
-                        "data": all_data,
-                        "already_posted": False,
-                    }
-                
-                skip += batch_size
-                break  # exit retry loop if successful
-                
-            except requests.exceptions.RequestException as e:
-                attempt += 1
-                if attempt >= max_retries:
-                    return {
-                        "status": "failed",
-                        "message": f"Failed after {max_retries} attempts: {str(e)}",
-                        "data": None,
-                        "already_posted": False,
-                    }
-                time.sleep(retry_delay)
+    except ValueError as e:
+        return {
+            "status": "failed",
+            "message": str(e),
+            "data": None,
+            "already_posted": False,
+        }
+    
+    # Check if no GRNs were found at all (already posted scenario)
+    if len(all_data) == 0:
+        return {
+            "status": "success",
+            "message": "GRN already posted.",
+            "data": [],
+            "already_posted": True,
+        }
+    
+    return {
+        "status": "success",
+        "message": f"Fetched {len(all_data)} open GRNs for vendor {vendor_code}.",
+        "data": all_data,
+        "already_posted": False,
+    }
+
+
+def fetch_grns_by_docnums(vendor_code, doc_nums, chunk_size=None, max_retries=3, retry_delay=2,
+                          projection="full"):
+    """
+    Fetch only the open GRNs whose DocNum is in `doc_nums`.
+
+    The DocNums are pushed down into the $filter in chunks of `chunk_size`
+    (default: SAP_GRN_DOCNUM_CHUNK_SIZE). If any DocNum is not found among
+    the vendor's open GRNs, or no DocNums are given, this falls back to
+    fetch_grns_for_vendor() so the result matches a full scan (including
+    the already-posted case).
+    Returns:
+        dict: {status (str), message (str), data (list or None), already_posted (bool)}
+    """
+    wanted = normalize_docnums(doc_nums)
+    if not wanted or not vendor_code or not isinstance(vendor_code, str):
+        return fetch_grns_for_vendor(vendor_code, max_retries=max_retries, retry_delay=retry_delay,
+                                     projection=projection)
+
+    try:
+        SAPService.ensure_session()
+    except Exception as e:
+        return {
+            "status": "failed",
+            "message": f"Failed to initialize SAP session: {str(e)}",
+            "data": None,
+            "already_posted": False,
+        }
+
+    chunk_size = chunk_size or GRN_DOCNUM_CHUNK_SIZE
+    all_data = []
+
+    try:
+        for start in range(0, len(wanted), chunk_size):
+            chunk = wanted[start:start + chunk_size]
+            for page in iter_grn_pages(docnum_filter(vendor_code, chunk), projection=projection,
+                                       max_retries=max_retries, retry_delay=retry_delay):
+                all_data.extend(page)
+    except requests.exceptions.RequestException as e:
+        return {
+            "status": "failed",
+            "message": f"Failed after {max_retries} attempts: {str(e)}",
+            "data": None,
+            "already_posted": False,
+        }
+    except ValueError as e:
+        return {
+            "status": "failed",
+            "message": str(e),
+            "data": None,
+            "already_posted": False,
+        }
+
+    found = {grn.get("DocNum") for grn in all_data}
+    missing = [doc_num for doc_num in wanted if doc_num not in found]
+    if missing:
+        logger.info(
+            f"GRN DocNum(s) {missing} not open for vendor {vendor_code}; falling back to a full vendor scan"
+        )
+        return fetch_grns_for_vendor(vendor_code, max_retries=max_retries, retry_delay=retry_delay,
+                                     projection=projection)
+
+    return {
+        "status": "success",
+        "message": f"Fetched {len(all_data)} open GRNs for vendor {vendor_code}.",
+        "data": all_data,
+        "already_posted": False,
+    }
+
+
+def iter_open_grns(vendor_code, doc_nums=None, projection="full", chunk_size=None,
+                   max_retries=3, retry_delay=2, exclude=()):
+    """
+    Generator version of fetch_grns_by_docnums(): yields open GRNs one at a time.
+
+    At most one page is held in memory. The referenced DocNums are read first;
+    if any is missing the vendor's remaining open GRNs follow (GRNs already
+    yielded, or whose DocEntry is in `exclude`, are skipped).
+
+    Raises:
+        requests.exceptions.RequestException, ValueError: as iter_grn_pages()
+    """
+    wanted = normalize_docnums(doc_nums)
+    yielded = set(exclude)
+    found = set()
+
+    if wanted:
+        chunk_size = chunk_size or GRN_DOCNUM_CHUNK_SIZE
+        for start in range(0, len(wanted), chunk_size):
+            chunk = wanted[start:start + chunk_size]
+            for page in iter_grn_pages(docnum_filter(vendor_code, chunk), projection=projection,
+                                       max_retries=max_retries, retry_delay=retry_delay):
+                for grn in page:
+                    found.add(grn.get("DocNum"))
+                    if grn.get("DocEntry") not in yielded:
+                        yielded.add(grn.get("DocEntry"))
+                        yield grn
+
+        missing = [doc_num for doc_num in wanted if doc_num not in found]
+        if not missing:
+            return
+        logger.info(
+            f"GRN DocNum(s) {missing} not open for vendor {vendor_code}; falling back to a full vendor scan"
+        )
+
+    for page in iter_grn_pages(open_grn_filter(vendor_code), projection=projection,
+                               max_retries=max_retries, retry_delay=retry_delay):
+        for grn in page:
+            if grn.get("DocEntry") not in yielded:
+                yield grn
+
+
+class GRNStream:
+    """
+    Lazily iterated GRNs that count how many pass each pipeline stage.
+
+    Only the current page is alive at any time. The first GRN is read on
+    construction so that an empty result or a failing first page is known
+    before the pipeline starts. An error while streaming is kept in `error`
+    and re-raised to the consumer.
+    """
+
+    def __init__(self, grns):
+        self._grns = iter(grns)
+        self.fetched = 0
+        self.filtered_count = 0
+        self.error = None
+        self._head = []
+        for grn in self._grns:
+            self._head.append(grn)
+            break
+
+    def is_empty(self):
+        return not self._head and self.fetched == 0
+
+    def __iter__(self):
+        try:
+            while self._head:
+                self.fetched += 1
+                yield self._head.pop()
+            for grn in self._grns:
+                self.fetched += 1
+                yield grn
+        except (requests.exceptions.RequestException, ValueError) as e:
+            self.error = e
+            raise
+
+    def filtered(self):
+        """Yield filter_grn_response() data for each GRN, skipping ones that fail."""
+        for grn in self:
+            result = filter_grn_response(grn)
+            if result["status"] == "success":
+                self.filtered_count += 1
+                yield result["data"]
 
 
 def filter_grn_response(grn):
@@ -1,14 +1,13 @@
 import logging
 import requests
-import os
 from typing import Dict, List, Union, Any
 from sap_integration.sap_service import SAPService
+from sap_integration.batch import BatchOperation
 from datetime import datetime
 import uuid
 
 
 logger = logging.getLogger(__name__)
-SERVICE_LAYER_URL = os.getenv("SAP_SERVICE_LAYER_URL", "").rstrip("/")
 
 
 class InvoiceCreationError(Exception):
@@ -235,6 +234,76 @@ def create_dummy_response(
     }
 
 
+def sap_error_message(resp, default: str = "") -> str:
+    """Pull the human readable message out of a Service Layer error body."""
+    try:
+        return resp.json().get("error", {}).get("message", {}).get("value", default)
+    except Exception:
+        return default
+
+
+def find_invoices_by_reference(references: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Look up A/P Invoices in SAP by their vendor reference (NumAtCard).
+    
+    Returns:
+        {NumAtCard: invoice} for the references SAP has an invoice for
+        
+    Raises:
+        requests.exceptions.RequestException, ValueError: If SAP cannot be asked
+    """
+    filter_expr = " or ".join(f"NumAtCard eq '{ref}'" for ref in references)
+    resp = SAPService.get(
+        "/PurchaseInvoices",
+        params={"$filter": filter_expr, "$select": "DocEntry,DocNum,NumAtCard"},
+    )
+    return {invoice["NumAtCard"]: invoice for invoice in resp.json().get("value", [])}
+
+
+def recheck_unconfirmed_invoices(payloads: List[Dict[str, Any]], error_message: str) -> List[Dict[str, Any]]:
+    """
+    Settle invoices whose POST may or may not have reached SAP.
+    
+    A timeout or an unreadable response does not mean SAP rolled back, so each
+    invoice is looked up by its NumAtCard before anyone retries it: found ones
+    are successes, missing ones are plain failures that are safe to post again.
+    If SAP cannot be asked either, the invoices come back with status "unknown"
+    and must not be posted again until someone has checked SAP.
+    """
+    references = [payload.get("NumAtCard") for payload in payloads]
+    try:
+        found = find_invoices_by_reference(references)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.error(f"Could not re-check invoices {references} in SAP: {e}", exc_info=True)
+        return [
+            {
+                "status": "unknown",
+                "message": (
+                    f"{error_message}. SAP may have created the invoice; "
+                    f"check NumAtCard {reference} in SAP before posting it again"
+                ),
+                "data": {"NumAtCard": reference},
+            }
+            for reference in references
+        ]
+    
+    results = []
+    for reference in references:
+        if reference in found:
+            logger.info(
+                f"Invoice {reference} was created despite the failed response. "
+                f"DocEntry: {found[reference].get('DocEntry')}"
+            )
+            results.append({
+                "status": "success",
+                "message": "Invoice created successfully",
+                "data": found[reference],
+            })
+        else:
+            results.append({"status": "failed", "message": error_message, "data": None})
+    return results
+
+
 def call_sap_api(payload: Dict[str, Any]) -> Dict[str, Any]:
     """
     Make the actual SAP Service Layer API call.
@@ -248,16 +317,6 @@ def call_sap_api(payload: Dict[str, Any]) -> Dict[str, Any]:
     Raises:
         InvoiceCreationError: If API call fails
     """
-    if not SAPService.session_id:
-        raise InvoiceCreationError("SAP session not initialized")
-    
-    headers = {
-        "Cookie": f"B1SESSION={SAPService.session_id}",
-        "Content-Type": "application/json",
-    }
-    
-    url = f"{SERVICE_LAYER_URL}/PurchaseInvoices"
-    
     try:
         logger.info(
             f"Creating invoice in SAP for vendor {payload['CardCode']} "
@@ -265,16 +324,8 @@ def call_sap_api(payload: Dict[str, Any]) -> Dict[str, Any]:
         )
         logger.debug(f"Invoice payload: {payload}")
         
-        resp = requests.post(
-            url,
-            headers=headers,
-            json=payload,
-            verify=False,
-            timeout=30
-        )
-        
-        # Check for HTTP errors
-        resp.raise_for_status()
+        # POSTs are never auto-retried by the client, so an invoice cannot be posted twice
+        resp = SAPService.post("/PurchaseInvoices", json=payload)
         
         response_data = resp.json()
         logger.info(
@@ -290,20 +341,16 @@ def call_sap_api(payload: Dict[str, Any]) -> Dict[str, Any]:
     
     except requests.exceptions.Timeout:
         logger.error("SAP API request timed out", exc_info=True)
-        raise InvoiceCreationError("SAP API request timed out after 30 seconds")
+        return recheck_unconfirmed_invoices(
+            [payload], f"SAP API request timed out after {SAPService.DEFAULT_TIMEOUT[1]:g} seconds"
+        )[0]
     
     except requests.exceptions.HTTPError as http_err:
+        resp = http_err.response
         error_text = resp.text if resp is not None else str(http_err)
         logger.error(f"SAP API HTTP error: {error_text}", exc_info=True)
         
-        # Try to extract SAP error message
-        try:
-            error_json = resp.json()
-            error_msg = error_json.get("error", {}).get("message", {}).get("value", error_text)
-        except:
-            error_msg = error_text
-        
-        raise InvoiceCreationError(f"SAP API Error: {error_msg}")
+        raise InvoiceCreationError(f"SAP API Error: {sap_error_message(resp, error_text)}")
     
     except requests.exceptions.RequestException as req_err:
         logger.error(f"SAP API request failed: {req_err}", exc_info=True)
@@ -311,7 +358,59 @@ def call_sap_api(payload: Dict[str, Any]) -> Dict[str, Any]:
     
     except ValueError as json_err:
         logger.error(f"Failed to parse SAP API response: {json_err}", exc_info=True)
-        raise InvoiceCreationError("Invalid JSON response from SAP API")
+        return recheck_unconfirmed_invoices([payload], "Invalid JSON response from SAP API")[0]
+
+
+def prepare_invoice_payload(grns: Union[Dict, List[Dict]]):
+    """
+    Validate GRN input and build the SAP invoice payload for one invoice.
+    
+    Args:
+        grns: Single GRN dict or list of GRN dicts from validation payload
+        
+    Returns:
+        Tuple of (payload, doc_lines)
+        
+    Raises:
+        InvoiceCreationError: If the GRNs cannot be invoiced
+    """
+    # Step 1: Validate and normalize input
+    try:
+        validated_grns = validate_grn_structure(grns)
+    except InvoiceCreationError as e:
+        logger.error(f"GRN validation failed: {e}")
+        raise
+    
+    # Step 2: Validate vendor consistency
+    try:
+        card_code = validate_vendor_consistency(validated_grns)
+        logger.info(f"Processing invoice for vendor: {card_code}")
+    except InvoiceCreationError as e:
+        logger.error(f"Vendor validation failed: {e}")
+        raise
+    
+    # Step 3: Extract document lines with remaining quantities
+    doc_lines = extract_document_lines(validated_grns)
+    
+    if not doc_lines:
+        logger.warning("No lines with remaining open quantity found")
+        raise InvoiceCreationError(
+            "All GRPO lines are fully invoiced or have no remaining "
+            "open quantity. No invoice created."
+        )
+    
+    logger.info(
+        f"Prepared {len(doc_lines)} invoice line(s) from "
+        f"{len(validated_grns)} GRN(s)"
+    )
+    
+    # Step 4: Generate unique vendor reference number (globally for all cases)
+    vendor_ref_no = generate_unique_vendor_ref_no(card_code)
+    logger.info(f"Generated unique vendor reference number: {vendor_ref_no}")
+    
+    # Step 5: Build invoice payload with unique reference
+    payload = build_invoice_payload(validated_grns, doc_lines, vendor_ref_no)
+    return payload, doc_lines
 
 
 def create_invoice(
@@ -326,7 +425,8 @@ def create_invoice(
     
     Supports three scenarios:
     1. One GRN to One Invoice (1:1)
-    2. One GRN to Multiple Invoices (1:many) - handled by calling this function multiple times
+    2. One GRN to Multiple Invoices (1:many) - handled by calling this function multiple times,
+       or all at once with create_invoices()
     3. Multiple GRNs to One Invoice (many:1)
     
     Args:
@@ -335,7 +435,8 @@ def create_invoice(
         
     Returns:
         dict with keys:
-            - status: "success" or "failed"
+            - status: "success", "failed", or "unknown" when SAP may have
+              created the invoice but could not be asked (do not retry)
             - message: Description of result
             - data: Invoice data or None on failure
             
@@ -368,55 +469,16 @@ def create_invoice(
         if not use_dummy:
             SAPService.ensure_session()
         
-        # Step 1: Validate and normalize input
+        # Steps 1-5: validate input and build the payload
         try:
-            validated_grns = validate_grn_structure(grns)
+            payload, doc_lines = prepare_invoice_payload(grns)
         except InvoiceCreationError as e:
-            logger.error(f"GRN validation failed: {e}")
             return {
                 "status": "failed",
                 "message": str(e),
                 "data": None,
             }
         
-        # Step 2: Validate vendor consistency
-        try:
-            card_code = validate_vendor_consistency(validated_grns)
-            logger.info(f"Processing invoice for vendor: {card_code}")
-        except InvoiceCreationError as e:
-            logger.error(f"Vendor validation failed: {e}")
-            return {
-                "status": "failed",
-                "message": str(e),
-                "data": None,
-            }
-        
-        # Step 3: Extract document lines with remaining quantities
-        doc_lines = extract_document_lines(validated_grns)
-        
-        if not doc_lines:
-            logger.warning("No lines with remaining open quantity found")
-            return {
-                "status": "failed",
-                "message": (
-                    "All GRPO lines are fully invoiced or have no remaining "
-                    "open quantity. No invoice created."
-                ),
-                "data": None,
-            }
-        
-        logger.info(
-            f"Prepared {len(doc_lines)} invoice line(s) from "
-            f"{len(validated_grns)} GRN(s)"
-        )
-        
-        # Step 4: Generate unique vendor reference number (globally for all cases)
-        vendor_ref_no = generate_unique_vendor_ref_no(card_code)
-        logger.info(f"Generated unique vendor reference number: {vendor_ref_no}")
-        
-        # Step 5: Build invoice payload with unique reference
-        payload = build_invoice_payload(validated_grns, doc_lines, vendor_ref_no)
-        
         # Step 6: Return dummy response or call SAP API
         if use_dummy:
             logger.info("Dummy mode enabled, returning mock response")
@@ -439,4 +501,96 @@ def create_invoice(
             "message": f"Unexpected error: {str(e)}",
             "data": None,
         }
-    
\ No newline at end of file
+
+
+def create_invoices(
+    grns_list: List[Union[Dict, List[Dict]]],
+    use_dummy: bool = True
+) -> List[Dict[str, Any]]:
+    """
+    Create several A/P Invoices in one SAP Service Layer $batch round trip.
+    
+    Each entry of `grns_list` is what create_invoice() accepts for a single
+    invoice. Every invoice is sent in its own changeset, so one rejected
+    invoice does not roll back the others.
+    
+    Args:
+        grns_list: One GRN payload (dict or list of dicts) per invoice
+        use_dummy: If True, returns dummy responses without calling SAP API
+        
+    Returns:
+        List of create_invoice()-style result dicts, in the same order as
+        `grns_list`, so results can be mapped back to ValidationResult rows
+    """
+    results = [None] * len(grns_list)
+    prepared = []  # (index, payload)
+    
+    for idx, grns in enumerate(grns_list):
+        try:
+            payload, doc_lines = prepare_invoice_payload(grns)
+        except InvoiceCreationError as e:
+            results[idx] = {"status": "failed", "message": str(e), "data": None}
+            continue
+        except Exception as e:
+            logger.error(f"Unexpected error preparing invoice {idx + 1}: {e}", exc_info=True)
+            results[idx] = {"status": "failed", "message": f"Unexpected error: {str(e)}", "data": None}
+            continue
+        
+        if use_dummy:
+            results[idx] = create_dummy_response(payload, doc_lines)
+        else:
+            prepared.append((idx, payload))
+    
+    if not prepared:
+        return results
+    
+    logger.info(f"Posting {len(prepared)} invoice(s) to SAP in one $batch request")
+    operations = [BatchOperation("POST", "/PurchaseInvoices", payload) for _, payload in prepared]
+    
+    try:
+        batch_results = SAPService.batch(operations)
+    except requests.exceptions.HTTPError as http_err:
+        resp = http_err.response
+        error_text = resp.text if resp is not None else str(http_err)
+        logger.error(f"SAP $batch HTTP error: {error_text}", exc_info=True)
+        batch_results = None
+        error_message = f"SAP API Error: {sap_error_message(resp, error_text)}"
+        # A 4xx means SAP refused the whole $batch before running any changeset
+        unconfirmed = resp is None or resp.status_code >= 500
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.error(f"SAP $batch request failed: {e}", exc_info=True)
+        batch_results = None
+        error_message = f"SAP API request failed: {str(e)}"
+        # Timed out or unreadable: the changesets may have been committed
+        unconfirmed = True
+    
+    if batch_results is None:
+        if unconfirmed:
+            outcomes = recheck_unconfirmed_invoices([payload for _, payload in prepared], error_message)
+        else:
+            outcomes = [{"status": "failed", "message": error_message, "data": None}] * len(prepared)
+        for (idx, _), outcome in zip(prepared, outcomes):
+            results[idx] = dict(outcome)
+        return results
+    
+    for position, (idx, payload) in enumerate(prepared):
+        result = batch_results[position]
+        if result.ok:
+            logger.info(
+                f"Invoice created successfully. DocEntry: {(result.body or {}).get('DocEntry')}, "
+                f"Reference: {payload.get('NumAtCard')}"
+            )
+            results[idx] = {
+                "status": "success",
+                "message": "Invoice created successfully",
+                "data": result.body,
+            }
+        else:
+            logger.error(f"SAP rejected invoice {payload.get('NumAtCard')}: {result.error_message}")
+            results[idx] = {
+                "status": "failed",
+                "message": f"SAP API Error: {result.error_message}",
+                "data": None,
+            }
+    
+    return results
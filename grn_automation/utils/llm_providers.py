@@ -0,0 +1,380 @@
+"""
+LLM providers for InvoiceProcessor.
+
+A provider owns long-lived API clients (keep-alive HTTP pools, explicit
+timeouts and retry budgets) and exposes the two kinds of call the pipeline
+makes: `generate` (Gemini-style text/JSON from a prompt and optional PDF)
+and `parse` (OpenAI-style structured output into a pydantic model).
+
+get_provider() returns one shared instance per process, selected by
+LLM_PROVIDER; views and tasks reuse its connections instead of paying TLS
+setup on every call. Pass a provider to InvoiceProcessor to override it.
+Hosted calls wait for cluster-wide quota first (see rate_limit.acquire()).
+"""
+import os
+import re
+import abc
+import json
+import time
+import random
+import hashlib
+import logging
+import threading
+from .rate_limit import acquire, estimate_tokens
+
+
+logger = logging.getLogger(__name__)
+
+
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "hosted")
+# Per-request timeout; PDF extraction of long documents can take a while
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "120"))
+# Retries on connection errors, 408/429 and 5xx (on top of the first attempt)
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+# Keep-alive pool size per client; at least VALIDATION_CONCURRENCY x worker threads
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+LLM_KEEPALIVE_SECONDS = 60
+
+RETRY_STATUS_CODES = [408, 429, 500, 502, 503, 504]
+
+# LLM_PROVIDER=fake: offline responses for benchmarking (see FakeProvider)
+LLM_FAKE_FIXTURE = os.getenv(
+    "LLM_FAKE_FIXTURE", os.path.join(os.path.dirname(__file__), "fake_llm_fixture.json")
+)
+# Multiplies every simulated latency; 0 answers immediately
+LLM_FAKE_LATENCY_SCALE = float(os.getenv("LLM_FAKE_LATENCY_SCALE", "1"))
+# Overrides the fixture's error_rate when set
+LLM_FAKE_ERROR_RATE = os.getenv("LLM_FAKE_ERROR_RATE")
+LLM_FAKE_SEED = os.getenv("LLM_FAKE_SEED")
+
+
+class LLMProvider(abc.ABC):
+    """Interface used by InvoiceProcessor; a provider implements both calls."""
+
+    name = "base"
+
+    @abc.abstractmethod
+    def generate(self, model, prompt, pdf_bytes=None, system_instruction=None, response_schema=None):
+        """
+        Text response for `prompt`, optionally with a PDF attached. With
+        `response_schema` (a pydantic model) the text is JSON in that shape.
+        """
+
+    @abc.abstractmethod
+    def parse(self, model, system_prompt, user_content, response_model):
+        """Structured response parsed into an instance of `response_model`."""
+
+    def close(self):
+        """Release pooled connections."""
+
+
+def _http_limits():
+    import httpx
+
+    return httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_CONNECTIONS,
+        keepalive_expiry=LLM_KEEPALIVE_SECONDS,
+    )
+
+
+class GeminiClient:
+    """google-genai client for HostedProvider.generate(); created on first use and then reused."""
+
+    name = "gemini"
+
+    def __init__(self, api_key=None, timeout=None, max_retries=None):
+        self.api_key = api_key
+        self.timeout = LLM_TIMEOUT_SECONDS if timeout is None else timeout
+        self.max_retries = LLM_MAX_RETRIES if max_retries is None else max_retries
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                from google import genai
+                from google.genai import types
+
+                self._client = genai.Client(
+                    api_key=self.api_key or os.getenv("GEMINI_API_KEY"),
+                    http_options=types.HttpOptions(
+                        timeout=int(self.timeout * 1000),  # milliseconds
+                        retry_options=types.HttpRetryOptions(
+                            attempts=self.max_retries + 1,
+                            http_status_codes=RETRY_STATUS_CODES,
+                        ),
+                        client_args={"limits": _http_limits()},
+                    ),
+                )
+            return self._client
+
+    def generate(self, model, prompt, pdf_bytes=None, system_instruction=None, response_schema=None):
+        from google.genai import types
+
+        contents = prompt
+        if pdf_bytes is not None:
+            contents = [types.Part.from_bytes(data=pdf_bytes, mime_type="application/pdf"), prompt]
+
+        config = None
+        if system_instruction or response_schema:
+            config = types.GenerateContentConfig(
+                system_instruction=system_instruction,
+                response_mime_type="application/json" if response_schema else None,
+                response_schema=response_schema,
+            )
+
+        acquire(self.name, model, estimate_tokens(prompt, system_instruction, pdf_bytes=pdf_bytes))
+        response = self.client.models.generate_content(model=model, contents=contents, config=config)
+        return response.text
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+
+class OpenAIClient:
+    """OpenAI client for HostedProvider.parse(), over a shared keep-alive httpx pool."""
+
+    name = "openai"
+
+    def __init__(self, api_key=None, timeout=None, max_retries=None):
+        self.api_key = api_key
+        self.timeout = LLM_TIMEOUT_SECONDS if timeout is None else timeout
+        self.max_retries = LLM_MAX_RETRIES if max_retries is None else max_retries
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                import httpx
+                from openai import OpenAI
+
+                self._client = OpenAI(
+                    api_key=self.api_key or os.getenv("OPENAI_API_KEY"),
+                    timeout=self.timeout,
+                    max_retries=self.max_retries,
+                    http_client=httpx.Client(limits=_http_limits(), timeout=self.timeout),
+                )
+            return self._client
+
+    def parse(self, model, system_prompt, user_content, response_model):
+        acquire(self.name, model, estimate_tokens(system_prompt, user_content))
+        response = self.client.responses.parse(
+            model=model,
+            input=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_content},
+            ],
+            text_format=response_model,
+        )
+        return response.output_parsed
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+
+class HostedProvider(LLMProvider):
+    """Production routing: Gemini for extraction, OpenAI for validation."""
+
+    name = "hosted"
+
+    def __init__(self, gemini_api_key=None, openai_api_key=None, timeout=None, max_retries=None):
+        self.gemini = GeminiClient(gemini_api_key, timeout, max_retries)
+        self.openai = OpenAIClient(openai_api_key, timeout, max_retries)
+
+    def generate(self, model, prompt, pdf_bytes=None, system_instruction=None, response_schema=None):
+        return self.gemini.generate(model, prompt, pdf_bytes, system_instruction, response_schema)
+
+    def parse(self, model, system_prompt, user_content, response_model):
+        return self.openai.parse(model, system_prompt, user_content, response_model)
+
+    def close(self):
+        self.gemini.close()
+        self.openai.close()
+
+
+class FakeLLMError(RuntimeError):
+    """Simulated provider failure raised by FakeProvider."""
+    pass
+
+
+class FakeProvider(LLMProvider):
+    """
+    Offline stand-in that answers from a JSON fixture after a simulated latency.
+
+    The fixture holds `documents` (markdown, vendor_fields and validation for
+    one PDF), per-call `latency` distributions and an `error_rate`. A PDF maps
+    to a document by content hash, so the same upload always gets the same
+    answers. Validation payloads are built from the GRN in the prompt, so a
+    run can go all the way to posting (against the SAP emulator).
+
+    Latency specs (milliseconds): {"distribution": "fixed", "ms"},
+    {"distribution": "uniform", "min_ms", "max_ms"},
+    {"distribution": "normal", "mean_ms", "stddev_ms"},
+    {"distribution": "lognormal", "median_ms", "sigma"}.
+    """
+
+    name = "fake"
+
+    def __init__(self, fixture_path=None, seed=None, latency_scale=None, error_rate=None):
+        with open(fixture_path or LLM_FAKE_FIXTURE, encoding="utf-8") as fixture_file:
+            fixture = json.load(fixture_file)
+        self.documents = fixture["documents"]
+        self.latency = fixture.get("latency", {})
+        if error_rate is None:
+            error_rate = LLM_FAKE_ERROR_RATE if LLM_FAKE_ERROR_RATE is not None else fixture.get("error_rate", 0)
+        self.error_rate = float(error_rate)
+        self.error_message = fixture.get("error_message", "Simulated provider error")
+        self.latency_scale = LLM_FAKE_LATENCY_SCALE if latency_scale is None else latency_scale
+        seed = LLM_FAKE_SEED if seed is None else seed
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = {}
+
+    def _document(self, key):
+        if isinstance(key, str):
+            key = key.encode("utf-8")
+        index = int(hashlib.sha256(key).hexdigest(), 16) % len(self.documents)
+        return self.documents[index]
+
+    def _delay(self, spec):
+        distribution = spec.get("distribution", "fixed")
+        if distribution == "uniform":
+            return self.random.uniform(spec["min_ms"], spec["max_ms"])
+        if distribution == "normal":
+            return max(0.0, self.random.gauss(spec["mean_ms"], spec["stddev_ms"]))
+        if distribution == "lognormal":
+            return spec["median_ms"] * self.random.lognormvariate(0, spec.get("sigma", 0.5))
+        return spec.get("ms", 0)
+
+    def _simulate(self, kind):
+        """Sleep for the call's simulated latency, then fail at the configured rate."""
+        with self._lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+            spec = self.latency.get(kind) or self.latency.get("default") or {}
+            delay_ms = self._delay(spec) * self.latency_scale
+            failed = self.random.random() < self.error_rate
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000)
+        if failed:
+            raise FakeLLMError(self.error_message)
+
+    def generate(self, model, prompt, pdf_bytes=None, system_instruction=None, response_schema=None):
+        if pdf_bytes is not None:
+            document = self._document(pdf_bytes)
+        else:
+            document = next(
+                (doc for doc in self.documents if doc["markdown"] and doc["markdown"] in prompt),
+                None,
+            ) or self._document(prompt)
+
+        if response_schema is None:
+            self._simulate("markdown")
+            return document["markdown"]
+
+        # Round-trip through the schema so fixtures are checked like real responses
+        if "markdown" in response_schema.model_fields:
+            self._simulate("document")
+            data = {**document["vendor_fields"], "markdown": document["markdown"]}
+        else:
+            self._simulate("vendor_fields")
+            data = document["vendor_fields"]
+        return json.dumps(response_schema(**data).model_dump())
+
+    def parse(self, model, system_prompt, user_content, response_model):
+        self._simulate("validation")
+        document = self._document(user_content)
+        data = {
+            "invoice_number": _prompt_value(user_content, "Invoice Number"),
+            "invoice_date": _prompt_value(user_content, "Invoice Date") or "",
+            "status": "SUCCESS",
+            "reasoning": "Simulated validation.",
+            **document.get("validation", {}),
+        }
+        if data["status"] == "SUCCESS" and "payload" not in data:
+            data["payload"] = _payload_from_prompt(user_content, data["invoice_number"], data["invoice_date"])
+        return response_model(**data)
+
+
+def _prompt_value(text, label):
+    match = re.search(rf"{label}:\s*(.+)", text)
+    value = match.group(1).strip() if match else None
+    return None if value in (None, "", "N/A") else value
+
+
+def _payload_from_prompt(user_content, invoice_number, invoice_date):
+    """AP invoice payload for the first GRN of a validation prompt (compact GRN table format)."""
+    header = re.search(r"^\s*GRN (DocEntry=.*)$", user_content, re.MULTILINE)
+    if not header:
+        return None
+    fields = dict(re.findall(r"\b(DocEntry|CardCode|BPL_IDAssignedToInvoice)=(\S+)", header.group(1)))
+    if "DocEntry" not in fields or "CardCode" not in fields:
+        return None
+
+    lines = []
+    for row in user_content[header.end():].splitlines():
+        row = row.strip()
+        if row.startswith("GRN "):
+            break
+        cells = row.split("|")
+        if len(cells) >= 5 and cells[0].isdigit():
+            lines.append({"LineNum": int(cells[0]), "RemainingOpenQuantity": float(cells[4] or 0)})
+
+    return {
+        "CardCode": fields["CardCode"],
+        "DocEntry": int(fields["DocEntry"]),
+        "DocDate": invoice_date,
+        "NumAtCard": invoice_number,
+        "BPL_IDAssignedToInvoice": int(fields.get("BPL_IDAssignedToInvoice", 1)),
+        "DocumentLines": lines,
+    }
+
+
+PROVIDER_CLASSES = {
+    "hosted": HostedProvider,
+    "fake": FakeProvider,
+}
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_provider(name=None):
+    """
+    The shared provider for this process (LLM_PROVIDER by default).
+
+    Instances are per process id, so a forked worker (Celery prefork, gunicorn)
+    opens its own connections instead of sharing the parent's sockets.
+    """
+    name = name or LLM_PROVIDER
+    if name not in PROVIDER_CLASSES:
+        raise ValueError(f"Unknown LLM provider '{name}'. Expected one of: {', '.join(PROVIDER_CLASSES)}")
+
+    key = (name, os.getpid())
+    with _providers_lock:
+        provider = _providers.get(key)
+        if provider is None:
+            provider = _providers[key] = PROVIDER_CLASSES[name]()
+            logger.info(f"LLM provider '{name}' initialised for process {os.getpid()}")
+        return provider
+
+
+def reset_providers():
+    """Close and forget every shared provider (next get_provider() builds new clients)."""
+    with _providers_lock:
+        providers = list(_providers.values())
+        _providers.clear()
+    for provider in providers:
+        try:
+            provider.close()
+        except Exception as e:
+            logger.warning(f"Closing LLM provider {provider.name} failed: {e}")
@@ -0,0 +1,160 @@
+"""
+Local extraction of a PDF's embedded text layer.
+
+Digitally generated invoices carry their text, so it can be read in-process
+instead of sending the PDF to Gemini. The result is scored for completeness
+(every page has text, GRN/PO references, dates and amounts are present, the
+text is not garbled by a broken font encoding); only a confident result is
+used, anything else (scanned pages, odd encodings) goes to Gemini as before.
+"""
+import io
+import os
+import re
+import logging
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # optional; without it every PDF is sent to Gemini
+    PdfReader = None
+
+
+logger = logging.getLogger(__name__)
+
+
+PDF_TEXT_FAST_PATH = os.getenv("PDF_TEXT_FAST_PATH", "true").lower() == "true"
+# Minimum completeness score (0-1) for the local text to replace Gemini
+PDF_TEXT_MIN_SCORE = float(os.getenv("PDF_TEXT_MIN_SCORE", "0.85"))
+# Fewer text characters than this marks a page as scanned
+PDF_TEXT_MIN_PAGE_CHARS = 80
+
+SCORE_WEIGHTS = {
+    "text_coverage": 0.35,
+    "references": 0.25,
+    "dates": 0.2,
+    "amounts": 0.1,
+    "clean_text": 0.1,
+}
+
+MONTHS = r"(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*"
+DATE_PATTERN = re.compile(
+    r"\b(?:\d{4}-\d{1,2}-\d{1,2}|\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4}"
+    rf"|\d{{1,2}}[ -]{MONTHS}[ -,]+\d{{2,4}}|{MONTHS} \d{{1,2}},? \d{{4}})\b",
+    re.IGNORECASE,
+)
+REFERENCE_PATTERN = re.compile(
+    r"\b(?:grn|grpo|l?po|p\.o\.?|purchase order|goods receipt)\b[^\n\d]{0,20}\d{3,}",
+    re.IGNORECASE,
+)
+AMOUNT_PATTERN = re.compile(r"\d[\d,]*\.\d{2}\b")
+# Glyphs pypdf emits when a font has no usable unicode mapping
+GARBLED_PATTERN = re.compile(r"\(cid:\d+\)|�")
+COLUMN_GAP = re.compile(r"\s{2,}")
+
+
+def _page_text(page):
+    try:
+        return page.extract_text(extraction_mode="layout") or ""
+    except TypeError:  # pypdf < 3.17 has no layout mode
+        return page.extract_text() or ""
+
+
+def layout_to_markdown(text):
+    """
+    Turn layout-preserving page text into markdown: runs of two or more lines
+    split into three or more columns (by wide gaps) become pipe tables.
+    """
+    output = []
+    table = []
+
+    def flush():
+        if len(table) >= 2:
+            width = max(len(row) for row in table)
+            rows = [row + [""] * (width - len(row)) for row in table]
+            output.append("| " + " | ".join(rows[0]) + " |")
+            output.append("|" + "---|" * width)
+            output.extend("| " + " | ".join(row) + " |" for row in rows[1:])
+        else:
+            output.extend("  ".join(row) for row in table)
+        table.clear()
+
+    for line in text.splitlines():
+        cells = [cell.replace("|", "/") for cell in COLUMN_GAP.split(line.strip()) if cell]
+        if len(cells) >= 3:
+            table.append(cells)
+            continue
+        flush()
+        output.append(" ".join(cells))
+
+    flush()
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(output)).strip()
+
+
+def score_text(pages):
+    """Completeness of the extracted page texts: {"score": 0-1, "checks": {check: 0-1}}."""
+    text = "\n".join(pages)
+    visible = len(re.sub(r"\s", "", text))
+    garbled = sum(len(match) for match in GARBLED_PATTERN.findall(text))
+
+    checks = {
+        "text_coverage": (
+            sum(len(re.sub(r"\s", "", page)) >= PDF_TEXT_MIN_PAGE_CHARS for page in pages) / len(pages)
+            if pages else 0.0
+        ),
+        "references": 1.0 if REFERENCE_PATTERN.search(text) else 0.0,
+        "dates": 1.0 if DATE_PATTERN.search(text) else 0.0,
+        "amounts": 1.0 if AMOUNT_PATTERN.search(text) else 0.0,
+        "clean_text": 1.0 - min(1.0, 20 * garbled / visible) if visible else 0.0,
+    }
+    score = sum(SCORE_WEIGHTS[check] * value for check, value in checks.items())
+    return {"score": round(score, 3), "checks": checks}
+
+
+def extract_pdf_text(pdf_bytes, min_score=None):
+    """
+    Read the PDF's text layer as markdown and score it.
+
+    Returns: dict {status, message, data (markdown or None), score, checks};
+    status is "success" only when the score reaches `min_score`.
+    """
+    min_score = PDF_TEXT_MIN_SCORE if min_score is None else min_score
+    if PdfReader is None:
+        return {
+            "status": "failed",
+            "message": "pypdf is not installed; local text extraction unavailable.",
+            "data": None,
+            "score": 0.0,
+            "checks": {},
+        }
+
+    try:
+        reader = PdfReader(io.BytesIO(pdf_bytes))
+        if reader.is_encrypted:
+            reader.decrypt("")
+        pages = [_page_text(page) for page in reader.pages]
+    except Exception as e:
+        return {
+            "status": "failed",
+            "message": f"Could not read the PDF text layer: {str(e)}",
+            "data": None,
+            "score": 0.0,
+            "checks": {},
+        }
+
+    scored = score_text(pages)
+    markdown_text = "\n\n".join(
+        f"<!-- page {number} -->\n{layout_to_markdown(page)}" for number, page in enumerate(pages, start=1)
+    )
+    if scored["score"] < min_score:
+        return {
+            "status": "failed",
+            "message": f"PDF text layer incomplete (score {scored['score']:.2f} < {min_score:.2f}).",
+            "data": markdown_text,
+            **scored,
+        }
+
+    return {
+        "status": "success",
+        "message": f"PDF text layer extracted locally (score {scored['score']:.2f}).",
+        "data": markdown_text,
+        **scored,
+    }
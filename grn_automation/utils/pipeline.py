@@ -0,0 +1,699 @@
+import os
+import logging
+import threading
+from datetime import datetime, timedelta
+import requests
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from sap_integration.sap_service import SAPService
+from ..models import AutomationStep, GRNAutomation, ValidationResult
+from .ap_invoice.save_ap_invoices import save_validation_results
+from .extraction_and_validation import InvoiceProcessor
+from .grn_mirror import get_open_grns, open_grn_stream, recheck_open_grns
+from .grns import GRN_STREAMING, GRNStream, filter_grn_response
+from .invoice import create_invoice, create_invoices
+from .matcher import matching_grns
+from .stage_graph import critical_path, run_stage_graph
+from .vendor import get_vendor_code_from_api
+
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineStopped(Exception):
+    """Raised by a stage to end the run early; carries the run's result."""
+
+    def __init__(self, result):
+        super().__init__(result.get("message"))
+        self.result = result
+
+
+# Stages that may run at once; 1 runs them one after another
+PIPELINE_CONCURRENCY = int(os.getenv("PIPELINE_CONCURRENCY", "3"))
+
+# A RUNNING automation whose heartbeat is older than this lost its worker
+# (crash, OOM kill, redeploy) and may be resumed. Keep it well above the
+# slowest single stage (LLM extraction with retries).
+PIPELINE_STALE_SECONDS = int(os.getenv("PIPELINE_STALE_SECONDS", "1800"))
+
+# Step and status rows are written one at a time across all stage threads:
+# SQLite takes a single writer, and update_or_create() reads before it writes,
+# which fails with "database is locked" when two threads upgrade at once.
+# Stages still overlap everywhere else (SAP calls, LLM calls, parsing).
+STEP_WRITE_LOCK = threading.Lock()
+
+# Stages in a topological order: the step whose artifact lets a resumed run
+# skip the stage, and the stages it waits for. SAP login overlaps with the
+# extraction, and the GRN re-check with the validation. SAP login and the
+# checks are cheap and always run.
+STAGES = (
+    ("sap_login", None, ()),
+    ("extract", AutomationStep.Step.EXTRACTION, ()),
+    ("check_grn_details", None, ("extract",)),
+    ("fetch_vendor_code", AutomationStep.Step.FETCH_VENDOR_CODE, ("check_grn_details", "sap_login")),
+    ("fetch_open_grns", AutomationStep.Step.FETCH_OPEN_GRN, ("fetch_vendor_code",)),
+    ("filter_and_match", AutomationStep.Step.FILTER_GRN, ("fetch_open_grns",)),
+    ("validate", AutomationStep.Step.VALIDATION, ("filter_and_match",)),
+    ("recheck_grns", None, ("filter_and_match",)),
+    ("book", AutomationStep.Step.BOOKED, ("validate", "recheck_grns")),
+)
+STAGE_GRAPH = {stage: dependencies for stage, _, dependencies in STAGES}
+
+
+class AutomationPipeline:
+    """
+    The upload pipeline for one GRNAutomation: SAP login, extraction, vendor
+    code, open GRNs, filtering/matching, validation and invoice posting.
+
+    Every stage records an AutomationStep. Successful steps keep their output
+    in `AutomationStep.artifact`; a later run of the same automation restores
+    those and restarts from the first step that did not succeed. `run()`
+    returns the result that used to be the upload response body
+    ({"success", "message", ...}).
+    """
+
+    def __init__(self, automation, extractor=None):
+        self.automation = automation
+        # Shared provider: reuses this process's pooled LLM connections
+        self.extractor = extractor or InvoiceProcessor()
+        self.case_type = automation.case_type or GRNAutomation.CaseType.ONE_TO_ONE
+        self.vendor_code = None
+        self.grn_source = None
+        self.restored = []
+
+    # ------------------------------------------------------------------
+    # Bookkeeping
+    # ------------------------------------------------------------------
+
+    def create_step(self, step_name, status, message="", artifact=None):
+        """Record the outcome of a pipeline step; a resumed run overwrites the earlier attempt."""
+        with STEP_WRITE_LOCK:
+            step, _ = AutomationStep.objects.update_or_create(
+                automation=self.automation,
+                step_name=step_name,
+                defaults={"status": status, "message": message, "artifact": artifact},
+            )
+            GRNAutomation.objects.filter(pk=self.automation.pk).update(heartbeat_at=timezone.now())
+        return step
+
+    def checkpoints(self):
+        """Artifacts of the steps that succeeded in an earlier run, by step name."""
+        return dict(
+            self.automation.steps
+            .filter(status=AutomationStep.Status.SUCCESS, artifact__isnull=False)
+            .values_list("step_name", "artifact")
+        )
+
+    def set_status(self, status, completed=False):
+        self.automation.status = status
+        self.automation.heartbeat_at = timezone.now()
+        update_fields = ["status", "heartbeat_at"]
+        if completed:
+            self.automation.completed_at = timezone.now()
+            update_fields.append("completed_at")
+        with STEP_WRITE_LOCK:
+            self.automation.save(update_fields=update_fields)
+
+    def fail(self, step_name, step_message, message=None, **extra):
+        """Record a failed step, mark the automation failed and stop the run."""
+        self.create_step(step_name, AutomationStep.Status.FAILED, step_message)
+        self.set_status(GRNAutomation.Status.FAILED)
+        raise PipelineStopped({"success": False, "message": message or step_message, **extra})
+
+    def update_posting_status(self, invoice_date, posting_status, posting_message, validation_result_id=None,
+                              num_at_card=None):
+        """
+        Update the posting status of one saved validation result.
+
+        Args:
+            invoice_date: Date of the invoice to identify the validation result
+            posting_status: New posting status (pending/posted/failed/unknown)
+            posting_message: Message to store
+            validation_result_id: Optional ID to directly target specific validation result
+            num_at_card: Vendor reference the invoice was sent to SAP with, if known
+        """
+        automation_id = self.automation.id
+        try:
+            # Convert invoice_date string to date object if needed
+            if isinstance(invoice_date, str):
+                invoice_date_obj = datetime.strptime(invoice_date, '%Y-%m-%d').date()
+            else:
+                invoice_date_obj = invoice_date
+
+            # If validation_result_id is provided, use it directly (most reliable)
+            if validation_result_id:
+                validation_result = ValidationResult.objects.filter(
+                    id=validation_result_id,
+                    automation_id=automation_id
+                ).first()
+            else:
+                # Fallback: the first unprocessed record for that invoice date
+                validation_result = ValidationResult.objects.filter(
+                    automation_id=automation_id,
+                    invoice_date=invoice_date_obj,
+                    posting_status=ValidationResult.PostingStatus.PENDING
+                ).first()
+
+            if validation_result:
+                validation_result.posting_status = posting_status
+                validation_result.posting_message = posting_message
+                update_fields = ['posting_status', 'posting_message', 'updated_at']
+                if num_at_card:
+                    validation_result.num_at_card = num_at_card
+                    update_fields.append('num_at_card')
+                validation_result.save(update_fields=update_fields)
+                logger.info(
+                    f"✅ Updated posting status for validation {validation_result.id}: "
+                    f"{posting_status} - {posting_message}"
+                )
+                return True
+
+            logger.warning(
+                f"⚠️ No ValidationResult found for automation {automation_id}, "
+                f"invoice_date {invoice_date_obj}, validation_result_id {validation_result_id}"
+            )
+            return False
+
+        except Exception as e:
+            logger.error(f"❌ Error updating posting status: {str(e)}", exc_info=True)
+            return False
+
+    # ------------------------------------------------------------------
+    # Stages
+    # ------------------------------------------------------------------
+
+    def sap_login(self):
+        """SAP login / VPN check; reuses a pooled session and only logs in if none is still valid."""
+        try:
+            SAPService.ensure_session()
+        except requests.exceptions.RequestException as e:
+            self.fail(AutomationStep.Step.SAP_LOGIN, f"SAP/VPN connection failed. {e}", "SAP/VPN connection failed.")
+        except Exception:
+            logger.exception(f"SAP login error for automation {self.automation.id}")
+            self.fail(AutomationStep.Step.SAP_LOGIN, "SAP login error.")
+
+        self.create_step(
+            AutomationStep.Step.SAP_LOGIN,
+            AutomationStep.Status.SUCCESS,
+            "SAP/VPN connection successful. Logged in to SAP."
+        )
+
+    def extract(self):
+        """Markdown + vendor fields; two LLM calls or one, depending on EXTRACTION_MODE."""
+        field_resp = self.extractor.extract_document(self.automation.file.path)
+        if field_resp["status"] != "success" or not field_resp["data"]:
+            self.fail(AutomationStep.Step.EXTRACTION, field_resp["message"])
+
+        data = field_resp["data"]
+        self.restore_extract(data)
+        logger.info(
+            f"Automation {self.automation.id}: vendor name {self.vendor_name}, "
+            f"vendor code {self.vendor_code}, PO numbers {self.grn_po_number}"
+        )
+
+        self.create_step(
+            AutomationStep.Step.EXTRACTION,
+            AutomationStep.Status.SUCCESS,
+            f"Extraction succeeded ({field_resp['mode']}, {field_resp['elapsed_seconds']}s)",
+            artifact={
+                "markdown": data["markdown"],
+                "vendor_info": data["vendor_info"],
+                "invoices": data["invoices"],
+                "scenario_detected": data["scenario_detected"],
+            }
+        )
+
+    def check_grn_details(self):
+        """Extraction must give something to look GRNs up by; checked on resumed runs too."""
+        if not any([self.vendor_name, self.grn_po_number, self.vendor_code]):
+            self.fail(
+                AutomationStep.Step.GRN_DETAILS,
+                "No vendor name or grn po number or vendor code found.",
+                "Extraction failed: Required fields (vendor_name, vendor_code, po_number) missing"
+            )
+
+    def restore_extract(self, artifact):
+        self.markdown_text = artifact["markdown"]
+        self.vendor_info = artifact["vendor_info"]
+        self.vendor_name = self.vendor_info.get("vendor_name", None)
+        self.grn_po_number = [int(i) for i in self.vendor_info.get("grn_po_number", [])]
+        self.vendor_code = self.vendor_info.get("vendor_code", None)
+        self.invoices = artifact["invoices"]
+        self.scenario = artifact["scenario_detected"]
+
+    def fetch_vendor_code(self):
+        if self.vendor_code:
+            return
+
+        vendor_code_resp = get_vendor_code_from_api(self.vendor_name)
+        if vendor_code_resp["status"] != "success" or not vendor_code_resp.get("data"):
+            self.fail(
+                AutomationStep.Step.FETCH_VENDOR_CODE,
+                vendor_code_resp.get("message", "Vendor code fetch failed"),
+                f"Vendor code fetch failed: {vendor_code_resp.get('message', 'No vendor code returned')}"
+            )
+
+        self.vendor_code = vendor_code_resp["data"]
+        self.create_step(
+            AutomationStep.Step.FETCH_VENDOR_CODE,
+            AutomationStep.Status.SUCCESS,
+            f"Vendor code fetched: {self.vendor_code}",
+            artifact={"vendor_code": self.vendor_code}
+        )
+
+    def restore_fetch_vendor_code(self, artifact):
+        self.vendor_code = artifact["vendor_code"]
+
+    def fetch_open_grns(self):
+        """
+        Only the GRNs referenced on the invoice, from the local mirror when it
+        is fresh; a full vendor scan if any of them is missing.
+        """
+        if GRN_STREAMING:
+            fetch_resp = open_grn_stream(self.vendor_code, self.grn_po_number, projection="matching")
+        else:
+            fetch_resp = get_open_grns(self.vendor_code, self.grn_po_number, projection="matching")
+
+        if fetch_resp["status"] != "success":
+            self.fail(AutomationStep.Step.FETCH_OPEN_GRN, fetch_resp.get("message", "Failed to fetch GRNs"))
+
+        if fetch_resp.get("already_posted", False):
+            self.create_step(AutomationStep.Step.FETCH_OPEN_GRN, AutomationStep.Status.SUCCESS, "GRN already posted.")
+            self.set_status(GRNAutomation.Status.COMPLETED, completed=True)
+            raise PipelineStopped({"success": True, "message": "GRN already posted."})
+
+        self.grn_source = fetch_resp.get("source")
+        self.all_open_grns = fetch_resp["data"]
+        self.grn_stream = self.all_open_grns if isinstance(self.all_open_grns, GRNStream) else None
+
+        if self.grn_stream is None:
+            # A streamed fetch keeps nothing to checkpoint; resuming it fetches again
+            self.create_step(
+                AutomationStep.Step.FETCH_OPEN_GRN,
+                AutomationStep.Status.SUCCESS,
+                f"Found {len(self.all_open_grns)} open GRNs",
+                artifact={"source": self.grn_source, "grns": self.all_open_grns}
+            )
+
+    def restore_fetch_open_grns(self, artifact):
+        self.grn_source = artifact["source"]
+        self.all_open_grns = artifact["grns"]
+        self.grn_stream = None
+
+    def filter_and_match(self):
+        try:
+            grn_stream = self.grn_stream
+            if grn_stream is not None:
+                # GRNs go page by page through filter and match; only matches are kept
+                matched_grns_resp = matching_grns(self.vendor_code, self.grn_po_number, grn_stream.filtered())
+                if grn_stream.error is not None:
+                    self.fail(AutomationStep.Step.FETCH_OPEN_GRN, f"Failed to fetch GRNs: {grn_stream.error}")
+
+                self.create_step(
+                    AutomationStep.Step.FETCH_OPEN_GRN,
+                    AutomationStep.Status.SUCCESS,
+                    f"Found {grn_stream.fetched} open GRNs"
+                )
+                # Nothing was retained to echo back in the result
+                self.all_open_grns = self.filtered_grns = None
+                filtered_count = grn_stream.filtered_count
+            else:
+                self.filtered_grns = [filter_grn_response(grn)["data"] for grn in self.all_open_grns]
+                filtered_count = len(self.filtered_grns)
+
+            if not filtered_count:
+                self.fail(AutomationStep.Step.FILTER_GRN, "No GRNs available after filtering")
+
+            if grn_stream is None:
+                matched_grns_resp = matching_grns(self.vendor_code, self.grn_po_number, self.filtered_grns)
+
+            matched = bool(
+                matched_grns_resp and matched_grns_resp.get("status") == "success" and matched_grns_resp.get("data")
+            )
+            # The filter step only checkpoints once matching has succeeded too
+            self.create_step(
+                AutomationStep.Step.FILTER_GRN,
+                AutomationStep.Status.SUCCESS,
+                f"Filtered {filtered_count} GRNs",
+                artifact={
+                    "source": self.grn_source,
+                    "filtered_grns": self.filtered_grns,
+                    "matched_grns": matched_grns_resp["data"],
+                } if matched else None
+            )
+
+            if not matched:
+                self.fail(
+                    AutomationStep.Step.VALIDATION,
+                    matched_grns_resp.get("message", "No matching GRNs found after filtering"),
+                    matched_grns_resp.get("message", "No matching GRNs found")
+                )
+
+            self.matched_grns = matched_grns_resp["data"]
+
+        except PipelineStopped:
+            raise
+        except Exception as e:
+            logger.error(f"Filtering/Matching failed: {str(e)}", exc_info=True)
+            self.fail(AutomationStep.Step.FILTER_GRN, f"Filtering/Matching failed: {str(e)}", f"Matching failed: {str(e)}")
+
+    def restore_filter_and_match(self, artifact):
+        self.grn_source = artifact["source"]
+        self.filtered_grns = artifact["filtered_grns"]
+        self.matched_grns = artifact["matched_grns"]
+        self.all_open_grns = getattr(self, "all_open_grns", None)
+
+    def validate(self):
+        validation_resp = self.extractor.validate_invoice(
+            self.markdown_text, self.matched_grns, self.invoices, self.scenario
+        )
+
+        if not validation_resp or validation_resp.get("status") != "success" or not validation_resp.get("data"):
+            self.fail(
+                AutomationStep.Step.VALIDATION,
+                validation_resp.get("message", "Validation failed"),
+                f"Validation failed: {validation_resp.get('message', 'No validation data returned')}"
+            )
+
+        validation_results = validation_resp.get("data", {}).get("validation_results", [])
+        if not validation_results:
+            self.fail(AutomationStep.Step.VALIDATION, "No validation results returned", "No validation results found")
+
+        failed_validations = [r for r in validation_results if r.get("status") != "SUCCESS"]
+        if failed_validations:
+            failed_reasons = "; ".join([
+                f"Invoice {r.get('invoice_date', 'unknown')}: {r.get('reasoning', 'No reason')}"
+                for r in failed_validations
+            ])
+            self.fail(AutomationStep.Step.VALIDATION, failed_reasons, f"Validation failed: {failed_reasons}")
+
+        self.validation_results = validation_results
+
+        # Invoices an earlier attempt posted (or may have posted) keep their saved
+        # result, so book() skips them even when validation runs again on resume.
+        # Results of an earlier attempt that were never posted are replaced.
+        settled = {}
+        for result in ValidationResult.objects.filter(
+            automation=self.automation,
+            posting_status__in=[ValidationResult.PostingStatus.POSTED, ValidationResult.PostingStatus.UNKNOWN],
+        ).order_by("id"):
+            settled.setdefault(result.invoice_date.isoformat(), []).append(result.id)
+        settled_ids = [
+            settled[date].pop(0) if settled.get(date) else None
+            for date in (str(result.get("invoice_date")) for result in validation_results)
+        ]
+        ValidationResult.objects.filter(automation=self.automation).exclude(
+            posting_status__in=[ValidationResult.PostingStatus.POSTED, ValidationResult.PostingStatus.UNKNOWN]
+        ).delete()
+
+        to_save = [result for result, settled_id in zip(validation_results, settled_ids) if settled_id is None]
+        saved_ids = []
+        try:
+            save_result = save_validation_results(
+                self.automation.id,
+                {**validation_resp, "data": {**validation_resp["data"], "validation_results": to_save}},
+            )
+            if save_result['success']:
+                logger.info(f"✅ Validation results saved successfully for automation {self.automation.id}")
+                logger.info(f"📊 Summary: {save_result['summary']}")
+                saved_ids = save_result.get('summary', {}).get('validation_result_ids', [])
+                if to_save and not saved_ids:
+                    logger.warning("⚠️ No validation_result_ids returned from save_validation_results")
+            else:
+                logger.error(f"❌ Failed to save validation results: {save_result.get('error')}")
+        except Exception as e:
+            logger.error(f"❌ Error saving validation results: {str(e)}", exc_info=True)
+
+        saved_ids = iter(saved_ids)
+        self.validation_result_ids = [
+            settled_id if settled_id is not None else next(saved_ids, None) for settled_id in settled_ids
+        ]
+
+        self.create_step(
+            AutomationStep.Step.VALIDATION,
+            AutomationStep.Status.SUCCESS,
+            f"Validated {len(validation_results)} invoice(s) successfully",
+            artifact={"validation_results": validation_results, "validation_result_ids": self.validation_result_ids}
+        )
+
+    def restore_validate(self, artifact):
+        self.validation_results = artifact["validation_results"]
+        self.validation_result_ids = artifact["validation_result_ids"]
+
+    def recheck_grns(self):
+        """
+        The mirror can lag SAP by one sync interval, and a GRN snapshot restored
+        from an earlier run may be older still, so make sure the matched GRNs
+        are still open before anything is posted against them.
+        """
+        restored_grns = {"fetch_open_grns", "filter_and_match"} & set(self.restored)
+        if self.grn_source != "mirror" and not restored_grns:
+            return
+        recheck_resp = recheck_open_grns([grn.get("DocEntry") for grn in self.matched_grns])
+        if recheck_resp["status"] != "success":
+            self.fail(AutomationStep.Step.BOOKED, recheck_resp["message"])
+
+    def book(self):
+        """Post one invoice per validation result; several go to SAP in one $batch round trip."""
+        validation_results = self.validation_results
+        invoice_creation_results = []
+        invoice_errors = []
+
+        # A resumed run never posts an invoice a second time, nor one SAP may already have
+        validation_result_ids = list(self.validation_result_ids) + [None] * (len(validation_results) - len(self.validation_result_ids))
+        settled = {
+            result.id: result
+            for result in ValidationResult.objects.filter(
+                id__in=[result_id for result_id in validation_result_ids if result_id],
+                posting_status__in=[ValidationResult.PostingStatus.POSTED, ValidationResult.PostingStatus.UNKNOWN],
+            )
+        }
+        to_post = [idx for idx, result_id in enumerate(validation_result_ids) if result_id not in settled]
+
+        try:
+            if len(to_post) == 1:
+                # CASE 1 (1:1) or CASE 3 (many:1) - Single invoice
+                invoice_resps = [create_invoice(validation_results[to_post[0]].get("payload"), use_dummy=True)]
+            elif to_post:
+                # CASE 2 (1:many) OR CASE 4 (many:many) - results come back in order
+                invoice_resps = create_invoices(
+                    [validation_results[idx].get("payload") for idx in to_post],
+                    use_dummy=True
+                )
+            else:
+                invoice_resps = []
+            invoice_resps = dict(zip(to_post, invoice_resps))
+
+            multiple = len(validation_results) > 1
+            for idx, validation_result in enumerate(validation_results):
+                invoice_date = validation_result.get("invoice_date")
+                validation_result_id = validation_result_ids[idx]
+                label = f"Invoice {idx + 1}" if multiple else "Invoice"
+
+                if validation_result_id in settled:
+                    saved = settled[validation_result_id]
+                    if saved.posting_status == ValidationResult.PostingStatus.UNKNOWN:
+                        invoice_errors.append(f"{label} ({invoice_date}): {saved.posting_message}")
+                    invoice_creation_results.append({
+                        "invoice_date": invoice_date,
+                        "status": "success" if saved.posting_status == ValidationResult.PostingStatus.POSTED else "unknown",
+                        "message": saved.posting_message,
+                        "doc_entry": None,
+                        "validation_result_id": validation_result_id
+                    })
+                    continue
+
+                invoice_resp = invoice_resps[idx]
+                num_at_card = (invoice_resp.get("data") or {}).get("NumAtCard")
+
+                if invoice_resp.get("status") == "success":
+                    doc_entry = invoice_resp.get("data", {}).get("DocEntry")
+                    posting_message = f"{label} created successfully. DocEntry: {doc_entry}"
+                    posting_status = ValidationResult.PostingStatus.POSTED
+                    invoice_creation_results.append({
+                        "invoice_date": invoice_date,
+                        "status": "success",
+                        "message": posting_message,
+                        "doc_entry": doc_entry,
+                        "validation_result_id": validation_result_id
+                    })
+                else:
+                    error_message = invoice_resp.get("message", "Unknown error")
+                    if invoice_resp.get("status") == "unknown":
+                        # SAP may hold this invoice: never post it again without a check
+                        posting_message = error_message
+                        posting_status = ValidationResult.PostingStatus.UNKNOWN
+                    else:
+                        posting_message = f"{label} creation failed: {error_message}"
+                        posting_status = ValidationResult.PostingStatus.FAILED
+                    invoice_errors.append(
+                        f"{label} ({invoice_date}): {error_message}" if multiple else f"Invoice {invoice_date}: {error_message}"
+                    )
+                    invoice_creation_results.append({
+                        "invoice_date": invoice_date,
+                        "status": invoice_resp.get("status", "failed"),
+                        "message": error_message,
+                        "doc_entry": None,
+                        "validation_result_id": validation_result_id
+                    })
+
+                if not self.update_posting_status(
+                    invoice_date, posting_status, posting_message, validation_result_id, num_at_card=num_at_card
+                ):
+                    logger.error(
+                        f"❌ Failed to update posting status for invoice {idx + 1} "
+                        f"(validation_result_id: {validation_result_id})"
+                    )
+
+        except Exception as e:
+            logger.error(f"Unexpected error during invoice creation: {str(e)}", exc_info=True)
+            for validation_result in validation_results:
+                self.update_posting_status(
+                    validation_result.get("invoice_date"),
+                    ValidationResult.PostingStatus.FAILED,
+                    f"Unexpected error: {str(e)}"
+                )
+            self.fail(
+                AutomationStep.Step.BOOKED,
+                f"Unexpected error: {str(e)}",
+                f"Invoice creation error: {str(e)}",
+                automation_status=GRNAutomation.Status.FAILED,
+                error_type=type(e).__name__,
+            )
+
+        if invoice_errors:
+            self.fail(
+                AutomationStep.Step.BOOKED,
+                "; ".join(invoice_errors),
+                f"Invoice creation failed: {'; '.join(invoice_errors)}",
+                automation_status=GRNAutomation.Status.FAILED,
+                invoices_attempted=len(validation_results),
+                invoices_created=len([r for r in invoice_creation_results if r["status"] == "success"]),
+                errors=invoice_errors,
+                invoice_details=invoice_creation_results,
+            )
+
+        if len(invoice_creation_results) == 1:
+            message = f"Invoice created successfully. {invoice_creation_results[0]['message']}"
+        else:
+            message = f"Created {len(invoice_creation_results)} invoices successfully"
+        self.create_step(
+            AutomationStep.Step.BOOKED,
+            AutomationStep.Status.SUCCESS,
+            message,
+            artifact={"invoice_details": invoice_creation_results}
+        )
+        self.invoice_creation_results = invoice_creation_results
+
+    def restore_checkpoints(self):
+        """
+        Restore the stages whose step succeeded in an earlier run, as long as
+        nothing they depend on has to run again. Returns the restored stages.
+        """
+        checkpoints = self.checkpoints()
+        stale = set()
+        for stage, step_name, dependencies in STAGES:
+            if any(dependency in stale for dependency in dependencies):
+                stale.add(stage)
+            elif step_name is None:
+                continue
+            elif step_name in checkpoints:
+                getattr(self, f"restore_{stage}")(checkpoints[step_name])
+                self.restored.append(stage)
+            # A vendor code read off the invoice leaves no step to restore
+            elif not (stage == "fetch_vendor_code" and self.vendor_code):
+                stale.add(stage)
+        return self.restored
+
+    def run_stage(self, stage):
+        try:
+            getattr(self, stage)()
+        finally:
+            if threading.current_thread() is not self.thread:
+                # Stage threads do not outlive the run; neither should their DB connections
+                connection.close()
+
+    def record_timings(self, timings):
+        """Store how long each stage took and which chain of stages bounded the run."""
+        path, path_seconds = critical_path(STAGE_GRAPH, timings)
+        stage_timings = {
+            "stages": {
+                stage: {"started": round(started, 3), "seconds": round(ended - started, 3)}
+                for stage, (started, ended) in timings.items()
+            },
+            "restored": self.restored,
+            "critical_path": path,
+            "critical_path_seconds": round(path_seconds, 3),
+            "wall_seconds": round(max((ended for _, ended in timings.values()), default=0.0), 3),
+            "serial_seconds": round(sum(ended - started for started, ended in timings.values()), 3),
+        }
+        logger.info(
+            f"Automation {self.automation.id} critical path: {' -> '.join(path)} "
+            f"({stage_timings['critical_path_seconds']}s of {stage_timings['serial_seconds']}s stage time)"
+        )
+        self.automation.stage_timings = stage_timings
+        self.automation.save(update_fields=["stage_timings"])
+
+    def run(self):
+        self.set_status(GRNAutomation.Status.RUNNING)
+        self.thread = threading.current_thread()
+        try:
+            timings = run_stage_graph(
+                STAGE_GRAPH, self.run_stage, done=self.restore_checkpoints(), max_workers=PIPELINE_CONCURRENCY
+            )
+        except PipelineStopped as stopped:
+            self.record_timings(stopped.stage_timings)
+            logger.info(f"Automation {self.automation.id} stopped: {stopped.result['message']}")
+            return stopped.result
+        except Exception as e:
+            self.record_timings(getattr(e, "stage_timings", {}))
+            raise
+        self.record_timings(timings)
+
+        self.set_status(GRNAutomation.Status.COMPLETED, completed=True)
+        return {
+            "success": True,
+            "message": f"Your {self.case_type.replace('_', ' ')} automation completed successfully.",
+            "automation_status": self.automation.status,
+            "invoices_created": len(self.invoice_creation_results),
+            "invoice_details": self.invoice_creation_results,
+            "raw_data": self.markdown_text,
+            "vendor_data": self.vendor_info,
+            "all_open_grns": self.all_open_grns,
+            "filtered_grns": self.filtered_grns,
+            "matched_grns": self.matched_grns,
+            "validated_data": [result.get("payload") for result in self.validation_results],
+            "resumed_after": self.restored,
+            "stage_timings": self.automation.stage_timings,
+        }
+
+
+def stale_running():
+    """Filter for RUNNING automations whose worker stopped beating; they can be resumed."""
+    cutoff = timezone.now() - timedelta(seconds=PIPELINE_STALE_SECONDS)
+    return Q(status=GRNAutomation.Status.RUNNING) & (Q(heartbeat_at__lt=cutoff) | Q(heartbeat_at__isnull=True))
+
+
+def run_automation(automation_id, extractor=None):
+    """
+    Run the upload pipeline for a queued automation.
+
+    Returns:
+        dict: {"success": bool, "message": str, ...}; the details of a
+        completed run match what the upload endpoint used to return.
+    """
+    automation = GRNAutomation.objects.filter(id=automation_id).first()
+    if automation is None:
+        return {"success": False, "message": f"Automation {automation_id} not found"}
+    if automation.status != GRNAutomation.Status.PENDING:
+        # A redelivered task must not extract, validate or post a second time
+        return {"success": False, "message": f"Automation {automation_id} is already {automation.status}"}
+
+    try:
+        return AutomationPipeline(automation, extractor=extractor).run()
+    except Exception as e:
+        logger.error(f"Automation {automation_id} crashed: {str(e)}", exc_info=True)
+        automation.status = GRNAutomation.Status.FAILED
+        automation.save(update_fields=["status"])
+        return {"success": False, "message": f"Unexpected error: {str(e)}", "error_type": type(e).__name__}
@@ -0,0 +1,138 @@
+"""
+Field projections for SAP document reads.
+
+Each pipeline stage declares the header and line fields it actually uses, and
+fetchers send the smallest `$select` for that stage. Service Layer (OData v3)
+cannot project inside the DocumentLines collection, so line fields are trimmed
+client-side as soon as a page arrives; the header `$select` still drops the
+large sub-objects (AddressExtension, TaxExtension, ...) on the server.
+"""
+
+
+# Keep DocumentLines exactly as SAP returns them
+ALL_LINE_FIELDS = "*"
+
+
+class Projection:
+    """The header and DocumentLines fields one consumer needs from a document."""
+
+    def __init__(self, name, header, lines=()):
+        self.name = name
+        self.header = tuple(header)
+        self.lines = lines if lines == ALL_LINE_FIELDS else tuple(lines)
+
+    @property
+    def select(self):
+        """Value for the `$select` query option."""
+        fields = list(self.header)
+        if self.lines:
+            fields.append("DocumentLines")
+        return ",".join(fields)
+
+    def apply(self, doc):
+        """Drop every field of `doc` (and its lines) that is not in the projection."""
+        projected = {field: doc[field] for field in self.header if field in doc}
+        if self.lines == ALL_LINE_FIELDS:
+            projected["DocumentLines"] = doc.get("DocumentLines") or []
+        elif self.lines:
+            projected["DocumentLines"] = [
+                {field: line[field] for field in self.lines if field in line}
+                for line in doc.get("DocumentLines") or []
+            ]
+        return projected
+
+    def covers(self, other):
+        """True if every field of `other` is in this projection."""
+        if not set(other.header) <= set(self.header):
+            return False
+        if self.lines == ALL_LINE_FIELDS or not other.lines:
+            return True
+        return other.lines != ALL_LINE_FIELDS and set(other.lines) <= set(self.lines)
+
+    def __repr__(self):
+        return f"Projection({self.name})"
+
+
+GRN_HEADER_MATCHING = (
+    "DocEntry", "DocNum", "DocDate", "CardCode", "CardName", "DocTotal", "DocCurrency",
+    "DocTotalFc", "VatSum", "BPL_IDAssignedToInvoice",
+)
+
+GRN_PROJECTIONS = {
+    # Original select: everything the vendor GRN endpoints have always returned
+    "full": Projection(
+        "full",
+        header=(
+            "DocEntry", "DocNum", "DocDate", "TaxDate", "CreationDate", "UpdateDate",
+            "BPL_IDAssignedToInvoice", "DocTotalFc", "CardCode", "CardName", "DocTotal",
+            "DocTotalSys", "DocCurrency", "VatSum", "AddressExtension", "TaxExtension",
+        ),
+        lines=ALL_LINE_FIELDS,
+    ),
+    # filter_grn_response() + matching_grns()
+    "matching": Projection(
+        "matching",
+        header=GRN_HEADER_MATCHING,
+        lines=(
+            "LineNum", "ItemCode", "ItemDescription", "Quantity", "RemainingOpenQuantity",
+            "UnitPrice", "LineTotal", "TaxAmount", "TaxTotal", "Price", "PriceAfterVAT",
+        ),
+    ),
+    # What the validation prompt is given (matching_grns() output)
+    "validation": Projection(
+        "validation",
+        header=GRN_HEADER_MATCHING,
+        lines=(
+            "LineNum", "ItemCode", "ItemDescription", "Quantity", "RemainingOpenQuantity",
+            "UnitPrice", "LineTotal",
+        ),
+    ),
+    # prepare_invoice_payload()
+    "posting": Projection(
+        "posting",
+        header=("DocEntry", "DocNum", "DocDate", "CardCode", "BPL_IDAssignedToInvoice"),
+        lines=("LineNum", "RemainingOpenQuantity"),
+    ),
+    # Open/closed re-check right before posting
+    "status": Projection(
+        "status",
+        header=("DocEntry", "DocNum", "DocumentStatus", "UpdateDate", "UpdateTime"),
+    ),
+    # Local open-GRN mirror: serves "matching" and narrower, plus sync bookkeeping
+    "mirror": Projection(
+        "mirror",
+        header=GRN_HEADER_MATCHING + ("DocumentStatus", "UpdateDate", "UpdateTime"),
+        lines=(
+            "LineNum", "ItemCode", "ItemDescription", "Quantity", "RemainingOpenQuantity",
+            "UnitPrice", "LineTotal", "TaxAmount", "TaxTotal", "Price", "PriceAfterVAT",
+        ),
+    ),
+}
+
+PURCHASE_INVOICE_PROJECTIONS = {
+    # Looking an invoice up / showing it
+    "lookup": Projection(
+        "lookup",
+        header=(
+            "DocEntry", "DocNum", "DocType", "DocDate", "DocDueDate", "CardCode", "CardName",
+            "NumAtCard", "DocTotal", "VatSum", "DocCurrency", "DocumentStatus",
+            "BPL_IDAssignedToInvoice",
+        ),
+    ),
+    # Confirming what a posted invoice was based on
+    "posting": Projection(
+        "posting",
+        header=("DocEntry", "DocNum", "CardCode", "NumAtCard", "DocTotal"),
+        lines=("LineNum", "BaseType", "BaseEntry", "BaseLine", "Quantity", "LineTotal"),
+    ),
+}
+
+
+def get_projection(name, projections=GRN_PROJECTIONS):
+    """Look a projection up by name; Projection instances are passed through."""
+    if name is None or isinstance(name, Projection):
+        return name
+    try:
+        return projections[name]
+    except KeyError:
+        raise ValueError(f"Unknown projection '{name}'. Expected one of: {', '.join(projections)}")
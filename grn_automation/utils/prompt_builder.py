@@ -0,0 +1,219 @@
+"""
+Per-invoice context for validation prompts.
+
+Instead of the whole markdown and the whole GRN list as indented JSON, each
+validation call gets the markdown sections that mention the invoice, the GRN
+lines that plausibly match its line items, and the GRNs as a compact table.
+Every selection falls back to the full content when nothing matches, so a
+poor match never hides data from the model.
+"""
+import os
+import re
+import json
+import logging
+from datetime import datetime
+
+try:
+    import tiktoken
+except ImportError:  # optional; token counts are estimated without it
+    tiktoken = None
+
+
+logger = logging.getLogger(__name__)
+
+
+VALIDATION_PROMPT_SLICING = os.getenv("VALIDATION_PROMPT_SLICING", "true").lower() == "true"
+# Leading markdown always kept: vendor block, document title, totals header
+MARKDOWN_HEADER_CHARS = 600
+# Not worth slicing when the kept part is nearly the whole document
+MARKDOWN_MIN_SAVING = 0.1
+
+GRN_TABLE_COLUMNS = (
+    "LineNum", "ItemCode", "ItemDescription", "Quantity", "RemainingOpenQuantity", "UnitPrice", "LineTotal",
+)
+GRN_HEADER_FIELDS = (
+    "DocEntry", "DocNum", "GRNDocDate", "DocDate", "CardCode", "CardName", "DocTotal", "DocCurrency",
+    "Tax", "VatSum", "BPL_IDAssignedToInvoice",
+)
+
+_encoding = None
+
+
+def count_tokens(text):
+    """Token count with tiktoken when installed, otherwise a ~4 chars/token estimate."""
+    global _encoding
+    if not text:
+        return 0
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding("o200k_base")
+        return len(_encoding.encode(text))
+    return (len(text) + 3) // 4
+
+
+def _words(text):
+    return {word for word in re.findall(r"[a-z0-9]+", str(text or "").lower()) if len(word) >= 3}
+
+
+def _date_variants(value):
+    if not value or value == "N/A":
+        return set()
+    variants = {value}
+    try:
+        parsed = datetime.strptime(value[:10], "%Y-%m-%d")
+    except ValueError:
+        return variants
+    for fmt in ("%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y", "%d/%m/%y", "%d-%b-%Y", "%d %b %Y", "%d %B %Y", "%b %d, %Y"):
+        variants.add(parsed.strftime(fmt))
+    return variants
+
+
+def _grn_list(grn_data):
+    if isinstance(grn_data, dict):
+        return [grn_data]
+    return list(grn_data or [])
+
+
+def slice_markdown(markdown_text, invoice, grn_data=None):
+    """
+    Keep the header and the blank-line separated blocks that mention this invoice
+    (number, date, GRN numbers or line-item descriptions), plus a heading-only
+    block right before each kept block. Returns the full text if slicing would not help.
+    """
+    blocks = re.split(r"\n\s*\n", markdown_text)
+    if len(blocks) <= 2:
+        return markdown_text
+
+    terms = set()
+    invoice_number = invoice.get("invoice_number")
+    if invoice_number and invoice_number != "N/A":
+        terms.add(str(invoice_number).lower())
+    terms |= {variant.lower() for variant in _date_variants(invoice.get("invoice_date"))}
+    terms |= {str(grn.get("DocNum")).lower() for grn in _grn_list(grn_data) if grn.get("DocNum")}
+    descriptions = [
+        _words(item.get("description"))
+        for item in invoice.get("line_items") or []
+        if isinstance(item, dict) and item.get("description")
+    ]
+
+    keep = set()
+    matched = False
+    header_chars = 0
+    for index, block in enumerate(blocks):
+        if index == 0 or (header_chars is not None and header_chars + len(block) <= MARKDOWN_HEADER_CHARS):
+            keep.add(index)
+            header_chars += len(block)
+            continue
+        header_chars = None
+
+        lowered = block.lower()
+        words = _words(block)
+        if any(term in lowered for term in terms) or any(
+            description and len(description & words) >= min(2, len(description)) for description in descriptions
+        ):
+            keep.add(index)
+            matched = True
+            previous = blocks[index - 1].strip()
+            if previous.startswith("#") and "\n" not in previous:
+                keep.add(index - 1)
+
+    if not matched:
+        return markdown_text
+    sliced = "\n\n".join(block for index, block in enumerate(blocks) if index in keep)
+    if len(sliced) > len(markdown_text) * (1 - MARKDOWN_MIN_SAVING):
+        return markdown_text
+    return sliced
+
+
+def _close(a, b, tolerance):
+    try:
+        return abs(float(a) - float(b)) <= tolerance(float(b))
+    except (TypeError, ValueError):
+        return False
+
+
+def _line_matches(line, item):
+    description = _words(item.get("description"))
+    if description and description & (_words(line.get("ItemDescription")) | _words(line.get("ItemCode"))):
+        return True
+    if item.get("unit_price") and line.get("UnitPrice"):
+        if _close(item["unit_price"], line["UnitPrice"], lambda price: max(0.01, 0.01 * abs(price))):
+            return True
+    if item.get("line_total") and line.get("LineTotal"):
+        if _close(item["line_total"], line["LineTotal"], lambda total: 0.01):
+            return True
+    return False
+
+
+def relevant_grn_lines(grn_data, invoice):
+    """
+    Keep only the GRN lines that plausibly match one of the invoice's line items.
+
+    Each GRN keeps its header; a GRN without any matching line reports how many
+    lines were left out. If no line of any GRN matches, everything is kept.
+    """
+    grns = _grn_list(grn_data)
+    items = [item for item in invoice.get("line_items") or [] if isinstance(item, dict)]
+    if not items:
+        return grns
+
+    selected = []
+    matched_any = False
+    for grn in grns:
+        lines = grn.get("DocumentLines") or []
+        kept = [line for line in lines if any(_line_matches(line, item) for item in items)]
+        matched_any = matched_any or bool(kept)
+        selected.append({**grn, "DocumentLines": kept, "OmittedLines": len(lines) - len(kept)})
+
+    if not matched_any:
+        return grns
+    return selected
+
+
+def _cell(value):
+    if value is None:
+        return ""
+    return str(value).replace("|", "/").replace("\n", " ")
+
+
+def encode_grn_table(grn_data):
+    """Compact text encoding of GRNs: one header line per GRN, then a pipe table of its lines."""
+    parts = []
+    for grn in _grn_list(grn_data):
+        header = " ".join(f"{field}={_cell(grn[field])}" for field in GRN_HEADER_FIELDS if field in grn)
+        parts.append(f"GRN {header}")
+        lines = grn.get("DocumentLines") or []
+        if lines:
+            parts.append("|".join(GRN_TABLE_COLUMNS))
+            parts.extend("|".join(_cell(line.get(column)) for column in GRN_TABLE_COLUMNS) for line in lines)
+        if grn.get("OmittedLines"):
+            parts.append(f"({grn['OmittedLines']} other line(s) do not match this invoice and are omitted)")
+    return "\n".join(parts)
+
+
+def build_validation_context(markdown_text, grn_data, invoice):
+    """
+    Markdown and GRN text for one invoice's validation prompt.
+
+    Returns (markdown_context, grn_context, report); `report` holds the token
+    counts of the full context and of what is actually sent.
+    """
+    full_markdown_tokens = count_tokens(markdown_text)
+    full_grn_tokens = count_tokens(json.dumps(grn_data, indent=2))
+
+    if VALIDATION_PROMPT_SLICING:
+        markdown_context = slice_markdown(markdown_text, invoice, grn_data)
+        grn_context = encode_grn_table(relevant_grn_lines(grn_data, invoice))
+    else:
+        markdown_context = markdown_text
+        grn_context = json.dumps(grn_data, indent=2)
+
+    report = {
+        "invoice_number": invoice.get("invoice_number"),
+        "markdown_tokens_full": full_markdown_tokens,
+        "markdown_tokens_sent": count_tokens(markdown_context),
+        "grn_tokens_full": full_grn_tokens,
+        "grn_tokens_sent": count_tokens(grn_context),
+        "estimated": tiktoken is None,
+    }
+    return markdown_context, grn_context, report
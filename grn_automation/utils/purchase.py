@@ -1,13 +1,11 @@
-import os
 import requests
 import time
 from sap_integration.sap_service import SAPService
+from .projections import PURCHASE_INVOICE_PROJECTIONS, get_projection
 
 
-SERVICE_LAYER_URL = os.getenv("SAP_SERVICE_LAYER_URL", "").rstrip("/")
-
-
-def fetch_purchase_invoice_by_docnum(doc_num, card_code=None, select_fields=None, max_retries=3, retry_delay=2):
+def fetch_purchase_invoice_by_docnum(doc_num, card_code=None, select_fields=None, max_retries=3, retry_delay=2,
+                                     projection=None):
     """
     Fetch a specific Purchase Invoice by DocNum and optionally CardCode from SAP Service Layer.
 
@@ -15,6 +13,8 @@ def fetch_purchase_invoice_by_docnum(doc_num, card_code=None, select_fields=None
         doc_num (str/int): The DocNum of the purchase invoice (e.g., 12342).
         card_code (str, optional): The vendor code (CardCode) for more accurate filtering.
         select_fields (str, optional): Comma-separated list of fields to select.
+        projection (str, optional): Named projection from PURCHASE_INVOICE_PROJECTIONS,
+            used when select_fields is not given.
         max_retries (int): Number of retries for transient errors.
         retry_delay (int): Delay in seconds between retries.
 
@@ -37,21 +37,27 @@ def fetch_purchase_invoice_by_docnum(doc_num, card_code=None, select_fields=None
             "data": None,
         }
 
+    try:
+        projection = None if select_fields else get_projection(projection, PURCHASE_INVOICE_PROJECTIONS)
+    except ValueError as e:
+        return {
+            "status": "failed",
+            "message": str(e),
+            "data": None,
+        }
+    if projection:
+        select_fields = projection.select
+
     # STEP 1: First, let's search by DocNum only to see if the invoice exists
     filter_query_docnum_only = f"DocNum eq {doc_num}"
-    url_debug = f"{SERVICE_LAYER_URL}/PurchaseInvoices?$filter={filter_query_docnum_only}&$select=DocEntry,DocNum,CardCode,CardName&$top=5"
-    
-    headers = {
-        "Cookie": f"B1SESSION={SAPService.session_id}",
-        "Content-Type": "application/json",
-    }
+    url_debug = f"/PurchaseInvoices?$filter={filter_query_docnum_only}&$select=DocEntry,DocNum,CardCode,CardName&$top=5"
 
     try:
         print(f"\n[DEBUG STEP 1] Searching by DocNum only to see what exists...")
         print(f"[DEBUG] URL: {url_debug}")
         
-        resp_debug = requests.get(url_debug, headers=headers, verify=False, timeout=30)
-        resp_debug.raise_for_status()
+        # Pooled session; a 401 is re-authenticated and retried once
+        resp_debug = SAPService.make_request("GET", url_debug, timeout=30)
         debug_data = resp_debug.json()
         
         debug_invoices = debug_data.get("value", [])
@@ -77,7 +83,7 @@ def fetch_purchase_invoice_by_docnum(doc_num, card_code=None, select_fields=None
     else:
         filter_query = f"DocNum eq {doc_num}"
 
-    url = f"{SERVICE_LAYER_URL}/PurchaseInvoices?$filter={filter_query}"
+    url = f"/PurchaseInvoices?$filter={filter_query}"
     
     if select_fields:
         url += f"&$select={select_fields}"
@@ -90,10 +96,9 @@ def fetch_purchase_invoice_by_docnum(doc_num, card_code=None, select_fields=None
             print(f"\n[DEBUG STEP 2] Actual search with filters...")
             print(f"[DEBUG] URL: {url}")
             
-            resp = requests.get(url, headers=headers, verify=False, timeout=30)
+            resp = SAPService.make_request("GET", url, timeout=30)
             print(f"[DEBUG] Response Status: {resp.status_code}")
             
-            resp.raise_for_status()
             response_data = resp.json()
 
             if not isinstance(response_data, dict) or "value" not in response_data:
@@ -125,7 +130,7 @@ def fetch_purchase_invoice_by_docnum(doc_num, card_code=None, select_fields=None
             return {
                 "status": "success",
                 "message": f"Successfully fetched Purchase Invoice with DocNum {doc_num}.",
-                "data": invoices[0],
+                "data": projection.apply(invoices[0]) if projection else invoices[0],
             }
 
         except requests.exceptions.HTTPError as e:
@@ -138,9 +143,10 @@ def fetch_purchase_invoice_by_docnum(doc_num, card_code=None, select_fields=None
                 print(f"[DEBUG] HTTP Error Text: {error_detail[:500]}")
             
             if e.response.status_code == 401:
+                # make_request already re-authenticated once, so the credentials themselves are rejected
                 return {
                     "status": "failed",
-                    "message": f"SAP session expired or invalid. Please re-authenticate.",
+                    "message": "SAP rejected the request even after re-authenticating. Check the SAP credentials.",
                     "data": None,
                 }
             
@@ -0,0 +1,140 @@
+"""
+Cluster-wide rate limiting of LLM calls.
+
+Each provider/model has two token buckets in the database, one for requests
+per minute and one for tokens per minute, shared by every process and worker.
+A call takes one request and its estimated tokens before it is sent; when a
+bucket is short, the caller sleeps until enough has refilled instead of
+sending the request and getting a 429 back.
+"""
+import os
+import re
+import json
+import time
+import random
+import logging
+from django.db import transaction
+from ..models import LLMRateBucket
+from .prompt_builder import count_tokens
+
+
+logger = logging.getLogger(__name__)
+
+
+LLM_RATE_LIMIT_ENABLED = os.getenv("LLM_RATE_LIMIT_ENABLED", "true").lower() == "true"
+# Quotas per "provider:model"; LLM_RATE_LIMITS (JSON, same shape) overrides entries
+DEFAULT_RATE_LIMITS = {
+    "gemini:gemini-2.5-flash": {"rpm": 1000, "tpm": 1000000},
+    "openai:gpt-5": {"rpm": 500, "tpm": 500000},
+}
+# Longest a caller waits for capacity before sending anyway (the provider's
+# retry budget then deals with a 429)
+LLM_RATE_LIMIT_MAX_WAIT_SECONDS = float(os.getenv("LLM_RATE_LIMIT_MAX_WAIT_SECONDS", "300"))
+# Output tokens reserved per call on top of the input estimate
+LLM_RATE_OUTPUT_TOKENS = int(os.getenv("LLM_RATE_OUTPUT_TOKENS", "1000"))
+# Gemini bills each PDF page as an image of about this many tokens
+PDF_TOKENS_PER_PAGE = 258
+MAX_SLEEP_SECONDS = 5.0
+
+PDF_PAGE_PATTERN = re.compile(rb"/Type\s*/Page(?!s)")
+
+
+def _load_limits():
+    limits = {name: dict(limit) for name, limit in DEFAULT_RATE_LIMITS.items()}
+    configured = os.getenv("LLM_RATE_LIMITS")
+    if configured:
+        try:
+            limits.update(json.loads(configured))
+        except ValueError as e:
+            logger.error(f"Ignoring invalid LLM_RATE_LIMITS: {e}")
+    return limits
+
+
+RATE_LIMITS = _load_limits()
+
+
+def estimate_tokens(*texts, pdf_bytes=None):
+    """Input tokens of a call (texts plus an attached PDF) plus the output allowance."""
+    tokens = sum(count_tokens(text) for text in texts if text)
+    if pdf_bytes:
+        tokens += max(1, len(PDF_PAGE_PATTERN.findall(pdf_bytes))) * PDF_TOKENS_PER_PAGE
+    return tokens + LLM_RATE_OUTPUT_TOKENS
+
+
+def _take(name, per_minute, cost):
+    """
+    Take `cost` from the bucket if it holds enough.
+
+    Returns 0 on success, otherwise the seconds until `cost` will be available.
+    """
+    capacity = float(per_minute)
+    refill_per_second = capacity / 60
+    cost = min(float(cost), capacity)  # a call larger than the quota still gets through once full
+
+    with transaction.atomic():
+        now = time.time()
+        bucket, _ = LLMRateBucket.objects.select_for_update().get_or_create(
+            name=name,
+            defaults={
+                "capacity": capacity,
+                "refill_per_second": refill_per_second,
+                "tokens": capacity,
+                "refilled_at": now,
+            },
+        )
+        tokens = min(capacity, bucket.tokens + max(0.0, now - bucket.refilled_at) * refill_per_second)
+        if tokens < cost:
+            return (cost - tokens) / refill_per_second
+
+        # Compare-and-swap on refilled_at: databases without row locks
+        # (sqlite) reject a concurrent update instead of double-spending
+        updated = LLMRateBucket.objects.filter(pk=bucket.pk, refilled_at=bucket.refilled_at).update(
+            capacity=capacity,
+            refill_per_second=refill_per_second,
+            tokens=tokens - cost,
+            refilled_at=now,
+        )
+        return 0.0 if updated else 0.01
+
+
+def acquire(provider, model, tokens=0, max_wait=None):
+    """
+    Block until one request and `tokens` tokens are available for `provider`/`model`.
+
+    Models without a configured quota are not limited. After `max_wait`
+    seconds the call goes ahead regardless. Returns the seconds spent waiting.
+    """
+    limit = RATE_LIMITS.get(f"{provider}:{model}")
+    if not LLM_RATE_LIMIT_ENABLED or not limit:
+        return 0.0
+
+    max_wait = LLM_RATE_LIMIT_MAX_WAIT_SECONDS if max_wait is None else max_wait
+    buckets = []
+    if limit.get("rpm"):
+        buckets.append((f"{provider}:{model}:rpm", limit["rpm"], 1))
+    if limit.get("tpm") and tokens:
+        buckets.append((f"{provider}:{model}:tpm", limit["tpm"], tokens))
+
+    started = time.time()
+    for name, per_minute, cost in buckets:
+        while True:
+            try:
+                wait = _take(name, per_minute, cost)
+            except Exception as e:
+                # A broken limiter must not stop LLM calls
+                logger.warning(f"Rate limiter unavailable for {name}: {e}")
+                return time.time() - started
+            if not wait:
+                break
+
+            waited = time.time() - started
+            if waited >= max_wait:
+                logger.warning(f"Waited {waited:.1f}s for {name}; sending without capacity")
+                return waited
+            # Jitter keeps waiting workers from retrying in lockstep
+            time.sleep(min(wait, MAX_SLEEP_SECONDS, max_wait - waited) * random.uniform(1.0, 1.1))
+
+    waited = time.time() - started
+    if waited >= 1:
+        logger.info(f"Waited {waited:.1f}s for {provider}:{model} rate limit capacity")
+    return waited
@@ -0,0 +1,96 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+def run_stage_graph(graph, run_stage, done=(), max_workers=1, clock=time.monotonic):
+    """
+    Run the stages of a dependency graph, each as soon as its dependencies finish.
+
+    Args:
+        graph: {stage: (dependencies, ...)}, listed in a topological order
+        run_stage: callable running one stage by name
+        done: stages that count as finished without running
+        max_workers: stages run at once; 1 runs them in order on this thread
+
+    Returns:
+        dict: {stage: (started, finished)} in seconds from the start of the run
+
+    A failing stage stops new stages from starting. Stages already running
+    are let finish, then the error of the earliest listed failed stage is
+    raised; the timings so far are on the exception as `stage_timings`.
+    """
+    order = list(graph)
+    finished = set(done)
+    timings = {}
+    errors = {}
+    start = clock()
+
+    def timed(stage):
+        started = clock() - start
+        try:
+            run_stage(stage)
+        finally:
+            timings[stage] = (started, clock() - start)
+
+    waiting = [stage for stage in order if stage not in finished]
+    try:
+        if max_workers <= 1:
+            for stage in waiting:
+                timed(stage)
+            return timings
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pipeline-stage") as executor:
+            running = {}
+            while waiting or running:
+                if not errors:
+                    for stage in [s for s in waiting if all(dep in finished for dep in graph[s])]:
+                        waiting.remove(stage)
+                        running[executor.submit(timed, stage)] = stage
+                if not running:
+                    break
+                completed, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    stage = running.pop(future)
+                    try:
+                        future.result()
+                        finished.add(stage)
+                    except Exception as e:
+                        errors[stage] = e
+
+        if errors:
+            raise errors[min(errors, key=order.index)]
+        if waiting:
+            raise ValueError(f"Stages {waiting} depend on stages that are not in the graph")
+        return timings
+    except Exception as e:
+        e.stage_timings = timings
+        raise
+
+
+def critical_path(graph, timings):
+    """
+    The chain of dependent stages that bounded the run: the path through
+    `graph` with the largest total duration, counting only stages that ran.
+
+    Returns:
+        tuple: ([stage, ...], seconds)
+    """
+    path_seconds = {}
+    previous = {}
+    for stage in graph:
+        if stage not in timings:
+            continue
+        started, ended = timings[stage]
+        before = max((dep for dep in graph[stage] if dep in path_seconds), key=path_seconds.get, default=None)
+        path_seconds[stage] = (ended - started) + (path_seconds[before] if before else 0.0)
+        previous[stage] = before
+
+    if not path_seconds:
+        return [], 0.0
+    stage = max(path_seconds, key=path_seconds.get)
+    seconds = path_seconds[stage]
+    path = []
+    while stage:
+        path.append(stage)
+        stage = previous[stage]
+    return path[::-1], seconds
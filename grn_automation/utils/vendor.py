@@ -1,31 +1,310 @@
 import os, re, json
+import logging
+import threading
+import unicodedata
+from collections import Counter
+from datetime import timedelta
+from difflib import SequenceMatcher
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
 from sap_integration.sap_service import SAPService
+from ..models import VendorMaster
+from .grns import next_link_endpoint
 import requests
 
 
-SERVICE_LAYER_URL = os.getenv("SAP_SERVICE_LAYER_URL", "").rstrip("/")
+logger = logging.getLogger(__name__)
+
+
+# Supplier master refresh from SAP: entries older than the TTL are reloaded,
+# and a lookup miss reloads on demand (at most once per cooldown).
+VENDOR_CACHE_TTL_SECONDS = int(os.getenv("VENDOR_CACHE_TTL_SECONDS", "21600"))
+VENDOR_REFRESH_COOLDOWN_SECONDS = int(os.getenv("VENDOR_REFRESH_COOLDOWN_SECONDS", "60"))
+# Minimum confidence (0-1) for a fuzzy name match to be accepted
+VENDOR_MATCH_THRESHOLD = float(os.getenv("VENDOR_MATCH_THRESHOLD", "0.8"))
+# A runner-up this close to the best match makes the match ambiguous
+VENDOR_AMBIGUITY_MARGIN = 0.03
+VENDOR_CANDIDATES = 50
+VENDOR_PAGE_SIZE = 500
+# How long a forced refresh waits for a sync another thread already started
+VENDOR_SYNC_WAIT_SECONDS = int(os.getenv("VENDOR_SYNC_WAIT_SECONDS", "120"))
+
+# Legal-form words that vary between invoices and the supplier master
+LEGAL_SUFFIXES = {
+    "llc", "ltd", "limited", "inc", "co", "company", "corp", "corporation", "plc",
+    "est", "establishment", "wll", "fze", "fzco", "fzc", "jsc", "spc", "pvt", "pte",
+}
+
+
+def normalize_vendor_name(name):
+    """Lower-case, strip accents/punctuation/legal-form words and collapse whitespace."""
+    if not name:
+        return ""
+    name = unicodedata.normalize("NFKD", str(name))
+    name = "".join(ch for ch in name if not unicodedata.combining(ch)).lower()
+    name = name.replace("&", " and ")
+    # "l.l.c" / "w.l.l" -> "llc" / "wll" before punctuation becomes whitespace
+    name = re.sub(r"\b(?:[a-z]\.){2,}[a-z]?\b", lambda m: m.group(0).replace(".", ""), name)
+    name = re.sub(r"[^\w\s]", " ", name)
+    tokens = [token for token in name.split() if token not in LEGAL_SUFFIXES]
+    return " ".join(tokens)
+
+
+def trigrams(normalized):
+    padded = f"  {normalized} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def name_similarity(a, b):
+    """Confidence (0-1) that two normalized names are the same supplier."""
+    if not a or not b:
+        return 0.0
+    if a == b:
+        return 1.0
+    grams_a, grams_b = trigrams(a), trigrams(b)
+    dice = 2 * len(grams_a & grams_b) / (len(grams_a) + len(grams_b))
+    token_sort = SequenceMatcher(None, " ".join(sorted(a.split())), " ".join(sorted(b.split()))).ratio()
+    return round((dice + token_sort) / 2, 4)
+
+
+class VendorMasterUnavailable(RuntimeError):
+    """The supplier master has never been loaded and SAP could not be reached to load it."""
+
+
+class VendorIndex:
+    """In-memory supplier lookup: exact normalized name plus a trigram index for fuzzy matches."""
+
+    def __init__(self, vendors, synced_at=None):
+        self.synced_at = synced_at
+        self.vendors = []
+        self.by_name = {}
+        self.by_trigram = {}
+        for card_code, card_name, normalized in vendors:
+            position = len(self.vendors)
+            self.vendors.append((card_code, card_name, normalized))
+            self.by_name.setdefault(normalized, []).append(position)
+            for gram in trigrams(normalized):
+                self.by_trigram.setdefault(gram, []).append(position)
+
+    def __len__(self):
+        return len(self.vendors)
+
+    def search(self, name, limit=5):
+        """Best matches for `name` as a list of (confidence, card_code, card_name), best first."""
+        normalized = normalize_vendor_name(name)
+        if not normalized:
+            return []
+
+        exact = self.by_name.get(normalized)
+        if exact:
+            return [(1.0, self.vendors[i][0], self.vendors[i][1]) for i in exact][:limit]
+
+        shared = Counter()
+        for gram in trigrams(normalized):
+            shared.update(self.by_trigram.get(gram, ()))
+
+        scored = []
+        for position, _ in shared.most_common(VENDOR_CANDIDATES):
+            card_code, card_name, candidate = self.vendors[position]
+            scored.append((name_similarity(normalized, candidate), card_code, card_name))
+        scored.sort(key=lambda match: match[0], reverse=True)
+        return scored[:limit]
+
+
+_index = None
+_index_lock = threading.Lock()
+_last_refresh_at = None
+# Cleared while a sync_vendor_master() started by get_vendor_index() is running
+_sync_idle = threading.Event()
+_sync_idle.set()
+
+
+def sync_vendor_master():
+    """
+    Reload every supplier from SAP BusinessPartners into VendorMaster.
+
+    Every page is read before anything is written, so a sync that stops
+    partway leaves the stored master (and its synced_at) untouched.
+    Suppliers no longer returned by SAP are removed.
+    Returns: dict {status, message, data}
+    """
+    global _last_refresh_at
+    started = timezone.now()
+    _last_refresh_at = started
+    endpoint = "/BusinessPartners?$filter=CardType eq 'cSupplier'&$select=CardCode,CardName&$orderby=CardCode"
+    rows = []
+
+    try:
+        while endpoint:
+            resp = SAPService.get(endpoint, headers={"Prefer": f"odata.maxpagesize={VENDOR_PAGE_SIZE}"})
+            body = resp.json()
+            rows.extend(
+                VendorMaster(
+                    card_code=partner["CardCode"],
+                    card_name=partner.get("CardName") or "",
+                    normalized_name=normalize_vendor_name(partner.get("CardName"))[:255],
+                    synced_at=started,
+                )
+                for partner in body.get("value", [])
+                if partner.get("CardCode")
+            )
+            endpoint = next_link_endpoint(body)
+    except requests.exceptions.RequestException as e:
+        return {
+            "status": "failed",
+            "message": f"Request error while refreshing vendors: {str(e)}",
+            "data": None,
+        }
+
+    with transaction.atomic():
+        VendorMaster.objects.bulk_create(
+            rows,
+            batch_size=VENDOR_PAGE_SIZE,
+            update_conflicts=True,
+            unique_fields=["card_code"],
+            update_fields=["card_name", "normalized_name", "synced_at"],
+        )
+        removed, _ = VendorMaster.objects.filter(synced_at__lt=started).delete()
+    return {
+        "status": "success",
+        "message": f"Vendor master refreshed: {len(rows)} supplier(s), {removed} removed.",
+        "data": {"saved": len(rows), "removed": removed},
+    }
+
+
+def get_vendor_index(force_refresh=False):
+    """
+    The process-wide VendorIndex, rebuilt when the stored vendor master changes.
+
+    The master is refreshed from SAP first when `force_refresh` is set, or
+    when it is empty or older than VENDOR_CACHE_TTL_SECONDS and no refresh
+    was tried within the cooldown (so an unreachable SAP is not asked for
+    the whole supplier list on every lookup).
+
+    Only one refresh runs at a time and it runs outside `_index_lock`, so
+    lookups keep being served from the current index while SAP pages in.
+    A forced refresh that finds one already running waits for it instead of
+    starting another.
+    """
+    with _index_lock:
+        synced_at = VendorMaster.objects.aggregate(latest=Max("synced_at"))["latest"]
+        expired = synced_at is None or timezone.now() - synced_at > timedelta(seconds=VENDOR_CACHE_TTL_SECONDS)
+        wanted = force_refresh or (expired and _refresh_allowed())
+        leader = wanted and _sync_idle.is_set()
+        if leader:
+            _sync_idle.clear()
+
+    if leader:
+        try:
+            result = sync_vendor_master()
+            if result["status"] != "success":
+                logger.warning(result["message"])
+        finally:
+            _sync_idle.set()
+    elif force_refresh:
+        _sync_idle.wait(VENDOR_SYNC_WAIT_SECONDS)
+
+    return _current_index()
+
+
+def _current_index():
+    global _index
+    with _index_lock:
+        synced_at = VendorMaster.objects.aggregate(latest=Max("synced_at"))["latest"]
+        if _index is None or _index.synced_at != synced_at:
+            _index = VendorIndex(
+                VendorMaster.objects.values_list("card_code", "card_name", "normalized_name"),
+                synced_at=synced_at,
+            )
+        return _index
+
+
+def _refresh_allowed():
+    if _last_refresh_at is None:
+        return True
+    return timezone.now() - _last_refresh_at > timedelta(seconds=VENDOR_REFRESH_COOLDOWN_SECONDS)
+
+
+def resolve_vendor(vendor_name, threshold=None):
+    """
+    Resolve an extracted vendor name to an SAP CardCode from the local supplier index.
+
+    Exact normalized names score 1.0; otherwise the best trigram/token match
+    is accepted when it reaches `threshold` and is not tied with a different
+    supplier. A miss refreshes the index from SAP once and retries.
+    Raises VendorMasterUnavailable while no supplier has been loaded yet.
+    Returns: dict {status, message, data (CardCode or None), confidence, matches}
+    """
+    threshold = VENDOR_MATCH_THRESHOLD if threshold is None else threshold
+    index = get_vendor_index()
+    if not len(index):
+        # An empty master means SAP has not been reachable yet, not that the supplier is unknown
+        raise VendorMasterUnavailable("The supplier master is empty; SAP has not been reachable to load it.")
+    matches = index.search(vendor_name)
+
+    if (not matches or matches[0][0] < threshold) and _refresh_allowed():
+        logger.info(f"No confident vendor match for '{vendor_name}'; refreshing the supplier index")
+        index = get_vendor_index(force_refresh=True)
+        matches = index.search(vendor_name)
+
+    candidates = [
+        {"card_code": card_code, "card_name": card_name, "confidence": confidence}
+        for confidence, card_code, card_name in matches
+    ]
+    if not matches or matches[0][0] < threshold:
+        best = f" Closest: '{matches[0][2]}' ({matches[0][0]:.2f})." if matches else ""
+        return {
+            "status": "failed",
+            "message": f"No vendor found with name '{vendor_name}'.{best}",
+            "data": None,
+            "confidence": matches[0][0] if matches else 0.0,
+            "matches": candidates,
+        }
+
+    confidence, card_code, card_name = matches[0]
+    runner_up = next((match for match in matches[1:] if match[1] != card_code), None)
+    if runner_up and confidence - runner_up[0] < VENDOR_AMBIGUITY_MARGIN:
+        return {
+            "status": "failed",
+            "message": (
+                f"Vendor name '{vendor_name}' is ambiguous: '{card_name}' ({card_code}) "
+                f"and '{runner_up[2]}' ({runner_up[1]}) match equally well."
+            ),
+            "data": None,
+            "confidence": confidence,
+            "matches": candidates,
+        }
+
+    return {
+        "status": "success",
+        "message": f"Vendor code resolved for '{vendor_name}' as '{card_name}' (confidence {confidence:.2f}).",
+        "data": card_code,
+        "confidence": confidence,
+        "matches": candidates,
+    }
 
 
 def get_vendor_code_from_api(vendor_name):
     """
     Fetch vendor code from SAP B1 using the Service Layer.
     Returns a structured response with status, message, and data.
+
+    Names are resolved against the local supplier index (see resolve_vendor());
+    SAP is only queried directly if the index cannot be loaded.
     """
     try:
-        SAPService.ensure_session()
+        return resolve_vendor(vendor_name)
+    except Exception as e:
+        logger.warning(f"Vendor index unavailable, querying SAP directly: {e}")
 
-        url = f"{SERVICE_LAYER_URL}/BusinessPartners"
+    try:
         params = {
             "$filter": f"CardType eq 'cSupplier' and CardName eq '{vendor_name}'",
             "$select": "CardCode,CardName",
         }
-        headers = {
-            "Cookie": f"B1SESSION={SAPService.session_id}",
-            "Content-Type": "application/json",
-        }
 
-        resp = requests.get(url, params=params, headers=headers, verify=False, timeout=15)
-        resp.raise_for_status()
+        resp = SAPService.get("/BusinessPartners", params=params)
 
         data = resp.json().get("value", [])
         if not data:
@@ -55,5 +334,3 @@ def get_vendor_code_from_api(vendor_name):
             "message": f"Unexpected error: {str(e)}",
             "data": None,
         }
-
-
@@ -2,32 +2,31 @@ import os
 import logging
 import requests
 from rest_framework import status
+from django.urls import reverse
+from django.db.models import Q
 from django.utils import timezone
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from .models import GRNAutomation, AutomationStep, ValidationResult
+from .models import GRNAutomation, ValidationResult
 from .serializers import AutomationUploadSerializer, GRNAutomationSerializer, VendorCodeSerializer, GRNMatchRequestSerializer, TotalStatsSerializer, CaseTypeStatsSerializer, ValidationResultSerializer, ValidationResultListSerializer, ValidationResultUpdateSerializer
 from rest_framework.generics import RetrieveAPIView, ListAPIView
-from .utils.vendor import get_vendor_code_from_api
-from .utils.grns import fetch_grns_for_vendor, filter_grn_response
+from .utils.grns import filter_grn_response
+from .utils.grn_mirror import get_open_grns
 from .utils.matcher import matching_grns
 from .utils.invoice import create_invoice
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from .pagination import TenResultsSetPagination
 from sap_integration.sap_service import SAPService 
 from .services import get_total_stats, get_case_type_stats
-from .utils.extraction_and_validation import InvoiceProcessor
+from .tasks import process_grn_automation
+from .utils.pipeline import stale_running
 from .utils.purchase import fetch_purchase_invoice_by_docnum
-from grn_automation.utils.ap_invoice.save_ap_invoices import save_validation_results
 from django.shortcuts import get_object_or_404
 
 
 logger = logging.getLogger(__name__)
 
 
-SERVICE_LAYER_URL = os.getenv("SAP_SERVICE_LAYER_URL", "").rstrip("/")
-
-
 class UserAutomationDetailView(RetrieveAPIView):
     """
     Retrieve details of a single automation job.
@@ -60,78 +59,20 @@ class UserAutomationListView(ListAPIView):
     
 
 class BaseAutomationUploadView(APIView):
-    permission_classes = [IsAuthenticated]
+    """
+    Accept a PDF and queue its automation.
 
-    def create_step(self, automation, step_name, status, message=""):
-        """Helper method to create a new automation step."""
-        return AutomationStep.objects.create(
-            automation=automation,
-            step_name=step_name,
-            status=status,
-            message=message
-        )
-    
-    def update_posting_status(self, automation_id, invoice_date, posting_status, posting_message, validation_result_id=None):
-        """
-        Helper method to update posting status for a specific validation result.
-        
-        Args:
-            automation_id: ID of the automation
-            invoice_date: Date of the invoice to identify the validation result
-            posting_status: New posting status (pending/posted/failed)
-            posting_message: Message to store
-            validation_result_id: Optional ID to directly target specific validation result
-        """
-        try:
-            from datetime import datetime
-            
-            # Convert invoice_date string to date object if needed
-            if isinstance(invoice_date, str):
-                invoice_date_obj = datetime.strptime(invoice_date, '%Y-%m-%d').date()
-            else:
-                invoice_date_obj = invoice_date
-            
-            # If validation_result_id is provided, use it directly (most reliable)
-            if validation_result_id:
-                validation_result = ValidationResult.objects.filter(
-                    id=validation_result_id,
-                    automation_id=automation_id
-                ).first()
-            else:
-                # Fallback: Find by invoice_date and posting_status='pending'
-                # This ensures we update unprocessed records
-                validation_result = ValidationResult.objects.filter(
-                    automation_id=automation_id,
-                    invoice_date=invoice_date_obj,
-                    posting_status=ValidationResult.PostingStatus.PENDING
-                ).first()
-            
-            if validation_result:
-                validation_result.posting_status = posting_status
-                validation_result.posting_message = posting_message
-                validation_result.save(update_fields=['posting_status', 'posting_message', 'updated_at'])
-                logger.info(
-                    f"✅ Updated posting status for validation {validation_result.id}: "
-                    f"{posting_status} - {posting_message}"
-                )
-                return True
-            else:
-                logger.warning(
-                    f"⚠️ No ValidationResult found for automation {automation_id}, "
-                    f"invoice_date {invoice_date_obj}, validation_result_id {validation_result_id}"
-                )
-                return False
-                
-        except Exception as e:
-            logger.error(f"❌ Error updating posting status: {str(e)}", exc_info=True)
-            return False
+    The pipeline (SAP login, extraction, GRN matching, validation, posting)
+    runs in a Celery worker; the response is 202 with the automation ID and
+    clients poll `automation-details/<id>/` for its steps and status.
+    """
+    permission_classes = [IsAuthenticated]
 
     def post(self, request, *args, **kwargs):
         if isinstance(request.data, dict):
             data = request.data
         else:
             data = request.data.dict()
-        print(self.case_type)
 
         serializer = AutomationUploadSerializer(
             data=data,
@@ -141,583 +82,31 @@ class BaseAutomationUploadView(APIView):
             }
         )
 
-        if serializer.is_valid():
-            automation = serializer.save() 
-            automation.file.close()
-
-            # Mark automation as running
-            automation.status = GRNAutomation.Status.RUNNING
-            automation.save(update_fields=["status"])
-
-            # ---------- SAP Login / VPN Check ----------
-            try:
-                SAPService.login()
-                self.create_step(
-                    automation=automation,
-                    step_name=AutomationStep.Step.SAP_LOGIN,
-                    status=AutomationStep.Status.SUCCESS,
-                    message="SAP/VPN connection successful. Logged in to SAP."
-                )
-            except requests.exceptions.RequestException as e:
-                self.create_step(
-                    automation=automation,
-                    step_name=AutomationStep.Step.SAP_LOGIN,
-                    status=AutomationStep.Status.FAILED,
-                    message=f"SAP/VPN connection failed. {e}"
-                )
-
-                automation.status = GRNAutomation.Status.FAILED
-                automation.save(update_fields=["status"])
-
-                return Response(
-                    {"success": False, "message": "SAP/VPN connection failed."},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-            except Exception as e:
-                self.create_step(
-                    automation=automation,
-                    step_name=AutomationStep.Step.SAP_LOGIN,
-                    status=AutomationStep.Status.FAILED,
-                    message="SAP login error."
-                )
-
-                automation.status = GRNAutomation.Status.FAILED
-                automation.save(update_fields=["status"])
-
-                return Response(
-                    {"success": False, "message": "SAP login error."},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-
-            file_path = automation.file.path
-            openai_api_key = os.getenv("OPENAI_API_KEY")
-            extractor = InvoiceProcessor(api_key=openai_api_key)
-
-            # ---------- Extract Markdown ----------
-            markdown_resp = extractor.extract_complete_markdown(file_path)
-            if markdown_resp["status"] != "success" or not markdown_resp["data"]:
-                self.create_step(
-                    automation=automation,
-                    step_name=AutomationStep.Step.EXTRACTION,
-                    status=AutomationStep.Status.FAILED,
-                    message=f"Markdown extraction failed: {markdown_resp['message']}"
-                )
-                
-                automation.status = GRNAutomation.Status.FAILED
-                automation.save(update_fields=["status"])
-                return Response({
-                    "success": False,
-                    "message": f"Markdown extraction failed: {markdown_resp['message']}"
-                }, status=status.HTTP_400_BAD_REQUEST)
-
-            markdown_text = markdown_resp["data"]
-            print("Markdown")
-            print(markdown_text)
-
-            # ---------- Extract Vendor Fields ----------
-            field_resp = extractor.extract_vendor_fields(markdown_text)
-            if field_resp["status"] != "success" or not field_resp["data"]:
-                self.create_step(
-                    automation=automation,
-                    step_name=AutomationStep.Step.EXTRACTION,
-                    status=AutomationStep.Status.FAILED,
-                    message=f"Vendor field extraction failed: {field_resp['message']}"
-                )
-                
-                automation.status = GRNAutomation.Status.FAILED
-                automation.save(update_fields=["status"])
-                return Response({
-                    "success": False,
-                    "message": f"Vendor field extraction failed: {field_resp['message']}"
-                }, status=status.HTTP_400_BAD_REQUEST)
-            
-            print("Vendor Details")
-            print(field_resp)
-
-            vendor_info = field_resp["data"]["vendor_info"]
-            vendor_name = vendor_info.get("vendor_name", None)
-            grn_po_number = [int(i) for i in vendor_info.get("grn_po_number", [])]
-            vendor_code = vendor_info.get("vendor_code", None)
-            invoices = field_resp["data"]["invoices"]
-            scenario = field_resp["data"]["scenario_detected"]
-
-            print(f"Vendor Name: {vendor_name}, Vendor Code: {vendor_code}, PO Number: {grn_po_number}")
-
-            # ---------- Extraction Step SUCCESS ----------
-            self.create_step(
-                automation=automation,
-                step_name=AutomationStep.Step.EXTRACTION,
-                status=AutomationStep.Status.SUCCESS,
-                message="Extraction succeeded via OpenAI"
-            )
-
-            if not any([vendor_name, grn_po_number, vendor_code]):
-                self.create_step(
-                    automation=automation,
-                    step_name=AutomationStep.Step.GRN_DETAILS,
-                    status=AutomationStep.Status.FAILED,
-                    message="No vendor name or grn po number or vendor code found."
-                )
-
-                automation.status = GRNAutomation.Status.FAILED
-                automation.save(update_fields=["status"])
-                return Response({
-                    "success": False,
-                    "message": "Extraction failed: Required fields (vendor_name, vendor_code, po_number) missing"
-                }, status=status.HTTP_400_BAD_REQUEST)
-
-            # ---------- Fetch Vendor Code ----------
-            if not vendor_code:
-                vendor_code_resp = get_vendor_code_from_api(vendor_name)
-                print(f"Vendor Code Response: {vendor_code_resp}")
-
-                if vendor_code_resp["status"] != "success" or not vendor_code_resp.get("data"):
-                    self.create_step(
-                        automation=automation,
-                        step_name=AutomationStep.Step.FETCH_VENDOR_CODE,
-                        status=AutomationStep.Status.FAILED,
-                        message=vendor_code_resp.get("message", "Vendor code fetch failed")
-                    )
-
-                    automation.status = GRNAutomation.Status.FAILED
-                    automation.save(update_fields=["status"])
-
-                    return Response({
-                        "success": False,
-                        "message": f"Vendor code fetch failed: {vendor_code_resp.get('message', 'No vendor code returned')}"
-                    }, status=status.HTTP_400_BAD_REQUEST)
-
-                vendor_code = vendor_code_resp["data"]
-                self.create_step(
-                    automation=automation,
-                    step_name=AutomationStep.Step.FETCH_VENDOR_CODE,
-                    status=AutomationStep.Status.SUCCESS,
-                    message=f"Vendor code fetched: {vendor_code}"
-                )
-
-            # ---------- Fetch GRNs ----------
-            fetch_resp = fetch_grns_for_vendor(vendor_code)
-
-            if fetch_resp["status"] != "success":
-                self.create_step(
-                    automation=automation,
-                    step_name=AutomationStep.Step.FETCH_OPEN_GRN,
-                    status=AutomationStep.Status.FAILED,
-                    message=fetch_resp.get("message", "Failed to fetch GRNs")
-                )
-                
-                automation.status = GRNAutomation.Status.FAILED
-                automation.save(update_fields=["status"])
-                return Response(
-                    {"success": False, "message": fetch_resp.get("message", "Failed to fetch GRNs")},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-
-            # Check if GRNs are already posted
-            if fetch_resp.get("already_posted", False):
-                self.create_step(
-                    automation=automation,
-                    step_name=AutomationStep.Step.FETCH_OPEN_GRN,
-                    status=AutomationStep.Status.SUCCESS,
-                    message="GRN already posted."
-                )
-                
-                automation.status = GRNAutomation.Status.SUCCESS
-                automation.save(update_fields=["status"])
-                return Response(
-                    {"success": True, "message": "GRN already posted."},
-                    status=status.HTTP_200_OK
-                )
-
-            all_open_grns = fetch_resp["data"]
-            self.create_step(
-                automation=automation,
-                step_name=AutomationStep.Step.FETCH_OPEN_GRN,
-                status=AutomationStep.Status.SUCCESS,
-                message=f"Found {len(all_open_grns)} open GRNs"
-            )
-
-            print("Open GRNs")
-            print(all_open_grns)
-
-            # ---------- Filter + Matching ----------
-            try:
-                filtered_grns = [filter_grn_response(grn)["data"] for grn in all_open_grns]
-                print("Filter")
-                print(filtered_grns)
-                
-                if not filtered_grns:
-                    self.create_step(
-                        automation=automation,
-                        step_name=AutomationStep.Step.FILTER_GRN,
-                        status=AutomationStep.Status.FAILED,
-                        message="No GRNs available after filtering"
-                    )
-                    
-                    automation.status = GRNAutomation.Status.FAILED
-                    automation.save(update_fields=["status"])
-                    return Response({
-                        "success": False,
-                        "message": "No GRNs available after filtering"
-                    }, status=status.HTTP_400_BAD_REQUEST)
-                
-                self.create_step(
-                    automation=automation,
-                    step_name=AutomationStep.Step.FILTER_GRN,
-                    status=AutomationStep.Status.SUCCESS,
-                    message=f"Filtered {len(filtered_grns)} GRNs"
-                )
-
-                matched_grns_resp = matching_grns(vendor_code, grn_po_number, filtered_grns)
-                print("Matching")
-                print(matched_grns_resp)
-
-                if not matched_grns_resp or matched_grns_resp.get("status") != "success" or not matched_grns_resp.get("data"):
-                    self.create_step(
-                        automation=automation,
-                        step_name=AutomationStep.Step.VALIDATION,
-                        status=AutomationStep.Status.FAILED,
-                        message=matched_grns_resp.get("message", "No matching GRNs found after filtering")
-                    )
-                    
-                    automation.status = GRNAutomation.Status.FAILED
-                    automation.save(update_fields=["status"])
-                    return Response({
-                        "success": False,
-                        "message": matched_grns_resp.get("message", "No matching GRNs found")
-                    }, status=status.HTTP_400_BAD_REQUEST)
-                
-                matched_grns = matched_grns_resp["data"]
-
-            except Exception as e:
-                self.create_step(
-                    automation=automation,
-                    step_name=AutomationStep.Step.FILTER_GRN,
-                    status=AutomationStep.Status.FAILED,
-                    message=f"Filtering/Matching failed: {str(e)}"
-                )
-
-                automation.status = GRNAutomation.Status.FAILED
-                automation.save(update_fields=["status"])
-                return Response({
-                    "success": False,
-                    "message": f"Matching failed: {str(e)}"
-                }, status=status.HTTP_400_BAD_REQUEST)
-
-            # ---------- Validation ----------
-            validation_resp = extractor.validate_invoice(markdown_text, matched_grns, invoices, scenario)
-            print("Validation")
-            print(validation_resp)
-
-            if not validation_resp or validation_resp.get("status") != "success" or not validation_resp.get("data"):
-                self.create_step(
-                    automation=automation,
-                    step_name=AutomationStep.Step.VALIDATION,
-                    status=AutomationStep.Status.FAILED,
-                    message=validation_resp.get("message", "Validation failed")
-                )
-                
-                automation.status = GRNAutomation.Status.FAILED
-                automation.save(update_fields=["status"])
-                return Response(
-                    {"success": False, "message": f"Validation failed: {validation_resp.get('message', 'No validation data returned')}"}, 
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-
-            validation_results = validation_resp.get("data", {}).get("validation_results", [])
-            if not validation_results:
-                self.create_step(
-                    automation=automation,
-                    step_name=AutomationStep.Step.VALIDATION,
-                    status=AutomationStep.Status.FAILED,
-                    message="No validation results returned"
-                )
-                
-                automation.status = GRNAutomation.Status.FAILED
-                automation.save(update_fields=["status"])
-                return Response(
-                    {"success": False, "message": "No validation results found"}, 
-                    status=status.HTTP_400_BAD_REQUEST
-                )
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-            failed_validations = [r for r in validation_results if r.get("status") != "SUCCESS"]
-            if failed_validations:
-                failed_reasons = "; ".join([
-                    f"Invoice {r.get('invoice_date', 'unknown')}: {r.get('reasoning', 'No reason')}"
-                    for r in failed_validations
-                ])
-                
-                self.create_step(
-                    automation=automation,
-                    step_name=AutomationStep.Step.VALIDATION,
-                    status=AutomationStep.Status.FAILED,
-                    message=failed_reasons
-                )
-                
-                automation.status = GRNAutomation.Status.FAILED
-                automation.save(update_fields=["status"])
-                return Response(
-                    {"success": False, "message": f"Validation failed: {failed_reasons}"}, 
-                    status=status.HTTP_400_BAD_REQUEST
-                )
+        automation = serializer.save()
+        automation.file.close()
 
-            self.create_step(
-                automation=automation,
-                step_name=AutomationStep.Step.VALIDATION,
-                status=AutomationStep.Status.SUCCESS,
-                message=f"Validated {len(validation_results)} invoice(s) successfully"
+        try:
+            process_grn_automation.delay(automation.id)
+        except Exception as e:
+            logger.error(f"Could not queue automation {automation.id}: {str(e)}", exc_info=True)
+            automation.status = GRNAutomation.Status.FAILED
+            automation.validation_message = "Could not queue the automation for processing."
+            automation.save(update_fields=["status", "validation_message"])
+            return Response(
+                {"success": False, "message": "Automation queue is unavailable. Please try again later.", "automation_id": automation.id},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
             )
 
-            # ========== SAVE VALIDATION RESULTS TO DATABASE ==========
-            try:
-                save_result = save_validation_results(automation.id, validation_resp)
-                
-                if save_result['success']:
-                    logger.info(f"✅ Validation results saved successfully for automation {automation.id}")
-                    logger.info(f"📊 Summary: {save_result['summary']}")
-                    
-                    # ✅ Extract validation_result_ids from summary dict
-                    validation_result_ids = save_result.get('summary', {}).get('validation_result_ids', [])
-                    
-                    if not validation_result_ids:
-                        logger.warning("⚠️ No validation_result_ids returned from save_validation_results")
-                else:
-                    logger.error(f"❌ Failed to save validation results: {save_result.get('error')}")
-                    validation_result_ids = []
-                    
-            except Exception as e:
-                logger.error(f"❌ Error saving validation results: {str(e)}", exc_info=True)
-                validation_result_ids = []
-            # ========== END: SAVE VALIDATION RESULTS ==========
-
-            validated_grns = [result.get("payload") for result in validation_results]
-
-            # ---------- Create Invoice(s) ----------
-            invoice_creation_results = []
-            all_invoices_created = True
-            invoice_errors = []
-
-            try:
-                if len(validation_results) == 1:
-                    # CASE 1 (1:1) or CASE 3 (many:1) - Single invoice
-                    validation_result = validation_results[0]
-                    validated_payload = validation_result.get("payload")
-                    invoice_date = validation_result.get("invoice_date")
-                    
-                    # ✅ Get the corresponding validation_result_id
-                    validation_result_id = validation_result_ids[0] if len(validation_result_ids) > 0 else None
-                    
-                    print(f"Creating invoice for date: {invoice_date}")
-                    print(f"Validation Result ID: {validation_result_id}")
-                    print(f"Payload: {validated_payload}")
-                    
-                    invoice_resp = create_invoice(validated_payload, use_dummy=True)
-                    print("Invoice Response:")
-                    print(invoice_resp)
-                    
-                    # ========== UPDATE POSTING STATUS ==========
-                    if invoice_resp.get("status") == "success":
-                        doc_entry = invoice_resp.get("data", {}).get("DocEntry")
-                        posting_message = f"Invoice created successfully. DocEntry: {doc_entry}"
-                        
-                        self.update_posting_status(
-                            automation_id=automation.id,
-                            invoice_date=invoice_date,
-                            posting_status=ValidationResult.PostingStatus.POSTED,
-                            posting_message=posting_message,
-                            validation_result_id=validation_result_id  # ✅ Pass ID
-                        )
-                        
-                        invoice_creation_results.append({
-                            "invoice_date": invoice_date,
-                            "status": "success",
-                            "message": posting_message,
-                            "doc_entry": doc_entry,
-                            "validation_result_id": validation_result_id
-                        })
-                    else:
-                        error_message = invoice_resp.get("message", "Unknown error")
-                        
-                        self.update_posting_status(
-                            automation_id=automation.id,
-                            invoice_date=invoice_date,
-                            posting_status=ValidationResult.PostingStatus.FAILED,
-                            posting_message=f"Invoice creation failed: {error_message}",
-                            validation_result_id=validation_result_id  # ✅ Pass ID
-                        )
-                        
-                        all_invoices_created = False
-                        invoice_errors.append(f"Invoice {invoice_date}: {error_message}")
-                        
-                        invoice_creation_results.append({
-                            "invoice_date": invoice_date,
-                            "status": "failed",
-                            "message": error_message,
-                            "doc_entry": None,
-                            "validation_result_id": validation_result_id
-                        })
-                    # ========== END: UPDATE POSTING STATUS ==========
-                
-                elif len(validation_results) > 1:
-                    # CASE 2 (1:many) OR CASE 4 (many:many) - Multiple invoices
-                    print(f"Creating {len(validation_results)} separate invoices")
-                    
-                    for idx, validation_result in enumerate(validation_results):
-                        validated_payload = validation_result.get("payload")
-                        invoice_date = validation_result.get("invoice_date")
-                        
-                        # ✅ Get the corresponding validation_result_id for THIS specific invoice
-                        validation_result_id = validation_result_ids[idx] if idx < len(validation_result_ids) else None
-                        
-                        print(f"\n{'='*60}")
-                        print(f"Creating invoice {idx + 1}/{len(validation_results)}")
-                        print(f"Invoice Date: {invoice_date}")
-                        print(f"Validation Result ID: {validation_result_id}")
-                        print(f"{'='*60}\n")
-                        
-                        invoice_resp = create_invoice(validated_payload, use_dummy=True)
-                        print(f"Invoice {idx + 1} Response:")
-                        print(invoice_resp)
-                        
-                        # ========== UPDATE POSTING STATUS ==========
-                        if invoice_resp.get("status") == "success":
-                            doc_entry = invoice_resp.get("data", {}).get("DocEntry")
-                            posting_message = f"Invoice {idx + 1} created successfully. DocEntry: {doc_entry}"
-                            
-                            update_success = self.update_posting_status(
-                                automation_id=automation.id,
-                                invoice_date=invoice_date,
-                                posting_status=ValidationResult.PostingStatus.POSTED,
-                                posting_message=posting_message,
-                                validation_result_id=validation_result_id  # ✅ Pass ID
-                            )
-                            
-                            if not update_success:
-                                logger.error(
-                                    f"❌ Failed to update posting status for invoice {idx + 1} "
-                                    f"(validation_result_id: {validation_result_id})"
-                                )
-                            
-                            invoice_creation_results.append({
-                                "invoice_date": invoice_date,
-                                "status": "success",
-                                "message": posting_message,
-                                "doc_entry": doc_entry,
-                                "validation_result_id": validation_result_id
-                            })
-                        else:
-                            error_message = invoice_resp.get("message", "Unknown error")
-                            
-                            update_success = self.update_posting_status(
-                                automation_id=automation.id,
-                                invoice_date=invoice_date,
-                                posting_status=ValidationResult.PostingStatus.FAILED,
-                                posting_message=f"Invoice {idx + 1} creation failed: {error_message}",
-                                validation_result_id=validation_result_id  # ✅ Pass ID
-                            )
-                            
-                            if not update_success:
-                                logger.error(
-                                    f"❌ Failed to update posting status for invoice {idx + 1} "
-                                    f"(validation_result_id: {validation_result_id})"
-                                )
-                            
-                            all_invoices_created = False
-                            invoice_errors.append(f"Invoice {idx + 1} ({invoice_date}): {error_message}")
-                            
-                            invoice_creation_results.append({
-                                "invoice_date": invoice_date,
-                                "status": "failed",
-                                "message": error_message,
-                                "doc_entry": None,
-                                "validation_result_id": validation_result_id
-                            })
-                        # ========== END: UPDATE POSTING STATUS ==========
-    
-                
-                # Create final booking step
-                if all_invoices_created:
-                    if len(invoice_creation_results) == 1:
-                        message = f"Invoice created successfully. {invoice_creation_results[0]['message']}"
-                    else:
-                        message = f"Created {len(invoice_creation_results)} invoices successfully"
-                    
-                    self.create_step(
-                        automation=automation,
-                        step_name=AutomationStep.Step.BOOKED,
-                        status=AutomationStep.Status.SUCCESS,
-                        message=message
-                    )
-                    
-                    automation.status = GRNAutomation.Status.COMPLETED
-                    automation.completed_at = timezone.now()
-                    automation.save(update_fields=["status", "completed_at"])
-                    
-                    return Response({
-                        "success": True,
-                        "message": f"Your {self.case_type.replace('_', ' ')} automation completed successfully.",
-                        "automation_status": automation.status,
-                        "invoices_created": len(invoice_creation_results),
-                        "invoice_details": invoice_creation_results,
-                        "raw_data": markdown_text,
-                        "vendor_data": vendor_info,
-                        "all_open_grns": all_open_grns,
-                        "filtered_grns": filtered_grns,
-                        "matched_grns": matched_grns,
-                        "validated_data": validated_grns,
-                    }, status=status.HTTP_201_CREATED)
-                
-                else:
-                    self.create_step(
-                        automation=automation,
-                        step_name=AutomationStep.Step.BOOKED,
-                        status=AutomationStep.Status.FAILED,
-                        message="; ".join(invoice_errors)
-                    )
-                    
-                    automation.status = GRNAutomation.Status.FAILED
-                    automation.save(update_fields=["status"])
-                    
-                    return Response({
-                        "success": False,
-                        "message": f"Invoice creation failed: {'; '.join(invoice_errors)}",
-                        "automation_status": automation.status,
-                        "invoices_attempted": len(validation_results),
-                        "invoices_created": len([r for r in invoice_creation_results if r["status"] == "success"]),
-                        "errors": invoice_errors,
-                        "invoice_details": invoice_creation_results,
-                    }, status=status.HTTP_400_BAD_REQUEST)
-
-            except Exception as e:
-                logger.error(f"Unexpected error during invoice creation: {str(e)}", exc_info=True)
-                
-                # Update posting status to failed for all validation results
-                for validation_result in validation_results:
-                    self.update_posting_status(
-                        automation_id=automation.id,
-                        invoice_date=validation_result.get("invoice_date"),
-                        posting_status=ValidationResult.PostingStatus.FAILED,
-                        posting_message=f"Unexpected error: {str(e)}"
-                    )
-                
-                self.create_step(
-                    automation=automation,
-                    step_name=AutomationStep.Step.BOOKED,
-                    status=AutomationStep.Status.FAILED,
-                    message=f"Unexpected error: {str(e)}"
-                )
-                
-                automation.status = GRNAutomation.Status.FAILED
-                automation.save(update_fields=["status"])
-                
-                return Response({
-                    "success": False,
-                    "message": f"Invoice creation error: {str(e)}",
-                    "automation_status": automation.status,
-                    "error_type": type(e).__name__,
-                }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            "success": True,
+            "message": f"Your {self.case_type.replace('_', ' ')} automation has been queued for processing.",
+            "automation_id": automation.id,
+            "automation_status": automation.status,
+            "status_url": reverse("user-automation-detail", kwargs={"pk": automation.id}),
+        }, status=status.HTTP_202_ACCEPTED)
 
 
 class OneToOneAutomationUploadView(BaseAutomationUploadView):
@@ -732,30 +121,49 @@ class ManyToManyAutomationUploadView(BaseAutomationUploadView):
     case_type = GRNAutomation.CaseType.MANY_TO_MANY
 
 
-# from .tasks import process_grn_automation  # 👈 Import the Celery task
-
-# class BaseAutomationUploadView(APIView):
-#     permission_classes = [IsAuthenticated]
-#     case_type = GRNAutomation.CaseType.ONE_TO_ONE
+class AutomationResumeView(APIView):
+    """
+    Endpoint: POST /api/v1/automation/automation-details/<pk>/resume/
 
-#     def post(self, request, *args, **kwargs):
-#         data = request.data if isinstance(request.data, dict) else request.data.dict()
+    Re-queue a failed automation, or a running one whose worker died (no step
+    heartbeat for PIPELINE_STALE_SECONDS). The run restores the artifacts of
+    the steps that already succeeded (extraction, vendor code, GRNs,
+    validation) and restarts from the first step that did not, so no PDF
+    re-upload is needed.
+    """
+    permission_classes = [IsAuthenticated]
 
-#         serializer = AutomationUploadSerializer(data=data, context={"request": request})
-#         if serializer.is_valid():
-#             automation = serializer.save()
-#             automation.file.close()
+    def post(self, request, pk):
+        qs = GRNAutomation.objects.all() if request.user.is_staff else GRNAutomation.objects.filter(user=request.user)
+        automation = get_object_or_404(qs, pk=pk)
 
-#             # Trigger async processing
-#             process_grn_automation.delay(automation.id)
+        # Conditional update so two clicks cannot queue the same run twice
+        queued = qs.filter(pk=pk).filter(Q(status=GRNAutomation.Status.FAILED) | stale_running()).update(
+            status=GRNAutomation.Status.PENDING
+        )
+        if not queued:
+            return Response(
+                {"success": False, "message": f"Only failed or stalled automations can be resumed; this one is {automation.status}."},
+                status=status.HTTP_409_CONFLICT
+            )
 
-#             return Response({
-#                 "success": True,
-#                 "message": f"Your {self.case_type.replace('_', ' ')} automation has been queued for processing.",
-#                 # "automation_id": automation.id,
-#             }, status=status.HTTP_202_ACCEPTED)
+        try:
+            process_grn_automation.delay(automation.id)
+        except Exception as e:
+            logger.error(f"Could not queue automation {automation.id}: {str(e)}", exc_info=True)
+            GRNAutomation.objects.filter(pk=pk).update(status=GRNAutomation.Status.FAILED)
+            return Response(
+                {"success": False, "message": "Automation queue is unavailable. Please try again later.", "automation_id": automation.id},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
 
-#         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            "success": True,
+            "message": "Automation queued to resume from its first unsuccessful step.",
+            "automation_id": automation.id,
+            "automation_status": GRNAutomation.Status.PENDING,
+            "status_url": reverse("user-automation-detail", kwargs={"pk": automation.id}),
+        }, status=status.HTTP_202_ACCEPTED)
 
 
 class CreateInvoiceView(APIView):
@@ -805,6 +213,9 @@ class CreateInvoiceView(APIView):
             # Return appropriate response based on result
             if result["status"] == "success":
                 return Response(result, status=status.HTTP_201_CREATED)
+            elif result["status"] == "unknown":
+                # SAP may have created the invoice; the client must not simply retry
+                return Response(result, status=status.HTTP_504_GATEWAY_TIMEOUT)
             else:
                 return Response(result, status=status.HTTP_400_BAD_REQUEST)
 
@@ -828,30 +239,21 @@ class BranchListView(APIView):
 
     def get(self, request, *args, **kwargs):
         try:
-            SAPService.ensure_session()
-
-            url = f"{SERVICE_LAYER_URL}/BusinessPlaces"
-            headers = {
-                "Cookie": f"B1SESSION={SAPService.session_id}",
-                "Content-Type": "application/json",
-            }
-
-            resp = requests.get(url, headers=headers, verify=False, timeout=30)
+            resp = SAPService.get("/BusinessPlaces")
+            return Response(
+                {"status": "success", "data": resp.json().get("value", [])},
+                status=status.HTTP_200_OK,
+            )
 
-            if resp.status_code == 200:
-                return Response(
-                    {"status": "success", "data": resp.json().get("value", [])},
-                    status=status.HTTP_200_OK,
-                )
-            else:
-                return Response(
-                    {
-                        "status": "failed",
-                        "message": f"SAP Error: {resp.text}",
-                        "data": None,
-                    },
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
+        except requests.exceptions.HTTPError as e:
+            return Response(
+                {
+                    "status": "failed",
+                    "message": f"SAP Error: {e.response.text}",
+                    "data": None,
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
         except Exception as e:
             logger.error("Error fetching branches: %s", str(e), exc_info=True)
@@ -864,6 +266,9 @@ class BranchListView(APIView):
 class VendorGRNView(APIView):
     """
     API endpoint to fetch open GRNs for a given vendor.
+
+    Returns the fields the local mirror holds (the "mirror" projection), so
+    it is answered from the mirror when fresh and from SAP otherwise.
     """
 
     def post(self, request):
@@ -875,7 +280,7 @@ class VendorGRNView(APIView):
             )
 
         vendor_code = serializer.validated_data["vendor_code"]
-        result = fetch_grns_for_vendor(vendor_code)
+        result = get_open_grns(vendor_code, projection="mirror")
 
         if result["status"] == "success":
             return Response(result, status=status.HTTP_200_OK)
@@ -898,8 +303,8 @@ class VendorFilterOpenGRNView(APIView):
 
         vendor_code = serializer.validated_data["vendor_code"]
 
-        # Fetch raw GRNs from SAP
-        fetch_result = fetch_grns_for_vendor(vendor_code)
+        # Fetch raw GRNs (local mirror when fresh, otherwise SAP)
+        fetch_result = get_open_grns(vendor_code, projection="matching")
         if fetch_result["status"] != "success":
             return Response(fetch_result, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -944,7 +349,7 @@ class VendorGRNMatchView(APIView):
         grn_po = serializer.validated_data["grn_po"]
 
         # Step 1: Fetch open GRNs
-        fetch_result = fetch_grns_for_vendor(vendor_code)
+        fetch_result = get_open_grns(vendor_code, projection="matching")
         if fetch_result["status"] != "success":
             return Response(fetch_result, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -1046,6 +451,7 @@ class PurchaseInvoiceDetailView(APIView):
     Query Parameters:
     - card_code: Vendor code (highly recommended for accuracy)
     - select: Comma-separated fields (e.g., DocEntry,DocNum,DocType)
+    - profile: Named field projection used when `select` is not given ("lookup" or "posting")
     
     Examples:
     GET /api/purchase-invoices/12342/
@@ -1057,12 +463,14 @@ class PurchaseInvoiceDetailView(APIView):
         # Get query parameters
         card_code = request.query_params.get('card_code', None)
         select_fields = request.query_params.get('select', None)
+        profile = request.query_params.get('profile', None)
         
         # Fetch purchase invoice from SAP
         result = fetch_purchase_invoice_by_docnum(
             doc_num=doc_num,
             card_code=card_code,
-            select_fields=select_fields
+            select_fields=select_fields,
+            projection=profile
         )
         
         if result["status"] == "success":
@@ -1096,7 +504,7 @@ class AutomationInvoicesListView(APIView):
         Get all validation results (invoices) for a specific automation.
         
         Query Parameters:
-            - posting_status: Filter by posting status (pending/posted/failed)
+            - posting_status: Filter by posting status (pending/posted/failed/unknown)
             - validation_status: Filter by validation status (SUCCESS/FAILED/PARTIAL)
         """
         try:
@@ -1176,7 +584,7 @@ class InvoiceDetailView(APIView):
     
     def patch(self, request, invoice_id):
         """
-        Update invoice data (only if posting_status is not 'posted').
+        Update invoice data (only if posting_status is not 'posted' or 'unknown').
         
         Only existing document lines can be updated. Creating new lines is not allowed.
         """
@@ -1188,7 +596,7 @@ class InvoiceDetailView(APIView):
                 automation__user=request.user
             )
             
-            # Check if already posted
+            # Check if already posted (or possibly posted)
             if validation_result.posting_status == ValidationResult.PostingStatus.POSTED:
                 return Response({
                     'success': False,
@@ -1196,6 +604,13 @@ class InvoiceDetailView(APIView):
                     'invoice_id': invoice_id,
                     'posting_status': 'posted'
                 }, status=status.HTTP_403_FORBIDDEN)
+            if validation_result.posting_status == ValidationResult.PostingStatus.UNKNOWN:
+                return Response({
+                    'success': False,
+                    'message': 'Cannot update invoice that SAP may already have posted',
+                    'invoice_id': invoice_id,
+                    'posting_status': 'unknown'
+                }, status=status.HTTP_403_FORBIDDEN)
             
             # Validate and update
             serializer = ValidationResultUpdateSerializer(
@@ -1253,7 +668,7 @@ class InvoiceRetryView(APIView):
         }
         """
         try:
-            from grn_automation.utils.invoice import create_invoice
+            from grn_automation.utils.invoice import create_invoice, recheck_unconfirmed_invoices
             
             # Get validation result
             validation_result = get_object_or_404(
@@ -1272,6 +687,43 @@ class InvoiceRetryView(APIView):
                     'doc_entry': validation_result.doc_entry
                 }, status=status.HTTP_400_BAD_REQUEST)
             
+            # An earlier attempt may have reached SAP: only retry once SAP confirms it did not
+            if validation_result.posting_status == ValidationResult.PostingStatus.UNKNOWN:
+                recheck = {"status": "unknown", "message": "No NumAtCard recorded for the earlier attempt"}
+                if validation_result.num_at_card:
+                    recheck = recheck_unconfirmed_invoices(
+                        [{"NumAtCard": validation_result.num_at_card}],
+                        "Earlier posting attempt did not reach SAP"
+                    )[0]
+                
+                if recheck['status'] == 'success':
+                    doc_entry = recheck['data'].get('DocEntry')
+                    validation_result.posting_status = ValidationResult.PostingStatus.POSTED
+                    validation_result.posting_message = (
+                        f"Invoice found in SAP on re-check. DocEntry: {doc_entry}"
+                    )
+                    validation_result.save(update_fields=['posting_status', 'posting_message', 'updated_at'])
+                    return Response({
+                        'success': True,
+                        'message': 'Invoice was already created in SAP; not posted again',
+                        'invoice_id': invoice_id,
+                        'doc_entry': doc_entry,
+                        'posting_status': 'posted',
+                        'posting_message': validation_result.posting_message
+                    }, status=status.HTTP_200_OK)
+                if recheck['status'] != 'failed':
+                    return Response({
+                        'success': False,
+                        'message': (
+                            f"SAP may already hold this invoice ({recheck['message']}). "
+                            "Cannot retry until it is confirmed missing."
+                        ),
+                        'invoice_id': invoice_id,
+                        'posting_status': 'unknown',
+                        'num_at_card': validation_result.num_at_card
+                    }, status=status.HTTP_409_CONFLICT)
+                logger.info(f"Invoice {validation_result.num_at_card} is not in SAP; retrying ValidationResult {invoice_id}")
+            
             # Build payload from current validation result data
             payload = {
                 'CardCode': validation_result.card_code,
@@ -1317,6 +769,23 @@ class InvoiceRetryView(APIView):
                     'posting_message': validation_result.posting_message,
                     'invoice_response': invoice_resp
                 }, status=status.HTTP_201_CREATED)
+            elif invoice_resp.get('status') == 'unknown':
+                # UNKNOWN: SAP may have created it; keep it out of further retries until re-checked
+                validation_result.posting_status = ValidationResult.PostingStatus.UNKNOWN
+                validation_result.posting_message = invoice_resp.get('message')
+                validation_result.num_at_card = (invoice_resp.get('data') or {}).get('NumAtCard')
+                validation_result.save(update_fields=['posting_status', 'posting_message', 'num_at_card', 'updated_at'])
+                
+                logger.error(f"❓ Invoice {invoice_id} outcome unknown: {validation_result.posting_message}")
+                
+                return Response({
+                    'success': False,
+                    'message': validation_result.posting_message,
+                    'invoice_id': invoice_id,
+                    'posting_status': 'unknown',
+                    'posting_message': validation_result.posting_message,
+                    'invoice_response': invoice_resp
+                }, status=status.HTTP_504_GATEWAY_TIMEOUT)
             else:
                 # FAILED: Update to FAILED
                 error_message = invoice_resp.get('message', 'Unknown error')
@@ -1339,12 +808,15 @@ class InvoiceRetryView(APIView):
         except Exception as e:
             logger.error(f"Error retrying invoice {invoice_id}: {str(e)}", exc_info=True)
             
-            # Update status to failed on exception
+            # Update status to failed on exception; a posted or unknown outcome is kept
             try:
-                validation_result = ValidationResult.objects.get(id=invoice_id)
-                validation_result.posting_status = ValidationResult.PostingStatus.FAILED
-                validation_result.posting_message = f"Retry error: {str(e)}"
-                validation_result.save(update_fields=['posting_status', 'posting_message', 'updated_at'])
+                ValidationResult.objects.filter(id=invoice_id).exclude(
+                    posting_status__in=[ValidationResult.PostingStatus.POSTED, ValidationResult.PostingStatus.UNKNOWN]
+                ).update(
+                    posting_status=ValidationResult.PostingStatus.FAILED,
+                    posting_message=f"Retry error: {str(e)}",
+                    updated_at=timezone.now()
+                )
             except:
                 pass
             
@@ -1382,6 +854,7 @@ class AutomationInvoiceStatsView(APIView):
             posted_count = validation_results.filter(posting_status=ValidationResult.PostingStatus.POSTED).count()
             failed_count = validation_results.filter(posting_status=ValidationResult.PostingStatus.FAILED).count()
             pending_count = validation_results.filter(posting_status=ValidationResult.PostingStatus.PENDING).count()
+            unknown_count = validation_results.filter(posting_status=ValidationResult.PostingStatus.UNKNOWN).count()
             
             validation_success = validation_results.filter(validation_status=ValidationResult.ValidationStatus.SUCCESS).count()
             validation_failed = validation_results.filter(validation_status=ValidationResult.ValidationStatus.FAILED).count()
@@ -1396,7 +869,8 @@ class AutomationInvoiceStatsView(APIView):
                     'posting_status': {
                         'posted': posted_count,
                         'failed': failed_count,
-                        'pending': pending_count
+                        'pending': pending_count,
+                        'unknown': unknown_count
                     },
                     'validation_status': {
                         'success': validation_success,
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import httpx
+from .batch import BatchOperation, build_batch_body, parse_batch_response
+from .sap_service import SAPService, _rewind_files, _service_layer_url
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSAPService:
+    """
+    Async counterpart of SAPService built on httpx.
+
+    Requests run on sessions checked out of the same pool SAPService uses, so
+    sync and async code share logins, single-flight re-authentication and the
+    session limit. Concurrency is bounded by the pool size (or a smaller
+    `max_concurrency`). An httpx client is bound to one event loop, so create
+    one instance per loop:
+
+        async with AsyncSAPService() as sap:
+            partners, grns = await asyncio.gather(
+                sap.get("/BusinessPartners", params={...}),
+                sap.get("/PurchaseDeliveryNotes", params={...}),
+            )
+    """
+
+    def __init__(self, max_concurrency=None, transport=None):
+        self.max_concurrency = min(max_concurrency or SAPService.POOL_SIZE, SAPService.POOL_SIZE)
+        self._transport = transport
+        self._client = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+    def open(self):
+        if self._client is not None:
+            return
+        connect_timeout, read_timeout = SAPService.DEFAULT_TIMEOUT
+        limits = httpx.Limits(
+            max_connections=SAPService.HTTP_POOL_MAXSIZE,
+            max_keepalive_connections=SAPService.HTTP_POOL_MAXSIZE,
+        )
+        transport = self._transport or httpx.AsyncHTTPTransport(
+            verify=False,
+            limits=limits,
+            # httpx only retries connection failures, matching the sync policy for POSTs
+            retries=SAPService.MAX_RETRIES,
+        )
+        self._client = httpx.AsyncClient(
+            transport=transport,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        )
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _send(self, session, method, url, headers, kwargs):
+        # Cookies of the checked-out session are sent explicitly, never via
+        # the shared client jar, so sessions cannot leak into each other.
+        cookie = "; ".join(f"{name}={value}" for name, value in session.http.cookies.get_dict().items())
+        if not cookie:
+            cookie = f"B1SESSION={session.session_id}"
+        resp = await self._client.request(method, url, headers={**headers, "Cookie": cookie}, **kwargs)
+        # Keep cookies SAP sets (a re-issued B1SESSION / ROUTEID) on the session,
+        # as requests.Session does for the sync client.
+        for set_cookie in resp.cookies.jar:
+            session.http.cookies.set_cookie(set_cookie)
+        self._client.cookies.clear()
+        return resp
+
+    async def request(self, method, endpoint, **kwargs):
+        """
+        Make an authenticated request on a pooled session.
+
+        Like SAPService.make_request, a 401 re-authenticates the session once
+        and retries. Raises httpx.HTTPStatusError for non-2xx responses.
+        """
+        self.open()
+        url = f"{_service_layer_url()}{endpoint}"
+
+        headers = dict(kwargs.pop("headers", None) or {})
+        if "Content-Type" not in headers and "files" not in kwargs:
+            headers["Content-Type"] = "application/json"
+
+        pool = SAPService.get_pool()
+        async with self._semaphore:
+            # Checkout (and any login it triggers) is blocking, so run it off the loop
+            session = await asyncio.to_thread(pool.acquire, SAPService.CHECKOUT_TIMEOUT)
+            try:
+                resp = await self._send(session, method, url, headers, kwargs)
+
+                if resp.status_code == 401:
+                    logger.warning(
+                        f"SAP returned 401 for {method} {endpoint} on pool slot {session.index}; "
+                        "re-authenticating and retrying once"
+                    )
+                    await asyncio.to_thread(session.refresh)
+                    _rewind_files(kwargs)
+                    resp = await self._send(session, method, url, headers, kwargs)
+
+                session.touch()
+            finally:
+                pool.release(session)
+
+        resp.raise_for_status()
+        return resp
+
+    async def get(self, endpoint, **kwargs):
+        return await self.request("GET", endpoint, **kwargs)
+
+    async def post(self, endpoint, **kwargs):
+        return await self.request("POST", endpoint, **kwargs)
+
+    async def patch(self, endpoint, **kwargs):
+        return await self.request("PATCH", endpoint, **kwargs)
+
+    async def delete(self, endpoint, **kwargs):
+        return await self.request("DELETE", endpoint, **kwargs)
+
+    async def batch(self, operations, atomic=False, **kwargs):
+        """Async version of SAPService.batch(); returns BatchResult list in input order."""
+        operations = [
+            op if isinstance(op, BatchOperation) else BatchOperation(*op)
+            for op in operations
+        ]
+        if not operations:
+            return []
+
+        body, content_type, groups = build_batch_body(operations, _service_layer_url(), atomic=atomic)
+        resp = await self.request(
+            "POST", "/$batch", content=body, headers={"Content-Type": content_type}, **kwargs
+        )
+        return parse_batch_response(resp.headers.get("Content-Type", ""), resp.content, operations, groups)
@@ -0,0 +1,227 @@
+import json
+import uuid
+from urllib.parse import urlparse
+
+
+CRLF = "\r\n"
+
+
+class BatchOperation:
+    """One request inside an OData $batch call."""
+
+    def __init__(self, method, endpoint, body=None, headers=None):
+        self.method = method.upper()
+        self.endpoint = endpoint if endpoint.startswith("/") else f"/{endpoint}"
+        self.body = body
+        self.headers = headers or {}
+
+    @property
+    def is_read(self):
+        return self.method == "GET"
+
+    def __repr__(self):
+        return f"BatchOperation({self.method} {self.endpoint})"
+
+
+class BatchResult:
+    """The response SAP returned for one BatchOperation."""
+
+    def __init__(self, status_code, headers=None, body=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.body = body
+
+    @property
+    def ok(self):
+        return 200 <= self.status_code < 300
+
+    @property
+    def error_message(self):
+        """SAP error text for a failed operation, if any."""
+        if self.ok:
+            return None
+        if isinstance(self.body, dict):
+            return self.body.get("error", {}).get("message", {}).get("value") or json.dumps(self.body)
+        return self.body or f"HTTP {self.status_code}"
+
+    def __repr__(self):
+        return f"BatchResult({self.status_code})"
+
+
+def _http_part(operation, base_path, content_id=None):
+    lines = [
+        "Content-Type: application/http",
+        "Content-Transfer-Encoding: binary",
+    ]
+    if content_id is not None:
+        lines.append(f"Content-ID: {content_id}")
+    lines.append("")
+    lines.append(f"{operation.method} {base_path}{operation.endpoint} HTTP/1.1")
+
+    headers = dict(operation.headers)
+    body = operation.body
+    if body is not None and not isinstance(body, str):
+        body = json.dumps(body)
+        headers.setdefault("Content-Type", "application/json")
+    for name, value in headers.items():
+        lines.append(f"{name}: {value}")
+    lines.append("")
+    lines.append(body or "")
+    return CRLF.join(lines)
+
+
+def _group_operations(operations, atomic):
+    """
+    Split operations into batch parts.
+
+    Reads are sent as standalone parts. Writes go into changesets: one per
+    write so each succeeds or fails on its own, or a single changeset for
+    all writes when `atomic` is set (SAP then commits all or none).
+
+    Returns a list of (is_changeset, [operation indexes]).
+    """
+    groups = []
+    atomic_group = None
+    for index, operation in enumerate(operations):
+        if operation.is_read:
+            groups.append((False, [index]))
+        elif atomic:
+            if atomic_group is None:
+                atomic_group = (True, [])
+                groups.append(atomic_group)
+            atomic_group[1].append(index)
+        else:
+            groups.append((True, [index]))
+    return groups
+
+
+def build_batch_body(operations, base_url, atomic=False):
+    """
+    Encode operations as a multipart/mixed $batch body.
+
+    Returns (body_bytes, content_type, groups); `groups` is needed to map the
+    response back onto the operations.
+    """
+    base_path = urlparse(base_url).path.rstrip("/")
+    batch_boundary = f"batch_{uuid.uuid4()}"
+    groups = _group_operations(operations, atomic)
+
+    parts = []
+    for is_changeset, indexes in groups:
+        if not is_changeset:
+            parts.append(_http_part(operations[indexes[0]], base_path))
+            continue
+
+        changeset_boundary = f"changeset_{uuid.uuid4()}"
+        inner = [
+            f"--{changeset_boundary}{CRLF}"
+            f"{_http_part(operations[index], base_path, content_id=index + 1)}"
+            for index in indexes
+        ]
+        parts.append(
+            f"Content-Type: multipart/mixed; boundary={changeset_boundary}{CRLF}{CRLF}"
+            + CRLF.join(inner)
+            + f"{CRLF}--{changeset_boundary}--"
+        )
+
+    body = "".join(f"--{batch_boundary}{CRLF}{part}{CRLF}" for part in parts)
+    body += f"--{batch_boundary}--{CRLF}"
+    return body.encode("utf-8"), f"multipart/mixed; boundary={batch_boundary}", groups
+
+
+def _boundary(content_type):
+    for param in content_type.split(";")[1:]:
+        name, _, value = param.strip().partition("=")
+        if name.lower() == "boundary":
+            return value.strip('"')
+    raise ValueError(f"No multipart boundary in Content-Type: {content_type}")
+
+
+def _split_headers(text):
+    """Split 'headers\\r\\n\\r\\nbody' into (dict of lower-cased headers, body)."""
+    text = text.replace("\r\n", "\n")
+    head, _, body = text.partition("\n\n")
+    headers = {}
+    for line in head.split("\n"):
+        name, sep, value = line.partition(":")
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return headers, body
+
+
+def _split_multipart(text, boundary):
+    delimiter = f"--{boundary}"
+    parts = []
+    for chunk in text.split(delimiter)[1:]:
+        if chunk.startswith("--"):
+            break
+        parts.append(chunk.strip("\r\n"))
+    return parts
+
+
+def _parse_http_response(text):
+    text = text.replace("\r\n", "\n")
+    status_line, _, rest = text.partition("\n")
+    try:
+        status_code = int(status_line.split()[1])
+    except (IndexError, ValueError):
+        raise ValueError(f"Malformed status line in $batch response: {status_line!r}")
+
+    headers, body = _split_headers(rest)
+    body = body.strip()
+    if body and "json" in headers.get("content-type", ""):
+        try:
+            body = json.loads(body)
+        except ValueError:
+            pass
+    return BatchResult(status_code, headers, body or None)
+
+
+def _parse_part(part):
+    """Parse one top-level part into a single BatchResult or a list (changeset)."""
+    headers, body = _split_headers(part)
+    content_type = headers.get("content-type", "")
+    if content_type.startswith("multipart/mixed"):
+        inner = []
+        for inner_part in _split_multipart(body, _boundary(content_type)):
+            inner_headers, inner_body = _split_headers(inner_part)
+            inner.append((inner_headers.get("content-id"), _parse_http_response(inner_body)))
+        return inner
+    return _parse_http_response(body)
+
+
+def parse_batch_response(content_type, body, operations, groups):
+    """
+    Map a $batch response back onto the operations that produced it.
+
+    Returns a list of BatchResult aligned with `operations`. A failed
+    changeset comes back as a single error response; it is reported for
+    every operation in that changeset.
+    """
+    if isinstance(body, bytes):
+        body = body.decode("utf-8")
+
+    parts = [_parse_part(part) for part in _split_multipart(body, _boundary(content_type))]
+    if len(parts) != len(groups):
+        raise ValueError(
+            f"$batch response has {len(parts)} part(s) but {len(groups)} were sent."
+        )
+
+    results = [None] * len(operations)
+    for (is_changeset, indexes), part in zip(groups, parts):
+        if isinstance(part, BatchResult):
+            for index in indexes:
+                results[index] = part
+            continue
+
+        by_content_id = {content_id: result for content_id, result in part if content_id}
+        for position, index in enumerate(indexes):
+            result = by_content_id.get(str(index + 1))
+            if result is None and position < len(part):
+                result = part[position][1]
+            results[index] = result
+
+    missing = [operations[i] for i, result in enumerate(results) if result is None]
+    if missing:
+        raise ValueError(f"$batch response is missing results for {missing}")
+    return results
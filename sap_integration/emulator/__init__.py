@@ -0,0 +1,13 @@
+"""
+Local SAP B1 Service Layer emulator for benchmarks and fault injection.
+
+Serves the endpoints the project uses (/Login, /Logout,
+/CompanyService_GetCompanyInfo, /BusinessPartners, /PurchaseDeliveryNotes,
+/PurchaseInvoices, /BusinessPlaces, /Attachments2 and $batch) from seeded
+synthetic data. Run it with `python manage.py sap_emulator` and point
+SAP_SERVICE_LAYER_URL at the printed service root.
+"""
+from .data import SyntheticCompany
+from .server import EmulatorConfig, EmulatorServer, SAPEmulator, start_emulator
+
+__all__ = ["EmulatorConfig", "EmulatorServer", "SAPEmulator", "SyntheticCompany", "start_emulator"]
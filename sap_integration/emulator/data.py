@@ -0,0 +1,295 @@
+"""
+Seeded synthetic company data for the emulator.
+
+The same seed and sizes always produce the same company. GRN headers are
+held in memory (about 100k fit comfortably); their lines are derived from
+the seed on demand, so only quantities changed by posted invoices are stored.
+"""
+import copy
+import random
+import threading
+from datetime import date, datetime, timedelta
+
+
+OPEN = "bost_Open"
+CLOSED = "bost_Close"
+GRN_OBJECT_TYPE = 20
+
+NAME_PARTS = (
+    ("Gulf", "Emirates", "Al Noor", "Desert", "Falcon", "Pearl", "Oasis", "Crescent", "Horizon", "Summit",
+     "Blue Coast", "Golden Sands", "Delta", "Atlas", "Sahara", "Marina", "Royal", "Arabian", "Eastern", "Union"),
+    ("Steel", "Building Materials", "Trading", "Electrical", "Hardware", "Industrial Supplies", "Plastics",
+     "Timber", "Chemicals", "Paints", "Cables", "Scaffolding", "Safety Equipment", "Pipes", "Tools"),
+    ("LLC", "Est", "Trading LLC", "FZE", "Co. W.L.L", "L.L.C", "Limited", "General Trading"),
+)
+ITEMS = (
+    ("RB12", "Steel rebar 12mm", 250.0), ("RB16", "Steel rebar 16mm", 310.0), ("BW12", "Binding wire 1.2mm", 35.0),
+    ("CM50", "Portland cement 50kg", 18.5), ("SD01", "Sand (washed) m3", 45.0), ("PV40", "PVC pipe 40mm", 12.75),
+    ("CB25", "Copper cable 2.5mm", 4.2), ("PT20", "Emulsion paint 20L", 160.0), ("PL18", "Plywood 18mm sheet", 95.0),
+    ("GL01", "Safety gloves (pair)", 6.5), ("HM01", "Safety helmet", 22.0), ("BL10", "Hex bolt M10", 0.85),
+)
+VAT_RATE = 0.05
+
+
+def _time(seconds):
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+class SyntheticCompany:
+    """Suppliers, branches and GRNs generated from `seed`, plus what clients post."""
+
+    def __init__(self, seed=1, grns=2000, vendors=200, branches=3, open_ratio=0.6, max_lines=8,
+                 start_docnum=4000, start_date=date(2024, 1, 1)):
+        self.seed = seed
+        self.max_lines = max_lines
+        self.lock = threading.RLock()
+        rng = random.Random(seed)
+
+        self.branches = [
+            {"BPLID": number, "BPLName": f"Branch {number}", "Disabled": "tNO", "DefaultCurrency": "AED"}
+            for number in range(1, branches + 1)
+        ]
+
+        self.partners = []
+        used_names = set()
+        for index in range(vendors):
+            name = " ".join(rng.choice(part) for part in NAME_PARTS)
+            if name in used_names:
+                name = f"{name} {index}"
+            used_names.add(name)
+            self.partners.append({
+                "CardCode": f"S{index + 1:05d}",
+                "CardName": name,
+                "CardType": "cSupplier",
+                "Currency": "AED",
+                "Valid": "tYES",
+            })
+        self.partners_by_code = {partner["CardCode"]: partner for partner in self.partners}
+
+        span_days = max(1, (date.today() - start_date).days)
+        self.grns = []
+        self.grns_by_entry = {}
+        self.grns_by_vendor = {}
+        for doc_entry in range(1, grns + 1):
+            partner = self.partners[rng.randrange(vendors)]
+            doc_date = start_date + timedelta(days=span_days * doc_entry // max(grns, 1))
+            update_date = doc_date + timedelta(days=rng.randrange(0, 5))
+            header = {
+                "DocEntry": doc_entry,
+                "DocNum": start_docnum + doc_entry,
+                "DocDate": doc_date.isoformat(),
+                "UpdateDate": min(update_date, date.today()).isoformat(),
+                "UpdateTime": _time(rng.randrange(7 * 3600, 19 * 3600)),
+                "CardCode": partner["CardCode"],
+                "CardName": partner["CardName"],
+                "DocumentStatus": OPEN if rng.random() < open_ratio else CLOSED,
+                "BPL_IDAssignedToInvoice": rng.randint(1, branches),
+            }
+            self.grns.append(header)
+            self.grns_by_entry[doc_entry] = header
+            self.grns_by_vendor.setdefault(partner["CardCode"], []).append(header)
+
+        # Quantities still open per (DocEntry, LineNum) once invoices were posted
+        self.open_quantities = {}
+        self.invoices = []
+        self.attachments = {}
+        self.next_invoice_entry = 1
+        self.next_invoice_num = 90000
+        self.next_attachment_entry = 1
+
+    # ------------------------------------------------------------------
+    # GRNs
+    # ------------------------------------------------------------------
+
+    def _lines(self, header):
+        rng = random.Random(self.seed * 1000003 + header["DocEntry"])
+        closed = header["DocumentStatus"] != OPEN
+        lines = []
+        for line_num, (code, description, price) in enumerate(
+            rng.sample(ITEMS, rng.randint(1, min(self.max_lines, len(ITEMS))))
+        ):
+            quantity = float(rng.choice((1, 2, 5, 10, 12, 20, 25, 50, 100)))
+            remaining = self.open_quantities.get((header["DocEntry"], line_num), 0.0 if closed else quantity)
+            line_total = round(quantity * price, 2)
+            tax = round(line_total * VAT_RATE, 2)
+            lines.append({
+                "LineNum": line_num,
+                "ItemCode": code,
+                "ItemDescription": description,
+                "Quantity": quantity,
+                "RemainingOpenQuantity": remaining,
+                "OpenQuantity": remaining,
+                "LineStatus": OPEN if remaining > 0 else CLOSED,
+                "Price": price,
+                "UnitPrice": price,
+                "PriceAfterVAT": round(price * (1 + VAT_RATE), 2),
+                "LineTotal": line_total,
+                "TaxAmount": tax,
+                "TaxTotal": tax,
+                "VatGroup": "S1",
+                "WarehouseCode": f"WH{header['BPL_IDAssignedToInvoice']:02d}",
+            })
+        return lines
+
+    def grn_document(self, header):
+        """The full PurchaseDeliveryNote for a header, as the Service Layer returns it."""
+        lines = self._lines(header)
+        total = round(sum(line["LineTotal"] for line in lines), 2)
+        vat = round(sum(line["TaxAmount"] for line in lines), 2)
+        return {
+            **header,
+            "TaxDate": header["DocDate"],
+            "CreationDate": header["DocDate"],
+            "DocTotal": round(total + vat, 2),
+            "DocTotalFc": 0.0,
+            "DocTotalSys": round(total + vat, 2),
+            "VatSum": vat,
+            "DocCurrency": "AED",
+            "AddressExtension": {"ShipToCountry": "AE", "BillToCountry": "AE"},
+            "TaxExtension": {"TaxId0": None, "State": None},
+            "DocumentLines": lines,
+        }
+
+    def candidate_grns(self, card_codes=None, doc_entries=None):
+        """GRN headers to test against a filter, narrowed by an index when possible."""
+        if doc_entries is not None:
+            return [self.grns_by_entry[entry] for entry in sorted(doc_entries) if entry in self.grns_by_entry]
+        if card_codes is not None:
+            headers = [header for code in card_codes for header in self.grns_by_vendor.get(code, ())]
+            return sorted(headers, key=lambda header: header["DocEntry"])
+        return self.grns
+
+    # ------------------------------------------------------------------
+    # Purchase invoices
+    # ------------------------------------------------------------------
+
+    def snapshot(self):
+        """State changed by writes, for rolling back a failed $batch changeset."""
+        return (
+            copy.deepcopy(self.open_quantities),
+            {entry: header["DocumentStatus"] for entry, header in self.grns_by_entry.items()
+             if header["DocumentStatus"] == CLOSED},
+            len(self.invoices),
+            self.next_invoice_entry,
+            self.next_invoice_num,
+        )
+
+    def restore(self, snapshot):
+        open_quantities, closed, invoice_count, next_entry, next_num = snapshot
+        for header in self.grns:
+            if header["DocumentStatus"] == CLOSED and header["DocEntry"] not in closed:
+                header["DocumentStatus"] = OPEN
+        self.open_quantities = open_quantities
+        del self.invoices[invoice_count:]
+        self.next_invoice_entry = next_entry
+        self.next_invoice_num = next_num
+
+    def post_invoice(self, body):
+        """
+        Create a PurchaseInvoice based on GRN lines.
+
+        Returns the created document; raises ValueError with an SAP-style
+        message when the payload does not fit the open GRNs.
+        """
+        card_code = body.get("CardCode")
+        if card_code not in self.partners_by_code:
+            raise ValueError(f"Invalid BP code '{card_code}'")
+        lines = body.get("DocumentLines") or []
+        if not lines:
+            raise ValueError("Document must contain at least one line")
+
+        with self.lock:
+            updates = []
+            documents = {}
+            for line in lines:
+                if line.get("BaseType") != GRN_OBJECT_TYPE:
+                    raise ValueError("Only lines based on Goods Receipt POs (BaseType 20) are supported")
+                header = self.grns_by_entry.get(line.get("BaseEntry"))
+                if header is None or header["CardCode"] != card_code:
+                    raise ValueError(f"Base document {line.get('BaseEntry')} not found for BP '{card_code}'")
+                if header["DocumentStatus"] != OPEN:
+                    raise ValueError(f"Base document {header['DocNum']} is already closed")
+                document = documents.setdefault(header["DocEntry"], self.grn_document(header))
+                base_line = next(
+                    (grn_line for grn_line in document["DocumentLines"] if grn_line["LineNum"] == line.get("BaseLine")),
+                    None,
+                )
+                quantity = float(line.get("Quantity") or 0)
+                if base_line is None:
+                    raise ValueError(f"Base line {line.get('BaseLine')} not found in document {header['DocNum']}")
+                if quantity <= 0 or quantity > base_line["RemainingOpenQuantity"] + 1e-9:
+                    raise ValueError(
+                        f"Quantity {quantity:g} exceeds open quantity {base_line['RemainingOpenQuantity']:g} "
+                        f"of line {base_line['LineNum']} in document {header['DocNum']}"
+                    )
+                base_line["RemainingOpenQuantity"] -= quantity
+                updates.append((header, base_line, quantity))
+
+            now = datetime.now()
+            invoice_lines = []
+            for line_num, (header, base_line, quantity) in enumerate(updates):
+                self.open_quantities[(header["DocEntry"], base_line["LineNum"])] = base_line["RemainingOpenQuantity"]
+                invoice_lines.append({
+                    "LineNum": line_num,
+                    "ItemCode": base_line["ItemCode"],
+                    "ItemDescription": base_line["ItemDescription"],
+                    "BaseType": GRN_OBJECT_TYPE,
+                    "BaseEntry": header["DocEntry"],
+                    "BaseLine": base_line["LineNum"],
+                    "Quantity": quantity,
+                    "Price": base_line["Price"],
+                    "LineTotal": round(quantity * base_line["Price"], 2),
+                })
+            for doc_entry, document in documents.items():
+                header = self.grns_by_entry[doc_entry]
+                if all(line["RemainingOpenQuantity"] <= 1e-9 for line in document["DocumentLines"]):
+                    header["DocumentStatus"] = CLOSED
+                header["UpdateDate"] = now.date().isoformat()
+                header["UpdateTime"] = now.strftime("%H:%M:%S")
+
+            total = round(sum(line["LineTotal"] for line in invoice_lines), 2)
+            vat = round(total * VAT_RATE, 2)
+            invoice = {
+                "DocEntry": self.next_invoice_entry,
+                "DocNum": self.next_invoice_num,
+                "DocType": "dDocument_Items",
+                "DocDate": body.get("DocDate") or now.date().isoformat(),
+                "DocDueDate": body.get("DocDueDate") or body.get("DocDate") or now.date().isoformat(),
+                "TaxDate": body.get("TaxDate") or now.date().isoformat(),
+                "CardCode": card_code,
+                "CardName": self.partners_by_code[card_code]["CardName"],
+                "NumAtCard": body.get("NumAtCard"),
+                "BPL_IDAssignedToInvoice": body.get("BPL_IDAssignedToInvoice"),
+                "DocTotal": round(total + vat, 2),
+                "VatSum": vat,
+                "DocCurrency": "AED",
+                "DocumentStatus": OPEN,
+                "DocumentLines": invoice_lines,
+            }
+            self.invoices.append(invoice)
+            self.next_invoice_entry += 1
+            self.next_invoice_num += 1
+            return invoice
+
+    # ------------------------------------------------------------------
+    # Attachments
+    # ------------------------------------------------------------------
+
+    def add_attachment(self, filename, size):
+        with self.lock:
+            entry = self.next_attachment_entry
+            self.next_attachment_entry += 1
+            name, _, extension = filename.rpartition(".")
+            self.attachments[entry] = {
+                "AbsoluteEntry": entry,
+                "Attachments2_Lines": [{
+                    "LineNum": 1,
+                    "SourcePath": "C:\\SAP\\Attachments",
+                    "FileName": name or extension,
+                    "FileExtension": extension if name else "",
+                    "AttachmentDate": date.today().isoformat(),
+                    "Override": "tNO",
+                    "FreeText": f"{size} bytes",
+                }],
+            }
+            return self.attachments[entry]
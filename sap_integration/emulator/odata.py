@@ -0,0 +1,189 @@
+"""
+The subset of OData query options the project sends to the Service Layer:
+$filter (comparisons joined by and/or/not, parentheses), $select, $orderby,
+$top, $skip and `Prefer: odata.maxpagesize`.
+"""
+import re
+
+
+class ODataError(ValueError):
+    """A query the emulator cannot evaluate; answered with HTTP 400."""
+    pass
+
+
+TOKEN_PATTERN = re.compile(
+    r"\s*(?:(?P<string>'(?:[^']|'')*')|(?P<number>-?\d+(?:\.\d+)?)|(?P<paren>[()])|(?P<word>[A-Za-z_][\w/]*))"
+)
+COMPARISONS = {
+    "eq": lambda a, b: a == b,
+    "ne": lambda a, b: a != b,
+    "gt": lambda a, b: a is not None and a > b,
+    "ge": lambda a, b: a is not None and a >= b,
+    "lt": lambda a, b: a is not None and a < b,
+    "le": lambda a, b: a is not None and a <= b,
+}
+
+
+def _tokenize(text):
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = TOKEN_PATTERN.match(text, position)
+        if not match or match.end() == position:
+            raise ODataError(f"Cannot parse $filter near: {text[position:position + 30]!r}")
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "string":
+            tokens.append(("literal", value[1:-1].replace("''", "'")))
+        elif kind == "number":
+            tokens.append(("literal", float(value) if "." in value else int(value)))
+        elif kind == "paren":
+            tokens.append((value, value))
+        elif value in ("true", "false", "null"):
+            tokens.append(("literal", {"true": True, "false": False, "null": None}[value]))
+        elif value in ("and", "or", "not") or value in COMPARISONS:
+            tokens.append((value, value))
+        else:
+            tokens.append(("field", value))
+    return tokens
+
+
+class _Parser:
+    """Recursive descent: or_expr := and_expr ('or' and_expr)*, and so on down to comparisons."""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position][0] if self.position < len(self.tokens) else None
+
+    def take(self, kind=None):
+        if self.position >= len(self.tokens):
+            raise ODataError("Unexpected end of $filter")
+        token = self.tokens[self.position]
+        if kind and token[0] != kind:
+            raise ODataError(f"Expected {kind} in $filter, got {token[1]!r}")
+        self.position += 1
+        return token
+
+    def parse(self):
+        node = self.or_expr()
+        if self.position != len(self.tokens):
+            raise ODataError(f"Unexpected {self.tokens[self.position][1]!r} in $filter")
+        return node
+
+    def or_expr(self):
+        node = self.and_expr()
+        while self.peek() == "or":
+            self.take()
+            node = ("or", node, self.and_expr())
+        return node
+
+    def and_expr(self):
+        node = self.unary()
+        while self.peek() == "and":
+            self.take()
+            node = ("and", node, self.unary())
+        return node
+
+    def unary(self):
+        if self.peek() == "not":
+            self.take()
+            return ("not", self.unary())
+        if self.peek() == "(":
+            self.take()
+            node = self.or_expr()
+            self.take(")")
+            return node
+        return self.comparison()
+
+    def comparison(self):
+        field = self.take("field")[1]
+        operator = self.take()[0]
+        if operator not in COMPARISONS:
+            raise ODataError(f"Unsupported operator {operator!r} in $filter")
+        return ("cmp", operator, field, self.take("literal")[1])
+
+
+def parse_filter(text):
+    """Parse a $filter expression into a tree; None for an empty filter."""
+    if not text or not text.strip():
+        return None
+    return _Parser(_tokenize(text)).parse()
+
+
+def matches(node, row):
+    if node is None:
+        return True
+    kind = node[0]
+    if kind == "and":
+        return matches(node[1], row) and matches(node[2], row)
+    if kind == "or":
+        return matches(node[1], row) or matches(node[2], row)
+    if kind == "not":
+        return not matches(node[1], row)
+    _, operator, field, literal = node
+    value = row.get(field)
+    try:
+        return COMPARISONS[operator](value, literal)
+    except TypeError:
+        return False
+
+
+def equality_terms(node, field):
+    """
+    Values `field` must equal for the filter to match (top-level `and` terms
+    only), so callers can use an index. None when the filter does not pin it.
+    """
+    if node is None:
+        return None
+    if node[0] == "and":
+        left = equality_terms(node[1], field)
+        return left if left is not None else equality_terms(node[2], field)
+    if node[0] == "cmp" and node[1] == "eq" and node[2] == field:
+        return {node[3]}
+    if node[0] == "or":
+        left, right = equality_terms(node[1], field), equality_terms(node[2], field)
+        if left is not None and right is not None:
+            return left | right
+    return None
+
+
+def parse_orderby(text):
+    """'DocEntry desc,CardCode' -> [("DocEntry", True), ("CardCode", False)] (field, descending)."""
+    order = []
+    for part in (text or "").split(","):
+        words = part.split()
+        if not words:
+            continue
+        if len(words) > 2 or (len(words) == 2 and words[1] not in ("asc", "desc")):
+            raise ODataError(f"Unsupported $orderby: {text!r}")
+        order.append((words[0], len(words) == 2 and words[1] == "desc"))
+    return order
+
+
+def apply_orderby(rows, order):
+    # Stable sorts from the last key to the first give a multi-key order
+    for field, descending in reversed(order):
+        rows.sort(key=lambda row: (row.get(field) is None, row.get(field)), reverse=descending)
+    return rows
+
+
+def parse_select(text):
+    fields = [field.strip() for field in (text or "").split(",") if field.strip()]
+    return fields or None
+
+
+def apply_select(row, fields):
+    if not fields:
+        return row
+    return {field: row[field] for field in fields if field in row}
+
+
+def max_page_size(prefer_header, default):
+    """Page size asked for with `Prefer: odata.maxpagesize=N`."""
+    match = re.search(r"odata\.maxpagesize\s*=\s*(\d+)", prefer_header or "")
+    return int(match.group(1)) if match else default
@@ -0,0 +1,470 @@
+"""
+HTTP front end of the emulator: a ThreadingHTTPServer speaking enough of the
+Service Layer protocol (sessions, OData collections, $count, $batch) for
+SAPService and AsyncSAPService, with injectable latency and faults.
+"""
+import re
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+from ..batch import CRLF, _boundary, _split_headers, _split_multipart
+from .data import SyntheticCompany
+from .odata import (
+    ODataError, apply_orderby, apply_select, equality_terms, matches, max_page_size, parse_filter,
+    parse_orderby, parse_select,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+BASE_PATH = "/b1s/v1"
+ENTITY_PATTERN = re.compile(r"^/(?P<entity>[A-Za-z_]\w*)(?:\((?P<key>[^)]*)\))?(?P<count>/\$count)?$")
+NEXT_LINK_SAFE = "$,'()"
+REASONS = {200: "OK", 201: "Created", 204: "No Content", 400: "Bad Request", 401: "Unauthorized",
+           404: "Not Found", 405: "Method Not Allowed", 429: "Too Many Requests",
+           500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class EmulatorConfig:
+    """Behaviour knobs of the emulator; every fault is off by default."""
+
+    def __init__(self, latency_ms=0, latency_jitter_ms=0, latency_per_row_ms=0.0,
+                 session_timeout_seconds=1800, session_drop_rate=0.0,
+                 error_rate_429=0.0, error_rate_5xx=0.0, retry_after_seconds=1,
+                 default_page_size=20, max_page_size=5000, seed=1):
+        # Every request sleeps latency_ms + uniform(0, latency_jitter_ms), plus
+        # latency_per_row_ms for each document returned
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.latency_per_row_ms = latency_per_row_ms
+        # Idle sessions expire (401) after this; session_drop_rate answers 401
+        # at random, as after a Service Layer restart
+        self.session_timeout_seconds = session_timeout_seconds
+        self.session_drop_rate = session_drop_rate
+        self.error_rate_429 = error_rate_429
+        self.error_rate_5xx = error_rate_5xx
+        self.retry_after_seconds = retry_after_seconds
+        # Page size without `Prefer: odata.maxpagesize` (SAP's default is 20)
+        self.default_page_size = default_page_size
+        self.max_page_size = max_page_size
+        self.seed = seed
+
+
+class EmulatorResponse:
+    def __init__(self, status, body=None, headers=None, content_type="application/json"):
+        self.status = status
+        self.headers = dict(headers or {})
+        if body is None:
+            self.body = b""
+        elif isinstance(body, bytes):
+            self.body = body
+            self.headers.setdefault("Content-Type", content_type)
+        elif isinstance(body, str):
+            self.body = body.encode("utf-8")
+            self.headers.setdefault("Content-Type", "text/plain; charset=utf-8")
+        else:
+            self.body = json.dumps(body).encode("utf-8")
+            self.headers.setdefault("Content-Type", "application/json; odata=minimalmetadata; charset=utf-8")
+
+
+def sap_error(status, message, code=-1):
+    return EmulatorResponse(status, {"error": {"code": code, "message": {"lang": "en-us", "value": message}}})
+
+
+def _key(text):
+    if text is None:
+        return None
+    text = text.strip()
+    if text.startswith("'") and text.endswith("'"):
+        return text[1:-1].replace("''", "'")
+    try:
+        return int(text)
+    except ValueError:
+        raise ODataError(f"Invalid key: {text!r}")
+
+
+class SAPEmulator:
+    """
+    Request handling of the emulated Service Layer, independent of the HTTP server.
+
+    `handle(method, path, query, headers, body)` returns an EmulatorResponse;
+    the server adds latency and faults around it.
+    """
+
+    def __init__(self, company=None, config=None):
+        self.company = company or SyntheticCompany()
+        self.config = config or EmulatorConfig()
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        self.random = random.Random(self.config.seed)
+        self.random_lock = threading.Lock()
+        self.stats = {"requests": 0, "logins": 0, "401": 0, "429": 0, "5xx": 0}
+
+    def _chance(self, rate):
+        if rate <= 0:
+            return False
+        with self.random_lock:
+            return self.random.random() < rate
+
+    # ------------------------------------------------------------------
+    # Sessions and faults
+    # ------------------------------------------------------------------
+
+    def login(self, body):
+        if not isinstance(body, dict) or not body.get("UserName") or not body.get("CompanyDB"):
+            return sap_error(401, "Fail to get DB Credentials from SLD server", code=-304)
+        session_id = str(uuid.uuid4())
+        with self.sessions_lock:
+            self.sessions[session_id] = time.time()
+            self.stats["logins"] += 1
+        # SAP reports the timeout in minutes; the emulator enforces it to the second
+        timeout_minutes = max(1, round(self.config.session_timeout_seconds / 60))
+        return EmulatorResponse(
+            200,
+            {
+                "odata.metadata": f"{BASE_PATH}/$metadata#B1Sessions/@Element",
+                "SessionId": session_id,
+                "Version": "1000190",
+                "SessionTimeout": timeout_minutes,
+            },
+            headers={"Set-Cookie": [f"B1SESSION={session_id}; HttpOnly; Path={BASE_PATH}/", "ROUTEID=.node0; Path=/b1s"]},
+        )
+
+    def session_fault(self, session_id):
+        """401 response when the session is unknown, idle past the timeout or randomly dropped."""
+        now = time.time()
+        with self.sessions_lock:
+            last_used = self.sessions.get(session_id)
+            expired = last_used is None or now - last_used > self.config.session_timeout_seconds
+            if expired or self._chance(self.config.session_drop_rate):
+                self.sessions.pop(session_id, None)
+                self.stats["401"] += 1
+                return sap_error(401, "Invalid session or session already timeout.", code=301)
+            self.sessions[session_id] = now
+        return None
+
+    def injected_fault(self):
+        if self._chance(self.config.error_rate_429):
+            self.stats["429"] += 1
+            response = sap_error(429, "Too many requests (emulated)")
+            response.headers["Retry-After"] = str(self.config.retry_after_seconds)
+            return response
+        if self._chance(self.config.error_rate_5xx):
+            self.stats["5xx"] += 1
+            return sap_error(503, "Service Unavailable (emulated)")
+        return None
+
+    # ------------------------------------------------------------------
+    # Routing
+    # ------------------------------------------------------------------
+
+    def handle(self, method, path, query, headers, body, session_id=None):
+        with self.sessions_lock:
+            self.stats["requests"] += 1
+        if path == "/Login" and method == "POST":
+            try:
+                return self.login(_json(body))
+            except ODataError as e:
+                return sap_error(400, str(e))
+        if path == "/Logout" and method == "POST":
+            with self.sessions_lock:
+                self.sessions.pop(session_id, None)
+            return EmulatorResponse(204)
+
+        fault = self.session_fault(session_id) or self.injected_fault()
+        if fault is not None:
+            return fault
+        return self.dispatch(method, path, query, headers, body)
+
+    def dispatch(self, method, path, query, headers, body):
+        try:
+            if path == "/$batch" and method == "POST":
+                return self.batch(headers.get("content-type", ""), body)
+            if path == "/CompanyService_GetCompanyInfo" and method == "POST":
+                return EmulatorResponse(200, {
+                    "CompanyName": "Emulated Trading LLC",
+                    "Version": "1000190",
+                    "LocalCurrency": "AED",
+                    "SystemCurrency": "AED",
+                })
+
+            match = ENTITY_PATTERN.match(path)
+            if not match:
+                return sap_error(404, f"Resource not found for the segment '{path}'")
+            entity, key, count = match.group("entity"), _key(match.group("key")), bool(match.group("count"))
+            handler = getattr(self, f"{method.lower()}_{entity.lower()}", None)
+            if handler is None:
+                return sap_error(405, f"{method} is not supported on {entity} by the emulator")
+            return handler(key=key, count=count, query=query, headers=headers, body=body)
+        except ODataError as e:
+            return sap_error(400, str(e))
+        except ValueError as e:
+            return sap_error(400, str(e), code=-5002)
+
+    # ------------------------------------------------------------------
+    # Collections
+    # ------------------------------------------------------------------
+
+    def collection(self, entity, rows, query, headers, count=False, materialize=None):
+        """Apply $filter/$orderby/$top/$skip/$select and server paging to `rows`."""
+        node = parse_filter(query.get("$filter"))
+        rows = [row for row in rows if matches(node, row)]
+        if count:
+            return EmulatorResponse(200, str(len(rows)))
+
+        order = parse_orderby(query.get("$orderby"))
+        if order:
+            rows = apply_orderby(rows, order)
+        skip = int(query.get("$skip") or 0)
+        top = int(query["$top"]) if query.get("$top") else None
+        rows = rows[skip:] if top is None else rows[skip:skip + top]
+
+        page_size = min(max_page_size(headers.get("prefer"), self.config.default_page_size), self.config.max_page_size)
+        page = rows[:page_size]
+        if materialize:
+            page = [materialize(row) for row in page]
+        fields = parse_select(query.get("$select"))
+        body = {
+            "odata.metadata": f"{BASE_PATH}/$metadata#{entity}",
+            "value": [apply_select(row, fields) for row in page],
+        }
+        if len(rows) > len(page):
+            next_query = {**query, "$skip": str(skip + len(page))}
+            if top is not None:
+                next_query["$top"] = str(top - len(page))
+            # Relative to the service root, as SAP sends it
+            body["odata.nextLink"] = f"{entity}?{urlencode(next_query, safe=NEXT_LINK_SAFE)}"
+        self.row_cost(len(page))
+        return EmulatorResponse(200, body)
+
+    def row_cost(self, rows):
+        if self.config.latency_per_row_ms and rows:
+            time.sleep(self.config.latency_per_row_ms * rows / 1000)
+
+    def get_purchasedeliverynotes(self, key, count, query, headers, body):
+        company = self.company
+        with company.lock:
+            if key is not None:
+                header = company.grns_by_entry.get(key)
+                if header is None:
+                    return sap_error(404, "No matching records found (ODBC -2028)", code=-2028)
+                return EmulatorResponse(200, apply_select(company.grn_document(header), parse_select(query.get("$select"))))
+
+            node = parse_filter(query.get("$filter"))
+            entries = equality_terms(node, "DocEntry")
+            codes = equality_terms(node, "CardCode")
+            rows = company.candidate_grns(card_codes=codes, doc_entries=entries)
+            return self.collection("PurchaseDeliveryNotes", rows, query, headers, count, company.grn_document)
+
+    def get_businesspartners(self, key, count, query, headers, body):
+        company = self.company
+        if key is not None:
+            partner = company.partners_by_code.get(key)
+            if partner is None:
+                return sap_error(404, "No matching records found (ODBC -2028)", code=-2028)
+            return EmulatorResponse(200, apply_select(partner, parse_select(query.get("$select"))))
+        return self.collection("BusinessPartners", company.partners, query, headers, count)
+
+    def get_businessplaces(self, key, count, query, headers, body):
+        return self.collection("BusinessPlaces", self.company.branches, query, headers, count)
+
+    def get_purchaseinvoices(self, key, count, query, headers, body):
+        company = self.company
+        with company.lock:
+            if key is not None:
+                invoice = next((invoice for invoice in company.invoices if invoice["DocEntry"] == key), None)
+                if invoice is None:
+                    return sap_error(404, "No matching records found (ODBC -2028)", code=-2028)
+                return EmulatorResponse(200, apply_select(invoice, parse_select(query.get("$select"))))
+            return self.collection("PurchaseInvoices", list(company.invoices), query, headers, count)
+
+    def post_purchaseinvoices(self, key, count, query, headers, body):
+        invoice = self.company.post_invoice(_json(body))
+        return EmulatorResponse(201, invoice)
+
+    def post_attachments2(self, key, count, query, headers, body):
+        content_type = headers.get("content-type", "")
+        message = BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode("utf-8") + body)
+        parts = [part for part in message.walk() if part.get_filename()]
+        if not parts:
+            raise ValueError("No file found in the upload")
+        payload = parts[0].get_payload(decode=True) or b""
+        return EmulatorResponse(201, self.company.add_attachment(parts[0].get_filename(), len(payload)))
+
+    def get_attachments2(self, key, count, query, headers, body):
+        attachment = self.company.attachments.get(key)
+        if attachment is None:
+            return sap_error(404, "No matching records found (ODBC -2028)", code=-2028)
+        return EmulatorResponse(200, attachment)
+
+    def delete_attachments2(self, key, count, query, headers, body):
+        with self.company.lock:
+            if self.company.attachments.pop(key, None) is None:
+                return sap_error(404, "No matching records found (ODBC -2028)", code=-2028)
+        return EmulatorResponse(204)
+
+    # ------------------------------------------------------------------
+    # $batch
+    # ------------------------------------------------------------------
+
+    def _batch_operation(self, text):
+        """Run one application/http request part; returns its EmulatorResponse."""
+        text = text.replace("\r\n", "\n")
+        request_line, _, rest = text.partition("\n")
+        try:
+            method, target, _ = request_line.split(" ", 2)
+        except ValueError:
+            raise ODataError(f"Malformed request line in $batch: {request_line!r}")
+        headers, body = _split_headers(rest)
+        split = urlsplit(target)
+        path = split.path[len(BASE_PATH):] if split.path.startswith(BASE_PATH) else split.path
+        return self.dispatch(method.upper(), path, _query(split.query), headers, body.strip().encode("utf-8"))
+
+    def batch(self, content_type, body):
+        batch_boundary = f"batchresponse_{uuid.uuid4()}"
+        parts = []
+        for part in _split_multipart(body.decode("utf-8"), _boundary(content_type)):
+            part_headers, part_body = _split_headers(part)
+            part_type = part_headers.get("content-type", "")
+            if not part_type.startswith("multipart/mixed"):
+                parts.append(_http_part(self._batch_operation(part_body)))
+                continue
+
+            # Changeset: all or nothing; a failure is reported once for the whole set
+            with self.company.lock:
+                snapshot = self.company.snapshot()
+                results = []
+                for inner in _split_multipart(part_body, _boundary(part_type)):
+                    inner_headers, inner_body = _split_headers(inner)
+                    response = self._batch_operation(inner_body)
+                    if response.status >= 400:
+                        self.company.restore(snapshot)
+                        results = None
+                        parts.append(_http_part(response))
+                        break
+                    results.append((inner_headers.get("content-id"), response))
+            if results is not None:
+                changeset_boundary = f"changesetresponse_{uuid.uuid4()}"
+                inner_parts = "".join(
+                    f"--{changeset_boundary}{CRLF}{_http_part(response, content_id)}{CRLF}"
+                    for content_id, response in results
+                )
+                parts.append(
+                    f"Content-Type: multipart/mixed; boundary={changeset_boundary}{CRLF}{CRLF}"
+                    f"{inner_parts}--{changeset_boundary}--"
+                )
+
+        response_body = "".join(f"--{batch_boundary}{CRLF}{part}{CRLF}" for part in parts)
+        response_body += f"--{batch_boundary}--{CRLF}"
+        return EmulatorResponse(
+            202, response_body.encode("utf-8"), content_type=f"multipart/mixed; boundary={batch_boundary}"
+        )
+
+
+def _json(body):
+    if not body:
+        return {}
+    try:
+        return json.loads(body)
+    except ValueError:
+        raise ODataError("Request body is not valid JSON")
+
+
+def _query(query_string):
+    # Clients send raw spaces and quotes in $filter; parse_qs undoes the percent-encoding
+    return {name: values[-1] for name, values in parse_qs(query_string, keep_blank_values=True).items()}
+
+
+def _http_part(response, content_id=None):
+    lines = ["Content-Type: application/http", "Content-Transfer-Encoding: binary"]
+    if content_id:
+        lines.append(f"Content-ID: {content_id}")
+    lines.append("")
+    lines.append(f"HTTP/1.1 {response.status} {REASONS.get(response.status, '')}")
+    for name, value in response.headers.items():
+        if name != "Set-Cookie":
+            lines.append(f"{name}: {value}")
+    lines.append("")
+    lines.append(response.body.decode("utf-8"))
+    return CRLF.join(lines)
+
+
+class EmulatorRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "SAPServiceLayerEmulator/1.0"
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def _respond(self):
+        emulator = self.server.emulator
+        config = emulator.config
+        delay_ms = config.latency_ms
+        if config.latency_jitter_ms:
+            with emulator.random_lock:
+                delay_ms += emulator.random.uniform(0, config.latency_jitter_ms)
+        if delay_ms:
+            time.sleep(delay_ms / 1000)
+
+        split = urlsplit(self.path)
+        if not split.path.startswith(BASE_PATH):
+            response = sap_error(404, f"Unknown service root; expected {BASE_PATH}")
+        else:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+            headers = {name.lower(): value for name, value in self.headers.items()}
+            cookies = dict(
+                cookie.strip().split("=", 1) for cookie in headers.get("cookie", "").split(";") if "=" in cookie
+            )
+            try:
+                response = emulator.handle(
+                    self.command,
+                    split.path[len(BASE_PATH):] or "/",
+                    _query(split.query),
+                    headers,
+                    body,
+                    session_id=cookies.get("B1SESSION"),
+                )
+            except Exception as e:
+                logger.exception(f"Emulator failed on {self.command} {self.path}")
+                response = sap_error(500, f"Emulator error: {e}")
+
+        self.send_response(response.status, REASONS.get(response.status))
+        for name, value in response.headers.items():
+            for item in value if isinstance(value, list) else [value]:
+                self.send_header(name, item)
+        self.send_header("Content-Length", str(len(response.body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(response.body)
+
+    do_GET = do_POST = do_PATCH = do_DELETE = do_PUT = _respond
+
+
+class EmulatorServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, emulator):
+        self.emulator = emulator
+        super().__init__(address, EmulatorRequestHandler)
+
+    @property
+    def service_root(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}{BASE_PATH}"
+
+
+def start_emulator(host="127.0.0.1", port=0, company=None, config=None):
+    """Start an emulator on a background thread; port 0 picks a free port. Call .shutdown() to stop."""
+    server = EmulatorServer((host, port), SAPEmulator(company, config))
+    thread = threading.Thread(target=server.serve_forever, name="sap-emulator", daemon=True)
+    thread.start()
+    logger.info(f"SAP Service Layer emulator listening on {server.service_root}")
+    return server
@@ -0,0 +1,65 @@
+import time
+from django.core.management.base import BaseCommand
+from sap_integration.emulator import EmulatorConfig, EmulatorServer, SAPEmulator, SyntheticCompany
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a local SAP B1 Service Layer emulator with seeded synthetic data. "
+        "Point SAP_SERVICE_LAYER_URL at the printed service root."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=50000)
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--grns", type=int, default=2000, help="Number of GRNs (up to ~100k)")
+        parser.add_argument("--vendors", type=int, default=200)
+        parser.add_argument("--branches", type=int, default=3)
+        parser.add_argument("--open-ratio", type=float, default=0.6, help="Share of GRNs that are open")
+        parser.add_argument("--latency-ms", type=float, default=0, help="Fixed latency per request")
+        parser.add_argument("--jitter-ms", type=float, default=0, help="Extra uniform random latency")
+        parser.add_argument("--row-latency-ms", type=float, default=0, help="Latency per document returned")
+        parser.add_argument("--session-timeout", type=int, default=1800, help="Idle seconds before a 401")
+        parser.add_argument("--session-drop-rate", type=float, default=0, help="Chance of a random 401")
+        parser.add_argument("--error-rate-429", type=float, default=0)
+        parser.add_argument("--error-rate-5xx", type=float, default=0)
+        parser.add_argument("--page-size", type=int, default=20, help="Page size without odata.maxpagesize")
+        parser.add_argument("--max-page-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        company = SyntheticCompany(
+            seed=options["seed"],
+            grns=options["grns"],
+            vendors=options["vendors"],
+            branches=options["branches"],
+            open_ratio=options["open_ratio"],
+        )
+        config = EmulatorConfig(
+            latency_ms=options["latency_ms"],
+            latency_jitter_ms=options["jitter_ms"],
+            latency_per_row_ms=options["row_latency_ms"],
+            session_timeout_seconds=options["session_timeout"],
+            session_drop_rate=options["session_drop_rate"],
+            error_rate_429=options["error_rate_429"],
+            error_rate_5xx=options["error_rate_5xx"],
+            default_page_size=options["page_size"],
+            max_page_size=options["max_page_size"],
+            seed=options["seed"],
+        )
+        server = EmulatorServer((options["host"], options["port"]), SAPEmulator(company, config))
+        open_grns = sum(1 for grn in company.grns if grn["DocumentStatus"] == "bost_Open")
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated {len(company.grns)} GRNs ({open_grns} open), {len(company.partners)} suppliers "
+            f"in {time.monotonic() - started:.1f}s"
+        ))
+        self.stdout.write(f"SAP_SERVICE_LAYER_URL={server.service_root}")
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(f"Stopped. Requests: {server.emulator.stats}")
@@ -1,9 +1,15 @@
 import os
 import time
-import requests
-import urllib3
+import queue
 import atexit
 import logging
+import threading
+import contextlib
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .batch import BatchOperation, build_batch_body, parse_batch_response
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -12,24 +18,141 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-class SAPService:
-    session = None  # Changed: Use requests.Session object
-    session_id = None
-    session_created_at = None
-    SESSION_TIMEOUT = 1800
+class SAPPoolExhausted(RuntimeError):
+    """Raised when no pooled SAP session becomes free within the checkout timeout."""
+    pass
 
-    @classmethod
-    def _get_session(cls):
-        """Initialize session if not exists"""
-        if cls.session is None:
-            cls.session = requests.Session()
-        return cls.session
 
-    @classmethod
-    def login(cls):
-        """Login to SAP Service Layer and establish session"""
+def _service_layer_url():
+    return os.getenv("SAP_SERVICE_LAYER_URL", "").rstrip("/")
+
+
+class _FlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Collapse concurrent calls for the same key into a single execution.
+
+    The first caller for a key runs the function; callers that arrive while
+    it is running wait for it and receive the same result or exception.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _FlightCall()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+def _rewind_files(kwargs):
+    """Seek uploaded file objects (and file-like bodies) back to the start before a request is resent."""
+    file_objs = [value[1] if isinstance(value, tuple) else value for value in (kwargs.get("files") or {}).values()]
+    file_objs += [kwargs.get("data"), kwargs.get("content")]
+    for file_obj in file_objs:
+        if hasattr(file_obj, "seek"):
+            file_obj.seek(0)
+
+
+class SAPSession:
+    """
+    One independently logged-in SAP B1 Service Layer session.
+
+    Each instance owns its own requests.Session, so the B1SESSION / ROUTEID
+    cookies of one session never overwrite those of another.
+    """
+
+    # Expire locally a little before SAP does, so we never send a request
+    # on a session that dies mid-flight.
+    EXPIRY_MARGIN = 60
+
+    def __init__(self, index, timeout=1800, adapter=None, login_flight=None, login_limit=None):
+        self.index = index
+        self.timeout = timeout
+        # Shared by every session of a pool, see refresh()
+        self.login_flight = login_flight
+        self.login_limit = login_limit
+        self.http = requests.Session()
+        if adapter is not None:
+            # The adapter (and its keep-alive connection pool) is shared by
+            # every pooled session; only the cookie jars are per session.
+            self.http.mount("https://", adapter)
+            self.http.mount("http://", adapter)
+        self.session_id = None
+        self.created_at = None
+        self.last_used_at = None
+
+    def is_expired(self):
+        """True if the session was never established or has been idle past its timeout."""
+        if not self.session_id or self.last_used_at is None:
+            return True
+        return time.time() - self.last_used_at > self.timeout - self.EXPIRY_MARGIN
+
+    def touch(self):
+        """Mark the session as used; SAP session timeouts are idle-based."""
+        self.last_used_at = time.time()
+
+    def refresh(self):
+        """
+        Re-establish this session, coordinated with the rest of the pool.
+
+        Each pooled session is its own SAP session (Service Layer serialises
+        requests per session, so slots cannot share one B1SESSION), which means
+        every slot that lost its session still needs its own /Login. What the
+        pool coordinates is how those logins reach SAP: the first session to
+        refresh logs in alone while the others wait for it. If that login fails
+        (SAP down, credentials rejected) they all get its error without trying
+        again; if it succeeds they log in after it, at most
+        ``login_limit`` at a time, so a 401 wave becomes a short queue of
+        logins rather than a burst.
+        """
+        if self.login_flight is None:
+            return self.login()
+
+        led = []
+
+        def _login():
+            led.append(True)
+            return self.login()
+
+        session_id = self.login_flight.do("login", _login)
+        if led:
+            return session_id
+        if self.login_limit is None:
+            return self.login()
+        with self.login_limit:
+            return self.login()
+
+    def login(self):
+        """Login to SAP Service Layer and establish this session"""
         # Validate environment variables
-        base_url = os.getenv("SAP_SERVICE_LAYER_URL", "").rstrip("/")
+        base_url = _service_layer_url()
         username = os.getenv("SAP_USERNAME", "")
         password = os.getenv("SAP_PASSWORD", "")
         company_db = os.getenv("SAP_COMPANY_DB", "")
@@ -49,26 +172,33 @@ class SAPService:
         headers = {"Content-Type": "application/json"}
 
         try:
-            # Use session object to maintain cookies
-            session = cls._get_session()
-            
-            logger.info(f"Attempting login to SAP at {base_url}")
-            resp = session.post(url, json=payload, headers=headers, verify=False, timeout=15)
+            # Start from a clean cookie jar so a stale ROUTEID is never reused
+            self.http.cookies.clear()
+
+            logger.info(f"Attempting login to SAP at {base_url} (pool slot {self.index})")
+            resp = self.http.post(url, json=payload, headers=headers, verify=False, timeout=15)
             resp.raise_for_status()
-            
+
             data = resp.json()
-            cls.session_id = data.get("SessionId")
-            cls.session_created_at = time.time()
+            session_id = data.get("SessionId")
 
-            if not cls.session_id:
+            if not session_id:
                 raise RuntimeError(f"SAP login did not return SessionId. Response: {data}")
 
-            logger.info(f"✅ SAP login successful. SessionId: {cls.session_id}")
-            
+            self.session_id = session_id
+            self.created_at = time.time()
+            self.touch()
+
+            # SAP reports the idle timeout in minutes
+            if data.get("SessionTimeout"):
+                self.timeout = int(data["SessionTimeout"]) * 60
+
+            logger.info(f"✅ SAP login successful (pool slot {self.index}). SessionId: {self.session_id}")
+
             # Log cookies for debugging
-            logger.debug(f"Session cookies: {session.cookies.get_dict()}")
-            
-            return cls.session_id
+            logger.debug(f"Session cookies: {self.http.cookies.get_dict()}")
+
+            return self.session_id
 
         except requests.exceptions.RequestException as e:
             logger.error(f"❌ SAP login failed: {e}")
@@ -77,41 +207,209 @@ class SAPService:
                 logger.error(f"Response body: {e.response.text}")
             raise
 
-    @classmethod
-    def ensure_session(cls):
-        """Ensure valid session exists, refresh if needed"""
-        # If no session exists, login
-        if not cls.session_id:
-            logger.info("No active session, logging in...")
-            return cls.login()
-
-        # Check if session has timed out
-        if time.time() - cls.session_created_at > cls.SESSION_TIMEOUT:
-            logger.info("Session timeout reached, validating session...")
+    def logout(self):
+        """Call SAP Logout if this session is active"""
+        if self.session_id:
             try:
-                cls.get_company_info()
-                logger.info("Session still valid")
+                self.http.post(f"{_service_layer_url()}/Logout", verify=False, timeout=10)
+                logger.info(f"✅ SAP session (pool slot {self.index}) logged out successfully")
             except Exception as e:
-                logger.warning(f"Session validation failed: {e}. Re-logging in...")
-                return cls.login()
+                logger.warning(f"⚠️ SAP logout failed: {e}")
+        self.session_id = None
+        self.created_at = None
+        self.last_used_at = None
+        self.http.close()
+
+    def status(self):
+        now = time.time()
+        return {
+            "slot": self.index,
+            "session_id": self.session_id,
+            "session_age_seconds": round(now - self.created_at, 2) if self.created_at else None,
+            "idle_seconds": round(now - self.last_used_at, 2) if self.last_used_at else None,
+            "timeout_seconds": self.timeout,
+            "expired": self.is_expired(),
+        }
+
+
+class SAPSessionPool:
+    """
+    A fixed-size pool of SAP sessions.
+
+    Callers check a session out, use it exclusively and return it. Sessions
+    are logged in lazily on checkout, and idle sessions are handed out
+    most-recently-used first so a quiet system only keeps one session warm.
+    """
+
+    def __init__(self, size, session_timeout=1800, adapter=None, login_concurrency=1):
+        if size < 1:
+            raise ValueError("SAP session pool size must be at least 1")
+        if login_concurrency < 1:
+            raise ValueError("SAP login concurrency must be at least 1")
+        self.size = size
+        self.adapter = adapter
+        self.login_flight = SingleFlight()
+        # Caps the follower logins that run after a shared login, see SAPSession.refresh()
+        self.login_limit = threading.BoundedSemaphore(login_concurrency)
+        self._sessions = [
+            SAPSession(
+                i,
+                timeout=session_timeout,
+                adapter=adapter,
+                login_flight=self.login_flight,
+                login_limit=self.login_limit,
+            )
+            for i in range(size)
+        ]
+        self._idle = queue.LifoQueue()
+        for session in self._sessions:
+            self._idle.put(session)
+
+    def acquire(self, timeout=None, force_login=False):
+        """Check out an idle session, logging it in if it has expired."""
+        try:
+            session = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise SAPPoolExhausted(
+                f"No SAP session became available within {timeout} seconds "
+                f"(pool size {self.size})."
+            )
+
+        try:
+            if force_login or session.is_expired():
+                session.refresh()
+        except Exception:
+            self._idle.put(session)
+            raise
+
+        return session
+
+    def release(self, session):
+        """Return a checked-out session to the pool."""
+        self._idle.put(session)
+
+    @contextlib.contextmanager
+    def checkout(self, timeout=None, force_login=False):
+        session = self.acquire(timeout=timeout, force_login=force_login)
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+    def status(self):
+        return {
+            "size": self.size,
+            "idle": self._idle.qsize(),
+            "sessions": [session.status() for session in self._sessions],
+        }
+
+    def close(self):
+        """Logout every session that is still established."""
+        for session in self._sessions:
+            session.logout()
+        if self.adapter is not None:
+            self.adapter.close()
 
-        return cls.session_id
+
+class SAPService:
+    """
+    The single SAP Service Layer client used across the project.
+
+    All calls go through pooled sessions that share one keep-alive HTTPS
+    connection pool, a default (connect, read) timeout and one retry policy.
+    """
+    SESSION_TIMEOUT = 1800
+    POOL_SIZE = int(os.getenv("SAP_SESSION_POOL_SIZE", "4"))
+    CHECKOUT_TIMEOUT = int(os.getenv("SAP_SESSION_CHECKOUT_TIMEOUT", "60"))
+    # Pool slots allowed to log in at the same time after a 401 wave
+    LOGIN_CONCURRENCY = int(os.getenv("SAP_LOGIN_CONCURRENCY", "1"))
+
+    # Keep-alive connections held open to the Service Layer
+    HTTP_POOL_MAXSIZE = int(os.getenv("SAP_HTTP_POOL_MAXSIZE", str(max(POOL_SIZE, 10))))
+    DEFAULT_TIMEOUT = (
+        float(os.getenv("SAP_CONNECT_TIMEOUT", "5")),
+        float(os.getenv("SAP_READ_TIMEOUT", "30")),
+    )
+    # Connection errors are retried for every method (nothing reached SAP);
+    # gateway errors only for idempotent methods so an invoice is never posted twice.
+    MAX_RETRIES = int(os.getenv("SAP_MAX_RETRIES", "3"))
+    RETRY_BACKOFF = float(os.getenv("SAP_RETRY_BACKOFF", "0.5"))
+    RETRY_STATUSES = (502, 503, 504)
+
+    _pool = None
+    _pool_lock = threading.Lock()
+
+    # Id of the most recently checked-out session (reported by the health check)
+    session_id = None
+    session_created_at = None
 
     @classmethod
-    def get_company_info(cls):
-        """Test API call to validate session"""
-        if not cls.session_id:
-            raise RuntimeError("No active session. Call login() first.")
+    def get_pool(cls):
+        """Create the session pool on first use"""
+        if cls._pool is None:
+            with cls._pool_lock:
+                if cls._pool is None:
+                    cls._pool = SAPSessionPool(
+                        cls.POOL_SIZE,
+                        session_timeout=cls.SESSION_TIMEOUT,
+                        adapter=cls._build_adapter(),
+                        login_concurrency=cls.LOGIN_CONCURRENCY,
+                    )
+        return cls._pool
+
+    @classmethod
+    def _build_adapter(cls):
+        retry = Retry(
+            total=cls.MAX_RETRIES,
+            connect=cls.MAX_RETRIES,
+            read=cls.MAX_RETRIES,
+            status=cls.MAX_RETRIES,
+            backoff_factor=cls.RETRY_BACKOFF,
+            status_forcelist=cls.RETRY_STATUSES,
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+            raise_on_status=False,
+        )
+        return HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=cls.HTTP_POOL_MAXSIZE,
+            max_retries=retry,
+        )
+
+    @classmethod
+    def checkout(cls, timeout=None):
+        """
+        Check a logged-in session out of the pool.
+
+        Usage:
+            with SAPService.checkout() as session:
+                session.http.get(...)
+        """
+        return cls.get_pool().checkout(timeout=timeout or cls.CHECKOUT_TIMEOUT)
 
-        base_url = os.getenv("SAP_SERVICE_LAYER_URL", "").rstrip("/")
-        url = f"{base_url}/CompanyService_GetCompanyInfo"
-        
+    @classmethod
+    def _remember(cls, session):
+        cls.session_id = session.session_id
+        cls.session_created_at = session.created_at
+
+    @classmethod
+    def login(cls):
+        """Force a fresh login on one pooled session and return its SessionId"""
+        with cls.get_pool().checkout(timeout=cls.CHECKOUT_TIMEOUT, force_login=True) as session:
+            cls._remember(session)
+            return session.session_id
+
+    @classmethod
+    def ensure_session(cls):
+        """Ensure at least one valid pooled session exists, logging in if needed"""
+        with cls.checkout() as session:
+            cls._remember(session)
+            return session.session_id
+
+    @classmethod
+    def get_company_info(cls):
+        """Test API call to validate a pooled session"""
         try:
-            # Use the session object - cookies are automatically included
-            session = cls._get_session()
-            resp = session.post(url, json={}, verify=False, timeout=15)
-            resp.raise_for_status()
-            
+            resp = cls.make_request("POST", "/CompanyService_GetCompanyInfo", json={}, timeout=15)
             logger.debug("Company info retrieved successfully")
             return resp.json()
 
@@ -122,66 +420,125 @@ class SAPService:
     @classmethod
     def make_request(cls, method, endpoint, **kwargs):
         """
-        Make an authenticated request to SAP Service Layer
-        
+        Make an authenticated request to SAP Service Layer on a pooled session.
+
+        A 401 response means SAP dropped the session (timeout, server restart);
+        the session is re-established once and the request is retried on it.
+
         Args:
             method: HTTP method (GET, POST, PATCH, DELETE)
             endpoint: API endpoint (e.g., '/Items', '/BusinessPartners')
             **kwargs: Additional arguments to pass to requests
-            
+
         Returns:
             Response object
+
+        Raises:
+            requests.exceptions.RequestException: on connection errors and
+            non-2xx responses (HTTPError carries the SAP response)
         """
-        cls.ensure_session()
-        
-        base_url = os.getenv("SAP_SERVICE_LAYER_URL", "").rstrip("/")
-        url = f"{base_url}{endpoint}"
-        
-        # Use the session object
-        session = cls._get_session()
-        
-        # Set default headers if not provided
-        if 'headers' not in kwargs:
-            kwargs['headers'] = {}
-        if 'Content-Type' not in kwargs['headers']:
+        url = f"{_service_layer_url()}{endpoint}"
+
+        # Set default headers if not provided; multipart uploads set their own
+        kwargs['headers'] = dict(kwargs.get('headers') or {})
+        if 'Content-Type' not in kwargs['headers'] and 'files' not in kwargs:
             kwargs['headers']['Content-Type'] = 'application/json'
-        
+
         # Ensure verify=False is set
         kwargs['verify'] = False
-        
+        kwargs.setdefault('timeout', cls.DEFAULT_TIMEOUT)
+
         try:
-            resp = session.request(method, url, **kwargs)
+            with cls.checkout() as session:
+                resp = session.http.request(method, url, **kwargs)
+
+                if resp.status_code == 401:
+                    logger.warning(
+                        f"SAP returned 401 for {method} {endpoint} on pool slot {session.index}; "
+                        "re-authenticating and retrying once"
+                    )
+                    session.refresh()
+                    _rewind_files(kwargs)
+                    resp = session.http.request(method, url, **kwargs)
+
+                session.touch()
             resp.raise_for_status()
             return resp
-            
+
         except requests.exceptions.RequestException as e:
             logger.error(f"Request failed: {method} {endpoint} - {e}")
             raise
 
+    @classmethod
+    def get(cls, endpoint, **kwargs):
+        return cls.make_request("GET", endpoint, **kwargs)
+
+    @classmethod
+    def post(cls, endpoint, **kwargs):
+        return cls.make_request("POST", endpoint, **kwargs)
+
+    @classmethod
+    def patch(cls, endpoint, **kwargs):
+        return cls.make_request("PATCH", endpoint, **kwargs)
+
+    @classmethod
+    def delete(cls, endpoint, **kwargs):
+        return cls.make_request("DELETE", endpoint, **kwargs)
+
+    @classmethod
+    def batch(cls, operations, atomic=False, **kwargs):
+        """
+        Send several operations to SAP in one OData $batch round trip.
+
+        Args:
+            operations: list of BatchOperation, or (method, endpoint[, body]) tuples
+            atomic: put every write in one changeset so SAP commits all or none;
+                by default each write gets its own changeset and fails alone
+
+        Returns:
+            list of BatchResult in the same order as `operations`
+        """
+        operations = [
+            op if isinstance(op, BatchOperation) else BatchOperation(*op)
+            for op in operations
+        ]
+        if not operations:
+            return []
+
+        body, content_type, groups = build_batch_body(operations, _service_layer_url(), atomic=atomic)
+        resp = cls.make_request(
+            "POST", "/$batch", data=body, headers={"Content-Type": content_type}, **kwargs
+        )
+        return parse_batch_response(resp.headers.get("Content-Type", ""), resp.content, operations, groups)
+
+    @classmethod
+    def pool_status(cls):
+        return cls.get_pool().status()
+
     @classmethod
     def logout(cls):
-        """Call SAP Logout if session is active"""
-        if cls.session_id:
-            base_url = os.getenv("SAP_SERVICE_LAYER_URL", "").rstrip("/")
-            url = f"{base_url}/Logout"
-            
-            try:
-                session = cls._get_session()
-                session.post(url, verify=False, timeout=10)
-                logger.info("✅ SAP session logged out successfully")
-            except Exception as e:
-                logger.warning(f"⚠️ SAP logout failed: {e}")
-            finally:
-                cls.session_id = None
-                cls.session_created_at = None
-                if cls.session:
-                    cls.session.close()
-                    cls.session = None
+        """Logout every pooled session"""
+        if cls._pool is not None:
+            cls._pool.close()
+        cls.session_id = None
+        cls.session_created_at = None
+
+    @classmethod
+    def _reset_after_fork(cls):
+        # Sockets and cookies inherited from the parent process must not be
+        # shared with it; the child builds its own pool on first use.
+        cls._pool = None
+        cls._pool_lock = threading.Lock()
+        cls.session_id = None
+        cls.session_created_at = None
 
 
 # Register logout on shutdown
 atexit.register(SAPService.logout)
 
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=SAPService._reset_after_fork)
+
 
 # Example usage
 if __name__ == "__main__":
@@ -190,20 +547,20 @@ if __name__ == "__main__":
     # os.environ["SAP_USERNAME"] = "manager"
     # os.environ["SAP_PASSWORD"] = "your_password"
     # os.environ["SAP_COMPANY_DB"] = "SBODemoUS"
-    
+
     try:
         # Login
         SAPService.login()
-        
+
         # Test company info
         info = SAPService.get_company_info()
         print(f"Company Info: {info}")
-        
+
         # Example: Make a custom request
         # response = SAPService.make_request('GET', '/Items?$top=5')
         # print(response.json())
-        
+
     except Exception as e:
         logger.error(f"Error: {e}")
     finally:
-        SAPService.logout()
\ No newline at end of file
+        SAPService.logout()
@@ -1,3 +1,507 @@
-from django.test import TestCase
+import io
+import json
+import time
+import asyncio
+import threading
+from unittest import mock
+import httpx
+import requests
+from django.test import SimpleTestCase
+from rest_framework.test import APIRequestFactory, force_authenticate
+from .async_sap_service import AsyncSAPService
+from .batch import BatchOperation, build_batch_body, parse_batch_response
+from .emulator import EmulatorConfig, SAPEmulator, SyntheticCompany, start_emulator
+from .sap_service import SAPService, SAPSession, SAPSessionPool, SAPPoolExhausted, SingleFlight
+from .views import SAPHealthCheckView
 
-# Create your tests here.
+
+def fake_login(session):
+    session.session_id = f"session-{session.index}"
+    session.touch()
+    return session.session_id
+
+
+@mock.patch("sap_integration.sap_service.SAPSession.login", autospec=True, side_effect=fake_login)
+class SAPSessionPoolTests(SimpleTestCase):
+    def test_sessions_are_logged_in_lazily_and_reused(self, login):
+        pool = SAPSessionPool(3)
+
+        with pool.checkout() as session:
+            first_id = session.session_id
+        with pool.checkout() as session:
+            self.assertEqual(session.session_id, first_id)
+
+        self.assertEqual(login.call_count, 1)
+
+    def test_concurrent_checkouts_get_distinct_sessions(self, login):
+        pool = SAPSessionPool(2)
+
+        with pool.checkout() as first, pool.checkout() as second:
+            self.assertNotEqual(first.session_id, second.session_id)
+            with self.assertRaises(SAPPoolExhausted):
+                pool.acquire(timeout=0.01)
+
+        self.assertEqual(pool.status()["idle"], 2)
+
+    def test_expired_session_is_logged_in_again(self, login):
+        pool = SAPSessionPool(1)
+
+        with pool.checkout() as session:
+            session.last_used_at -= session.timeout
+        with pool.checkout():
+            pass
+
+        self.assertEqual(login.call_count, 2)
+
+    def test_sessions_share_one_connection_pool(self, login):
+        pool = SAPSessionPool(2, adapter=SAPService._build_adapter())
+
+        with pool.checkout() as first, pool.checkout() as second:
+            self.assertIs(first.http.get_adapter("https://sap"), second.http.get_adapter("https://sap"))
+            self.assertIsNot(first.http.cookies, second.http.cookies)
+
+    def test_waiting_thread_gets_session_once_released(self, login):
+        pool = SAPSessionPool(1)
+        acquired = []
+
+        session = pool.acquire()
+        waiter = threading.Thread(target=lambda: acquired.append(pool.acquire(timeout=5)))
+        waiter.start()
+        pool.release(session)
+        waiter.join()
+
+        self.assertEqual(acquired, [session])
+
+
+class SingleFlightTests(SimpleTestCase):
+    def test_concurrent_callers_share_one_execution(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def slow_login():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return "session-1"
+
+        leader = threading.Thread(target=lambda: results.append(flight.do("slot", slow_login)))
+        leader.start()
+        started.wait(5)
+        followers = [
+            threading.Thread(target=lambda: results.append(flight.do("slot", slow_login)))
+            for _ in range(5)
+        ]
+        for follower in followers:
+            follower.start()
+        time.sleep(0.2)  # let the followers reach the in-flight call
+        release.set()
+        for thread in [leader, *followers]:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["session-1"] * 6)
+
+    def test_errors_are_shared_and_not_cached(self):
+        flight = SingleFlight()
+
+        with self.assertRaises(RuntimeError):
+            flight.do("slot", mock.Mock(side_effect=RuntimeError("SAP down")))
+        self.assertEqual(flight.do("slot", lambda: "ok"), "ok")
+
+
+@mock.patch.dict("os.environ", {
+    "SAP_SERVICE_LAYER_URL": "https://sap.example/b1s/v1",
+    "SAP_USERNAME": "manager", "SAP_PASSWORD": "secret", "SAP_COMPANY_DB": "TEST",
+})
+class PooledLoginCoordinationTests(SimpleTestCase):
+    """Concurrent 401s on several pool slots, counted at the /Login endpoint."""
+
+    def setUp(self):
+        self.pool = SAPService._pool = SAPSessionPool(3)
+        for session in self.pool._sessions:
+            session.session_id = f"expired-{session.index}"
+            session.touch()
+        self.logins = []
+        self.logged_in = set()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def tearDown(self):
+        SAPService._pool = None
+
+    def _response(self, status_code, body=b"{}"):
+        resp = requests.Response()
+        resp.status_code = status_code
+        resp._content = body
+        return resp
+
+    def _request(self, session, method, url, **kwargs):
+        if url.endswith("/Login"):
+            with self.lock:
+                self.logins.append(url)
+                number = len(self.logins)
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            time.sleep(0.2)  # keep the first login in flight while the others arrive
+            with self.lock:
+                self.in_flight -= 1
+            if self.reject_login:
+                return self._response(401, b'{"error": {"message": {"value": "Invalid credentials"}}}')
+            with self.lock:
+                self.logged_in.add(id(session))
+                return self._response(200, f'{{"SessionId": "fresh-{number}"}}'.encode())
+        return self._response(200 if id(session) in self.logged_in else 401)
+
+    def _concurrent_requests(self):
+        errors = []
+        barrier = threading.Barrier(3)
+
+        def call():
+            barrier.wait()
+            try:
+                SAPService.make_request("GET", "/Items")
+            except requests.exceptions.RequestException as e:
+                errors.append(e)
+
+        with mock.patch("requests.Session.request", autospec=True, side_effect=self._request):
+            threads = [threading.Thread(target=call) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return errors
+
+    def test_rejected_login_is_tried_once_for_the_whole_pool(self):
+        self.reject_login = True
+
+        errors = self._concurrent_requests()
+
+        self.assertEqual(len(self.logins), 1)
+        self.assertEqual(len(errors), 3)
+
+    def test_each_slot_logs_in_once_after_the_first_login(self):
+        self.reject_login = False
+
+        errors = self._concurrent_requests()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.logins), 3)
+        self.assertEqual(len({session.session_id for session in self.pool._sessions}), 3)
+        # Followers queue behind the login limit instead of hitting /Login together
+        self.assertEqual(self.max_in_flight, 1)
+
+    def test_login_concurrency_caps_follower_logins(self):
+        self.pool = SAPService._pool = SAPSessionPool(3, login_concurrency=2)
+        for session in self.pool._sessions:
+            session.session_id = f"expired-{session.index}"
+            session.touch()
+        self.reject_login = False
+
+        errors = self._concurrent_requests()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.logins), 3)
+        self.assertEqual(self.max_in_flight, 2)
+
+
+@mock.patch.dict("os.environ", {"SAP_SERVICE_LAYER_URL": "https://sap.example/b1s/v1"})
+@mock.patch("sap_integration.sap_service.SAPSession.login", autospec=True, side_effect=fake_login)
+class MakeRequestReauthTests(SimpleTestCase):
+    def setUp(self):
+        SAPService._pool = SAPSessionPool(1)
+
+    def tearDown(self):
+        SAPService._pool = None
+
+    def _response(self, status_code):
+        resp = requests.Response()
+        resp.status_code = status_code
+        resp._content = b"{}"
+        return resp
+
+    def test_401_is_retried_once_on_a_fresh_session(self, login):
+        with mock.patch("requests.Session.request", side_effect=[self._response(401), self._response(200)]) as request:
+            resp = SAPService.make_request("GET", "/Items")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(request.call_count, 2)
+        self.assertEqual(login.call_count, 2)
+
+    def test_default_timeout_and_json_content_type(self, login):
+        with mock.patch("requests.Session.request", return_value=self._response(200)) as request:
+            SAPService.get("/BusinessPlaces")
+
+        kwargs = request.call_args.kwargs
+        self.assertEqual(kwargs["timeout"], SAPService.DEFAULT_TIMEOUT)
+        self.assertEqual(kwargs["headers"]["Content-Type"], "application/json")
+
+    def test_uploads_keep_their_multipart_content_type(self, login):
+        with mock.patch("requests.Session.request", return_value=self._response(200)) as request:
+            SAPService.post("/Attachments2", files={"files": ("a.pdf", b"%PDF", "application/pdf")})
+
+        self.assertNotIn("Content-Type", request.call_args.kwargs["headers"])
+
+    def test_second_401_is_raised(self, login):
+        with mock.patch("requests.Session.request", side_effect=[self._response(401), self._response(401)]):
+            with self.assertRaises(requests.exceptions.HTTPError):
+                SAPService.make_request("GET", "/Items")
+
+
+class BatchEncodingTests(SimpleTestCase):
+    BASE_URL = "https://sap.example:50000/b1s/v1"
+
+    def test_writes_get_their_own_changeset_and_reads_stay_outside(self):
+        operations = [
+            BatchOperation("POST", "/PurchaseInvoices", {"CardCode": "S1"}),
+            BatchOperation("GET", "/BusinessPlaces"),
+            BatchOperation("POST", "/PurchaseInvoices", {"CardCode": "S2"}),
+        ]
+
+        body, content_type, groups = build_batch_body(operations, self.BASE_URL)
+        text = body.decode()
+
+        self.assertTrue(content_type.startswith("multipart/mixed; boundary=batch_"))
+        self.assertEqual(groups, [(True, [0]), (False, [1]), (True, [2])])
+        self.assertEqual(text.count("boundary=changeset_"), 2)
+        self.assertIn("POST /b1s/v1/PurchaseInvoices HTTP/1.1", text)
+        self.assertIn("GET /b1s/v1/BusinessPlaces HTTP/1.1", text)
+        self.assertIn('{"CardCode": "S2"}', text)
+
+    def test_atomic_puts_all_writes_in_one_changeset(self):
+        operations = [BatchOperation("POST", "/PurchaseInvoices", {}) for _ in range(3)]
+
+        _, _, groups = build_batch_body(operations, self.BASE_URL, atomic=True)
+
+        self.assertEqual(groups, [(True, [0, 1, 2])])
+
+    def test_response_is_mapped_back_per_operation(self):
+        operations = [
+            BatchOperation("POST", "/PurchaseInvoices", {}),
+            BatchOperation("GET", "/BusinessPlaces"),
+            BatchOperation("POST", "/PurchaseInvoices", {}),
+        ]
+        groups = [(True, [0]), (False, [1]), (True, [2])]
+        response = "\r\n".join([
+            "--batchresponse_1",
+            "Content-Type: multipart/mixed;boundary=changesetresponse_a",
+            "",
+            "--changesetresponse_a",
+            "Content-Type: application/http",
+            "Content-Transfer-Encoding: binary",
+            "Content-ID: 1",
+            "",
+            "HTTP/1.1 201 Created",
+            "Content-Type: application/json;odata=minimalmetadata;charset=utf-8",
+            "",
+            '{"DocEntry": 501}',
+            "--changesetresponse_a--",
+            "--batchresponse_1",
+            "Content-Type: application/http",
+            "Content-Transfer-Encoding: binary",
+            "",
+            "HTTP/1.1 200 OK",
+            "Content-Type: application/json;charset=utf-8",
+            "",
+            '{"value": [{"BPLID": 3}]}',
+            "--batchresponse_1",
+            "Content-Type: application/http",
+            "Content-Transfer-Encoding: binary",
+            "",
+            "HTTP/1.1 400 Bad Request",
+            "Content-Type: application/json;charset=utf-8",
+            "",
+            '{"error": {"code": -5002, "message": {"lang": "en-us", "value": "Quantity exceeds open quantity"}}}',
+            "--batchresponse_1--",
+            "",
+        ])
+
+        results = parse_batch_response(
+            "multipart/mixed;boundary=batchresponse_1", response.encode(), operations, groups
+        )
+
+        self.assertEqual([r.status_code for r in results], [201, 200, 400])
+        self.assertEqual(results[0].body, {"DocEntry": 501})
+        self.assertEqual(results[1].body["value"][0]["BPLID"], 3)
+        self.assertFalse(results[2].ok)
+        self.assertEqual(results[2].error_message, "Quantity exceeds open quantity")
+
+
+@mock.patch.dict("os.environ", {"SAP_SERVICE_LAYER_URL": "https://sap.example/b1s/v1"})
+@mock.patch("sap_integration.sap_service.SAPSession.login", autospec=True, side_effect=fake_login)
+class AsyncSAPServiceTests(SimpleTestCase):
+    def setUp(self):
+        SAPService._pool = SAPSessionPool(2)
+
+    def tearDown(self):
+        SAPService._pool = None
+
+    def test_concurrent_requests_are_bounded_by_the_pool(self, login):
+        in_flight = []
+        peak = []
+
+        async def handler(request):
+            in_flight.append(request.headers["Cookie"])
+            peak.append(len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.remove(request.headers["Cookie"])
+            return httpx.Response(200, json={"value": []})
+
+        async def run():
+            async with AsyncSAPService(transport=httpx.MockTransport(handler)) as sap:
+                return await asyncio.gather(*[sap.get("/BusinessPartners") for _ in range(6)])
+
+        responses = asyncio.run(run())
+
+        self.assertEqual(len(responses), 6)
+        self.assertLessEqual(max(peak), 2)
+        self.assertEqual(len(set(in_flight)), 0)
+
+    def test_401_is_retried_on_a_fresh_session(self, login):
+        statuses = iter([401, 200])
+
+        async def handler(request):
+            return httpx.Response(next(statuses), json={})
+
+        async def run():
+            async with AsyncSAPService(transport=httpx.MockTransport(handler)) as sap:
+                return await sap.get("/Items")
+
+        self.assertEqual(asyncio.run(run()).status_code, 200)
+        self.assertEqual(login.call_count, 2)
+
+    def test_401_retry_resends_the_whole_file_and_keeps_new_cookies(self, login):
+        statuses = iter([401, 200])
+        uploads = []
+
+        async def handler(request):
+            uploads.append(request.read())
+            status = next(statuses)
+            headers = {"Set-Cookie": "ROUTEID=.node2; Path=/"} if status == 200 else {}
+            return httpx.Response(status, json={}, headers=headers)
+
+        async def run():
+            async with AsyncSAPService(transport=httpx.MockTransport(handler)) as sap:
+                return await sap.post("/Attachments2", files={"files": ("invoice.pdf", io.BytesIO(b"%PDF-1.4"))})
+
+        asyncio.run(run())
+
+        self.assertEqual(len(uploads), 2)
+        self.assertIn(b"%PDF-1.4", uploads[1])
+        session = SAPService._pool._sessions[-1]
+        self.assertEqual(session.http.cookies.get("ROUTEID"), ".node2")
+
+
+@mock.patch.dict("os.environ", {"SAP_USERNAME": "manager", "SAP_PASSWORD": "secret", "SAP_COMPANY_DB": "EMULATED"})
+class ServiceLayerEmulatorTests(SimpleTestCase):
+    def setUp(self):
+        self.company = SyntheticCompany(seed=7, grns=300, vendors=20)
+        self.config = EmulatorConfig(seed=7)
+        self.server = start_emulator(company=self.company, config=self.config)
+        patcher = mock.patch.dict("os.environ", {"SAP_SERVICE_LAYER_URL": self.server.service_root})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        SAPService._pool = SAPSessionPool(1)
+
+    def tearDown(self):
+        SAPService.logout()
+        SAPService._pool = None
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_synthetic_data_is_seeded(self):
+        again = SyntheticCompany(seed=7, grns=300, vendors=20)
+
+        self.assertEqual(again.grns, self.company.grns)
+        self.assertEqual(again.grn_document(again.grns[5]), self.company.grn_document(self.company.grns[5]))
+
+    def test_collections_page_with_next_links_and_count(self):
+        card_code = self.company.grns[0]["CardCode"]
+        expected = [grn["DocEntry"] for grn in self.company.grns_by_vendor[card_code] if grn["DocumentStatus"] == "bost_Open"]
+        query = f"$filter=CardCode eq '{card_code}' and DocumentStatus eq 'bost_Open'"
+
+        count = SAPService.get(f"/PurchaseDeliveryNotes/$count?{query}")
+        entries = []
+        endpoint = f"/PurchaseDeliveryNotes?{query}&$select=DocEntry,DocumentLines&$orderby=DocEntry"
+        while endpoint:
+            body = SAPService.get(endpoint, headers={"Prefer": "odata.maxpagesize=2"}).json()
+            self.assertLessEqual(len(body["value"]), 2)
+            entries.extend(doc["DocEntry"] for doc in body["value"])
+            endpoint = f"/{body['odata.nextLink']}" if "odata.nextLink" in body else None
+
+        self.assertEqual(int(count.text), len(expected))
+        self.assertEqual(entries, expected)
+
+    def test_expired_session_is_answered_with_401_and_reauthenticated(self):
+        SAPService.get("/BusinessPlaces")
+        self.server.emulator.sessions.clear()
+
+        resp = SAPService.get("/BusinessPlaces")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.server.emulator.stats["401"], 1)
+        self.assertEqual(self.server.emulator.stats["logins"], 2)
+
+    def test_batch_posts_invoice_and_closes_the_grn(self):
+        header = next(grn for grn in self.company.grns if grn["DocumentStatus"] == "bost_Open")
+        grn = self.company.grn_document(header)
+        invoice = {
+            "CardCode": header["CardCode"],
+            "DocumentLines": [
+                {"BaseType": 20, "BaseEntry": header["DocEntry"], "BaseLine": line["LineNum"],
+                 "Quantity": line["RemainingOpenQuantity"]}
+                for line in grn["DocumentLines"] if line["RemainingOpenQuantity"] > 0
+            ],
+        }
+        duplicate = {**invoice, "DocumentLines": invoice["DocumentLines"][:1]}
+
+        created, rejected = SAPService.batch([("POST", "/PurchaseInvoices", invoice), ("POST", "/PurchaseInvoices", duplicate)])
+
+        self.assertEqual(created.status_code, 201)
+        self.assertEqual(created.body["CardCode"], header["CardCode"])
+        self.assertEqual(rejected.status_code, 400)
+        self.assertIn("already closed", rejected.error_message)
+        self.assertEqual(header["DocumentStatus"], "bost_Close")
+        self.assertEqual(len(self.company.invoices), 1)
+
+    def test_injected_faults_follow_the_configured_rates(self):
+        emulator = SAPEmulator(self.company, EmulatorConfig(error_rate_429=1.0))
+        session_id = emulator.login({"UserName": "manager", "CompanyDB": "EMULATED"}).body
+        session_id = json.loads(session_id)["SessionId"]
+
+        resp = emulator.handle("GET", "/BusinessPlaces", {}, {}, b"", session_id=session_id)
+        unknown = SAPEmulator(self.company).handle("GET", "/BusinessPlaces", {}, {}, b"", session_id="nope")
+
+        self.assertEqual(resp.status, 429)
+        self.assertEqual(resp.headers["Retry-After"], "1")
+        self.assertEqual(unknown.status, 401)
+
+
+@mock.patch.dict("os.environ", {"SAP_SERVICE_LAYER_URL": "https://sap.example/b1s/v1"})
+@mock.patch("sap_integration.sap_service.SAPSession.login", autospec=True, side_effect=fake_login)
+class HealthCheckTests(SimpleTestCase):
+    def setUp(self):
+        SAPService._pool = SAPSessionPool(2)
+
+    def tearDown(self):
+        SAPService._pool = None
+
+    @mock.patch("sap_integration.sap_service.SAPService.get_company_info", return_value={"CompanyName": "X"})
+    def test_reports_age_and_expiry_of_the_oldest_pooled_session(self, company_info, login):
+        SAPService.ensure_session()
+        for session in SAPService._pool._sessions:
+            if session.session_id:
+                session.created_at = time.time() - 120
+
+        request = APIRequestFactory().get("/api/v1/sap/health/")
+        force_authenticate(request, user=mock.Mock(is_authenticated=True, pk=1))
+        with mock.patch("rest_framework.views.APIView.get_throttles", return_value=[]):
+            resp = SAPHealthCheckView.as_view()(request)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertGreaterEqual(resp.data["session_age_seconds"], 120)
+        self.assertEqual(resp.data["expiry_status"], "valid")
+        self.assertEqual(resp.data["session_pool"]["size"], 2)
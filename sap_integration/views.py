@@ -1,4 +1,3 @@
-import time
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
@@ -7,7 +6,7 @@ from .sap_service import SAPService
 
 class SAPHealthCheckView(APIView):
     """
-    Health endpoint to check SAP connection, session, and basic company info.
+    Health endpoint to check SAP connection, session pool, and basic company info.
     """
 
     def get(self, request):
@@ -15,17 +14,21 @@ class SAPHealthCheckView(APIView):
         company_info = None
 
         try:
-            # Ensure session (this may trigger a re-login if expired)
+            # Ensure a pooled session (this may trigger a login if all have expired)
             old_session = SAPService.session_id
             session_id = SAPService.ensure_session()
             if old_session != session_id:
                 relogin_triggered = True
 
-            # Session age
-            age = None
+            # Age of the oldest established pooled session, as reported before pooling
+            pool_status = SAPService.pool_status()
+            ages = [
+                session["session_age_seconds"] for session in pool_status["sessions"]
+                if session["session_id"] and session["session_age_seconds"] is not None
+            ]
+            age = max(ages) if ages else None
             expiry_status = "unknown"
-            if SAPService.session_created_at:
-                age = round(time.time() - SAPService.session_created_at, 2)
+            if age is not None:
                 expiry_status = (
                     "valid"
                     if age < SAPService.SESSION_TIMEOUT
@@ -45,6 +48,7 @@ class SAPHealthCheckView(APIView):
                     "session_age_seconds": age,
                     "expiry_status": expiry_status,
                     "relogin_triggered": relogin_triggered,
+                    "session_pool": pool_status,
                     "company_info": company_info,
                 },
                 status=status.HTTP_200_OK,